@@ -1,3 +1,4 @@
 from __future__ import absolute_import
 from .mcl_xyz_stage import MclXYZStageHW
-from .mcl_stage_slowscan import MCLStage2DSlowScan
\ No newline at end of file
+from .mcl_stage_slowscan import MCLStage2DSlowScan, MCLStage2DWaveformScan, MCLStage2DFrameWaveformScan
+from .mcl_point_scan import MCLStagePointScan, MCLStageAdaptiveScan
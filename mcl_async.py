@@ -0,0 +1,239 @@
+'''
+asyncio API for MCLNanoDrive and MclXYZStageHW.
+
+Blocking driver calls run on a dedicated single thread executor, so an
+event loop can move the stage and run asyncio detector drivers at the same
+time:
+
+    stage = AsyncNanoDrive(nanodrive)
+    await asyncio.gather(stage.move_to(10, 20), detector.arm())
+    async for t, pos in stage.stream_positions(0.01):
+        ...
+
+Slow moves run on the drive's motion thread and are awaited through
+SlowMove.add_done_callback, no thread waits for them. Cancelling the
+awaiting task (or an asyncio.wait_for timeout) cancels the move, the motion
+loop stops at its next step.
+'''
+from __future__ import division, print_function, absolute_import
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from .mcl_nanodrive import PRIORITY_MOVE
+
+
+def _call_soon(loop, func, *args):
+    # from a driver thread: the loop may have been closed since (eg. the
+    # awaiting task was cancelled), then nobody waits for the result
+    try:
+        loop.call_soon_threadsafe(func, *args)
+    except RuntimeError:
+        if not loop.is_closed():
+            raise
+
+
+async def await_move(move, poll_interval=0.005, run=None):
+    '''
+    Wait for a SlowMove (or mcl_client.RemoteMove) without blocking the
+    loop, returns move.wait()'s result. Cancelling cancels the move.
+    run: coroutine function running a blocking call off the loop, used to
+         poll moves that have no add_done_callback
+    '''
+    try:
+        if hasattr(move, 'add_done_callback'):
+            loop = asyncio.get_running_loop()
+            done = loop.create_future()
+            def on_done(m):
+                _call_soon(loop, lambda: done.done() or done.set_result(None))
+            move.add_done_callback(on_done)
+            await done
+        else:
+            while not await run(move.done):
+                await asyncio.sleep(poll_interval)
+            return await run(move.wait, 0)
+    except asyncio.CancelledError:
+        move.cancel()
+        raise
+    return move.wait(0)
+
+
+class AsyncNanoDrive(object):
+
+    def __init__(self, nanodrive, priority=PRIORITY_MOVE, poll_interval=0.005):
+        '''
+        nanodrive: MCLNanoDrive (or mcl_client.MCLStageClient), stays owned by the caller
+        priority: I/O priority of the calls made through this object
+        poll_interval: how often moves of a stage server client are checked
+        '''
+        self.nd = nanodrive
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='mcl_async',
+                                           initializer=nanodrive.set_io_priority,
+                                           initargs=(priority,))
+
+    async def run(self, func, *args):
+        '''func(*args) on the driver executor'''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def set_pos(self, x=None, y=None, z=None):
+        '''fast move, returns once settled (see MCLNanoDrive.settle_mode)'''
+        await self.run(self.nd.set_pos, x, y, z)
+
+    async def set_pos_ax(self, pos, axis):
+        await self.run(self.nd.set_pos_ax, pos, axis)
+
+    async def move_to(self, x=None, y=None, z=None):
+        '''
+        slow move at max_speed, True if the targets were reached (False if
+        a later move superseded it)
+        '''
+        # starting is a round trip when nd is a stage server client
+        move = await self.run(self.nd.move_slow, x, y, z)
+        return await await_move(move, self.poll_interval, self.run)
+
+    async def move_to_ax(self, pos, axis):
+        move = await self.run(self.nd.move_slow_ax, pos, axis)
+        return await await_move(move, self.poll_interval, self.run)
+
+    async def read_positions(self, axes=None, max_age=None):
+        '''measured positions of axes (default: all), one batched read'''
+        if axes is None:
+            axes = list(range(1, self.nd.num_axes + 1))
+        return await self.run(self.nd.read_axes, axes, max_age)
+
+    async def stream_positions(self, interval=0.01, axes=None):
+        '''
+        yields (time.monotonic(), positions) every interval seconds, reads
+        are scheduled against absolute deadlines so the rate does not drift
+        '''
+        t_next = time.monotonic()
+        while True:
+            pos = await self.read_positions(axes, 0)
+            yield time.monotonic(), pos
+            t_next += interval
+            delay = t_next - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                t_next = time.monotonic() # fell behind, do not burst
+
+
+async def stream_recorder(recorder, max_blocks=16):
+    '''
+    yields (t0, data) copies of the blocks of a running MCLPositionRecorder
+    (see MCLPositionRecorder.add_listener). If the consumer falls behind by
+    more than max_blocks the oldest queued blocks are dropped.
+    '''
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    def put(block):
+        if queue.qsize() >= max_blocks:
+            queue.get_nowait()
+        queue.put_nowait(block)
+    def on_block(t0, data):
+        _call_soon(loop, put, (t0.copy(), data.copy()))
+    recorder.add_listener(on_block)
+    try:
+        while True:
+            yield await queue.get()
+    finally:
+        recorder.remove_listener(on_block)
+
+
+class AsyncStage(object):
+    '''
+    asyncio API of a connected MclXYZStageHW, positions in sample
+    coordinates like move_pos_slow / move_pos_fast
+    '''
+
+    def __init__(self, hw, priority=PRIORITY_MOVE, poll_interval=0.005):
+        self.hw = hw
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='mcl_async',
+                                           initializer=self._set_priority, initargs=(priority,))
+
+    def _set_priority(self, priority):
+        for drive in self.hw.drives:
+            drive.set_io_priority(priority)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def move_to(self, x=None, y=None, z=None):
+        '''
+        slow move, every controller concurrently. True if all targets were
+        reached. Cancelling stops all of them.
+        '''
+        hw = self.hw
+        hw.mark_activity()
+        groups = await self.run(hw.group_by_drive, x, y, z)
+        moves = await self.run(lambda: [drive.move_slow(*pos) for drive, pos in groups.items()])
+        waits = [asyncio.ensure_future(await_move(move, self.poll_interval, self.run))
+                 for move in moves]
+        try:
+            reached = await asyncio.gather(*waits)
+        except asyncio.CancelledError:
+            for move, w in zip(moves, waits):
+                move.cancel()
+                w.cancel()
+            raise
+        for ax in 'XYZ':
+            drive, axis_id = hw.axis_drive[ax], hw.MCL_AXIS_ID[ax]
+            if drive in groups and groups[drive][axis_id-1] is not None:
+                hw.settings[ax.lower() + '_target'].update_value(groups[drive][axis_id-1],
+                                                                  update_hardware=False)
+        return all(reached)
+
+    async def move_fast(self, x=None, y=None, z=None):
+        await self.run(self.hw.move_pos_fast, x, y, z)
+
+    def _read_positions(self, max_age):
+        hw = self.hw
+        groups = OrderedDict()
+        for ax in 'XYZ':
+            if ax != 'Z' or hw.has_z:
+                groups.setdefault(hw.axis_drive[ax], []).append(ax)
+        positions = OrderedDict()
+        for drive, names in groups.items():
+            values = drive.read_axes([hw.MCL_AXIS_ID[ax] for ax in names], max_age)
+            positions.update(zip(names, values))
+        return positions
+
+    async def read_positions(self, max_age=None):
+        '''OrderedDict X, Y (, Z) -> measured stage position'''
+        return await self.run(self._read_positions, max_age)
+
+    async def stream_positions(self, interval=0.01):
+        '''
+        yields (time.monotonic(), positions dict), from the position
+        recorder's blocks while it runs, otherwise read every interval
+        '''
+        hw = self.hw
+        recorder = getattr(hw, 'recorder', None)
+        if recorder is not None and recorder.running:
+            names = hw.recorder_names
+            dt = recorder.ring.dt
+            async for t0, data in stream_recorder(recorder):
+                for k in range(data.shape[1]):
+                    yield t0[0] + k*dt, OrderedDict(zip(names, data[:, k]))
+            return
+        t_next = time.monotonic()
+        while True:
+            pos = await self.read_positions(0)
+            yield time.monotonic(), pos
+            t_next += interval
+            delay = t_next - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                t_next = time.monotonic()
+
+    async def stop_motion(self):
+        await self.run(self.hw.stop_motion)
@@ -0,0 +1,160 @@
+'''
+Throughput benchmarks for the MCL stage driver and scan classes, run against
+the simulated MadLib backend so they work without hardware:
+
+    python -m ScopeFoundry_HW.mcl_stage.mcl_benchmark [--json results.json]
+
+Scan benchmarks need ScopeFoundry (and a Qt binding), they are skipped if it
+cannot be imported.
+'''
+from __future__ import division, print_function, absolute_import
+import time
+import json
+import argparse
+from collections import OrderedDict
+from .mcl_nanodrive import MCLNanoDrive
+from .mcl_sim import SimMadlib
+from .mcl_server import MCLStageServer
+from .mcl_client import MCLStageClient
+
+
+def _rate(func, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        func(i)
+    return n/(time.perf_counter() - t0)
+
+
+def bench_set_get(nanodrive, n=2000):
+    '''calls per second of the single point driver wrappers'''
+    nd = nanodrive
+    x0 = nd.cal_X*0.5
+    results = OrderedDict()
+    results['set_pos_ax_per_s'] = _rate(lambda i: nd.set_pos_ax(x0 + 1e-3*(i % 100), 1), n)
+    results['set_pos_xy_per_s'] = _rate(lambda i: nd.set_pos(x0 + 1e-3*(i % 100), x0), n)
+    results['get_pos_ax_per_s'] = _rate(lambda i: nd.get_pos_ax(1), n)
+    results['get_pos_per_s'] = _rate(lambda i: nd.get_pos(), n)
+    return results
+
+
+def bench_slow_move(nanodrive, distance=5.0, speed=100.0):
+    '''wall time of set_pos_slow against the planned (speed and acceleration limited) duration'''
+    nd = nanodrive
+    nd.set_max_speed(speed)
+    x0 = nd.cal_X*0.5
+    nd.set_pos(x0, x0)
+    ideal = nd.plan_slow_move([1], [x0], [x0 + distance]).duration
+    t0 = time.perf_counter()
+    nd.set_pos_slow(x0 + distance, x0)
+    wall = time.perf_counter() - t0
+    return OrderedDict([('set_pos_slow_wall_s', wall),
+                        ('set_pos_slow_ideal_s', ideal),
+                        ('set_pos_slow_overhead', wall/ideal - 1)])
+
+
+def bench_server(n=2000, batch=100, address='127.0.0.1:47556'):
+    '''
+    per command overhead of the stage server, on a zero latency simulated
+    driver so only the client, transport and server remain
+    '''
+    nd = MCLNanoDrive(backend=SimMadlib(write_latency=0, read_latency=0, call_latency=0))
+    server = MCLStageServer(nd, address)
+    server.start_thread()
+    client = MCLStageClient(address)
+    try:
+        x0 = nd.cal_X*0.5
+        direct = _rate(lambda i: nd.get_pos_ax(1, 0), n)
+        single = _rate(lambda i: client.get_pos_ax(1, 0), n)
+        # the server runs a batch as one call on the I/O worker, the baseline
+        # does the same with the same write/read mix
+        def direct_mix():
+            for j in range(batch):
+                nd.set_pos_ax(x0 + 1e-3*(j % 10), 1)
+                nd.get_pos_ax(1, 0)
+        direct_batched = 2*batch*_rate(lambda i: nd._io_call(direct_mix), max(1, n//batch))
+        def send_batch(i):
+            b = client.batch()
+            for j in range(batch):
+                b.set_pos_ax(x0 + 1e-3*(j % 10), 1).get_pos_ax(1, 0)
+            b.send()
+        batched = 2*batch*_rate(send_batch, max(1, n//batch))
+    finally:
+        client.close()
+        server.stop()
+        nd.close()
+    return OrderedDict([('server_direct_per_s', direct),
+                        ('server_single_per_s', single),
+                        ('server_direct_batched_per_s', direct_batched),
+                        ('server_batched_per_s', batched),
+                        ('server_single_overhead_us', 1e6*(1/single - 1/direct)),
+                        ('server_batched_overhead_us', 1e6*(1/batched - 1/direct_batched))])
+
+
+def bench_scans(sim_kwargs, Nh=16, Nv=16):
+    '''end-to-end pixels per second of the slow scan measurements'''
+    try:
+        from ScopeFoundry import BaseMicroscopeApp
+        from .mcl_xyz_stage import MclXYZStageHW
+        from .mcl_stage_slowscan import MCLStage2DSlowScan, Delay_MCL_2DSlowScan
+    except ImportError as err:
+        print("skipping scan benchmarks:", err)
+        return OrderedDict()
+
+    class BenchmarkApp(BaseMicroscopeApp):
+        name = 'mcl_benchmark'
+        def setup(self):
+            hw = self.add_hardware(MclXYZStageHW(self))
+            hw.settings['backend'] = 'sim'
+            hw.sim_kwargs = sim_kwargs
+            self.add_measurement(MCLStage2DSlowScan(self))
+            self.add_measurement(Delay_MCL_2DSlowScan(self))
+
+    app = BenchmarkApp([])
+    app.hardware['mcl_xyz_stage'].settings['connected'] = True
+
+    results = OrderedDict()
+    for mname in ['MCLStage2DSlowScan', 'Delay_MCL_2DSlowScan']:
+        M = app.measurements[mname]
+        S = M.settings
+        S['save_h5'] = False
+        if hasattr(S, 'continuous_scan'):
+            S['continuous_scan'] = False
+        S['h0'], S['h1'], S['Nh'] = 10, 20, Nh
+        S['v0'], S['v1'], S['Nv'] = 10, 20, Nv
+        S['pixel_time'] = 0
+        M.interrupt_measurement_called = False
+        t0 = time.perf_counter()
+        M.run()
+        results[mname + '_pixels_per_s'] = Nh*Nv/(time.perf_counter() - t0)
+
+    app.hardware['mcl_xyz_stage'].settings['connected'] = False
+    return results
+
+
+def run_benchmarks(n=2000, **sim_kwargs):
+    results = OrderedDict()
+    nd = MCLNanoDrive(backend=SimMadlib(**sim_kwargs))
+    try:
+        results.update(bench_set_get(nd, n))
+        results.update(bench_slow_move(nd))
+    finally:
+        nd.close()
+    results.update(bench_server(n))
+    results.update(bench_scans(sim_kwargs))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MCL stage throughput benchmarks (simulated driver)")
+    parser.add_argument('-n', type=int, default=2000, help="calls per driver benchmark")
+    parser.add_argument('--write-latency', type=float, default=150e-6)
+    parser.add_argument('--read-latency', type=float, default=250e-6)
+    parser.add_argument('--json', help="write results to this file")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.n, write_latency=args.write_latency, read_latency=args.read_latency)
+    for k, v in results.items():
+        print("{:40s} {:12.4g}".format(k, v))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
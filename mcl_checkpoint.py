@@ -0,0 +1,60 @@
+'''
+Progress checkpoints of long scans.
+
+A ScanCheckpoint is a small JSON record of where a scan is (frame, first
+pixel of the line being scanned, recoveries so far, ...). The pixel data
+itself goes to the scan's h5 file as it is collected; each checkpoint
+flushes that file first, so after a crash everything before the recorded
+line is on disk. Updates are throttled to one per min_interval seconds and
+written with a rename, a crash never leaves a truncated record behind.
+'''
+from __future__ import division, print_function, absolute_import
+import json
+import os
+import time
+
+
+class ScanCheckpoint(object):
+
+    def __init__(self, path, min_interval=5.0, h5_file=None, **info):
+        '''
+        path: JSON file, rewritten on every update
+        h5_file: open h5py file of the scan, flushed before each update
+        info: fixed entries stored with every update (scan shape, plane positions, ...)
+        '''
+        self.path = path
+        self.min_interval = min_interval
+        self.h5_file = h5_file
+        self.info = info
+        if h5_file is not None:
+            self.info['h5_file'] = h5_file.filename
+        self.t_last = None
+        self.write_count = 0
+
+    def update(self, force=False, status='running', **state):
+        '''record state, returns True if it was written'''
+        now = time.time()
+        if not force and self.t_last is not None and now - self.t_last < self.min_interval:
+            return False
+        if self.h5_file is not None:
+            self.h5_file.flush()
+        record = dict(self.info)
+        record.update(state, status=status, time=now)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.t_last = now
+        self.write_count += 1
+        return True
+
+    @staticmethod
+    def load(path):
+        '''last record written to path, None if there is none'''
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
@@ -0,0 +1,426 @@
+'''
+Client of a local stage server (mcl_server.MCLStageServer).
+
+MCLStageClient has the MCLNanoDrive API used by MclXYZStageHW, the scans
+and scripts, so any of them can share a controller that another process
+owns. Each call is one round trip; batch() queues several commands and
+sends them in one frame:
+
+    b = client.batch()
+    for x in xs:
+        b.set_pos_ax(x, 1).get_pos_ax(1)
+    results = b.send()
+'''
+from __future__ import division, print_function, absolute_import
+import json
+import socket
+import threading
+import time
+import numpy as np
+from .mcl_nanodrive import MCLDeviceError, MCLProductInformation, PRIORITY_MOVE
+from .mcl_io_worker import IOFuture
+from .mcl_timing import CallTimer
+from .mcl_waveform import WAVEFORM_MAX_POINTS
+from .mcl_server import (DEFAULT_ADDRESS, FRAME_HEADER, CMD_HEADER, DOUBLE, OP_NAMES, OP_CALL,
+                         OP_SET_POS_AX, OP_GET_POS_AX, OP_READ_AXES, OP_WRITE_AXES, OP_SETTLE,
+                         OP_GET_COMMANDED_POS_AX, OP_MOVE_SLOW, OP_WAIT_MOTION, OP_STOP_MOTION,
+                         OP_SETUP_LOAD_WAVEFORM, OP_READ_WAVEFORM, OP_WAVEFORM_ACQUISITION,
+                         OP_WFMA_SETUP, OP_WFMA_TRIGGER_AND_READ, CALL_METHODS, REMOTE_ATTRIBUTES,
+                         STATUS_OK, KIND_NONE, KIND_ARRAY, parse_address, axis_mask, encode_frame,
+                         encode_json, decode_array, iter_commands)
+
+
+# exception types re-raised as themselves on the client, others as RuntimeError
+REMOTE_ERRORS = dict((e.__name__, e) for e in (ValueError, AssertionError, KeyError, TypeError,
+                                               IOError, OSError, TimeoutError))
+
+
+def _remote_error(data):
+    name, message, code = json.loads(data.decode('utf-8'))
+    if name == 'MCLDeviceError':
+        return MCLDeviceError(message, code)
+    return REMOTE_ERRORS.get(name, RuntimeError)(message)
+
+
+def _doubles(*values):
+    return np.array(values, dtype='<f8').tobytes()
+
+
+class CommandBatch(object):
+    '''
+    commands queued with the methods below (same arguments as
+    MCLNanoDrive, they return the batch for chaining) and sent in one
+    frame by send(), which returns their results in order
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def add(self, op, axis=0, data=b''):
+        self.commands.append((op, axis, data))
+        return self
+
+    def set_pos_ax(self, pos, axis):
+        return self.add(OP_SET_POS_AX, axis, DOUBLE.pack(pos))
+
+    def get_pos_ax(self, axis, max_age=None):
+        return self.add(OP_GET_POS_AX, axis, b'' if max_age is None else DOUBLE.pack(max_age))
+
+    def read_axes(self, axes, max_age=None):
+        return self.add(OP_READ_AXES, axis_mask(axes), b'' if max_age is None else DOUBLE.pack(max_age))
+
+    def write_axes(self, axes, positions):
+        '''positions must be in increasing axis order'''
+        return self.add(OP_WRITE_AXES, axis_mask(axes), _doubles(*positions))
+
+    def settle(self):
+        return self.add(OP_SETTLE)
+
+    def get_commanded_pos_ax(self, axis):
+        return self.add(OP_GET_COMMANDED_POS_AX, axis)
+
+    def move_slow(self, x=None, y=None, z=None):
+        targets = [(axis, pos) for axis, pos in ((1, x), (2, y), (3, z)) if pos is not None]
+        return self.add(OP_MOVE_SLOW, axis_mask([a for a, p in targets]), _doubles(*[p for a, p in targets]))
+
+    def wait_motion(self, timeout=None, move_id=0):
+        '''waits for the move with move_id, by default the last one of this client'''
+        if timeout is None:
+            data = _doubles(move_id) if move_id else b''
+        else:
+            data = _doubles(move_id, timeout)
+        return self.add(OP_WAIT_MOTION, 0, data)
+
+    def call(self, name, *args):
+        return self.add(OP_CALL, 0, encode_json([name, args]))
+
+    def send(self):
+        '''results: None, float64 arrays or JSON values, raises the first error'''
+        commands, self.commands = self.commands, []
+        return self.client._request(commands)
+
+
+class RemoteMove(object):
+    '''SlowMove handle of a move running on the server'''
+
+    def __init__(self, client, move_id):
+        self.client = client
+        self.move_id = move_id
+
+    def wait(self, timeout=None):
+        return bool(self.client.batch().wait_motion(timeout, self.move_id).send()[0][0])
+
+    def done(self):
+        return self.client.call('move_done', self.move_id)
+
+    def cancel(self):
+        self.client.call('move_cancel', self.move_id)
+
+
+class RemoteSettleStats(object):
+    '''settle_stats of the served drive, every attribute access is a round trip'''
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        stats = self.client.call('settle_stats')
+        if name not in stats:
+            raise AttributeError(name)
+        return stats[name]
+
+    @property
+    def mean(self):
+        stats = self.client.call('settle_stats')
+        return stats['total']/stats['count'] if stats['count'] else 0.0
+
+    def reset(self):
+        self.client.reset_settle_model()
+
+
+class MCLStageClient(object):
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        '''
+        address: of the MCLStageServer, 'host:port' or 'unix:/path'
+        timeout: socket timeout (s), None waits as long as calls take
+        '''
+        kind, addr = parse_address(address)
+        if kind == 'unix':
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(timeout)
+        sock.connect(addr)
+        object.__setattr__(self, 'address', address)
+        object.__setattr__(self, '_sock', sock)
+        object.__setattr__(self, '_file', sock.makefile('rb'))
+        object.__setattr__(self, 'lock', threading.Lock())
+        object.__setattr__(self, 'call_timer', None)
+        object.__setattr__(self, '_closed', False)
+        object.__setattr__(self, '_io_local', threading.local())
+        object.__setattr__(self, '_sent_priority', PRIORITY_MOVE)
+        self._load_info(self.call('device_info'))
+        self.settle_stats = RemoteSettleStats(self)
+        self.linearization = None
+        self.reconnect_count = 0
+
+    def _load_info(self, info):
+        self.device_serial_number = info['serial']
+        self.num_axes = info['num_axes']
+        self.cal = dict((int(axis), cal) for axis, cal in info['cal'].items())
+        for axname, axnum in [('X', 1), ('Y', 2), ('Z', 3)]:
+            setattr(self, 'cal_%s' % axname, self.cal.get(axnum))
+        self.prodinfo = MCLProductInformation(**info['prodinfo'])
+        self.max_speed = info['max_speed']
+        self.max_accel = info['max_accel']
+        for name in REMOTE_ATTRIBUTES:
+            object.__setattr__(self, name, info[name])
+
+    def __setattr__(self, name, value):
+        # settings of the served drive are set there too, and kept for reading
+        if name in REMOTE_ATTRIBUTES:
+            self.call('set_attr', name, value)
+        object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        # the remaining MCLNanoDrive methods, one OP_CALL each
+        if name in CALL_METHODS:
+            return lambda *args: self.call(name, *args)
+        raise AttributeError(name)
+
+    # transport
+
+    def _request(self, commands):
+        priority = getattr(self._io_local, 'priority', PRIORITY_MOVE)
+        parts = [CMD_HEADER.pack(op, axis, len(data)) + data for op, axis, data in commands]
+        with self.lock:
+            # the server keeps one priority per connection, switch it when
+            # another thread of this process shares the connection
+            switch = priority != self._sent_priority
+            if switch:
+                data = encode_json(['set_io_priority', [priority]])
+                parts.insert(0, CMD_HEADER.pack(OP_CALL, 0, len(data)) + data)
+            t0 = time.perf_counter()
+            self._sock.sendall(encode_frame(parts, len(parts)))
+            size, n = FRAME_HEADER.unpack(self._read(FRAME_HEADER.size))
+            payload = self._read(size)
+            if self.call_timer is not None:
+                name = OP_NAMES[commands[0][0]] if len(commands) == 1 else 'batch'
+                self.call_timer.record(name, time.perf_counter() - t0)
+            if switch:
+                object.__setattr__(self, '_sent_priority', priority)
+        results = []
+        for status, kind, data in list(iter_commands(payload, n))[int(switch):]:
+            if status != STATUS_OK:
+                raise _remote_error(data)
+            if kind == KIND_NONE:
+                results.append(None)
+            elif kind == KIND_ARRAY:
+                results.append(decode_array(data))
+            else:
+                results.append(json.loads(data.decode('utf-8')))
+        return results
+
+    def _read(self, n):
+        data = self._file.read(n)
+        if len(data) != n:
+            raise MCLDeviceError("stage server at {} closed the connection".format(self.address), -3)
+        return data
+
+    def _cmd(self, op, axis=0, data=b''):
+        return self._request([(op, axis, data)])[0]
+
+    def batch(self):
+        return CommandBatch(self)
+
+    def call(self, name, *args):
+        return self._cmd(OP_CALL, 0, encode_json([name, args]))
+
+    def close(self, release=True):
+        '''closes the connection, the server keeps the controller'''
+        if self._closed:
+            return
+        self._closed = True
+        self._file.close()
+        self._sock.close()
+
+    def __del__(self):
+        if '_sock' in self.__dict__:
+            self.close()
+
+    # MCLNanoDrive API
+
+    def enable_call_timing(self, enable=True):
+        '''round trip time per command type in call_timer'''
+        if not enable:
+            object.__setattr__(self, 'call_timer', None)
+        elif self.call_timer is None:
+            object.__setattr__(self, 'call_timer', CallTimer())
+        return self.call_timer
+
+    @property
+    def write_count(self):
+        return self.call('counters')['write_count']
+
+    @property
+    def skipped_write_count(self):
+        return self.call('counters')['skipped_write_count']
+
+    @property
+    def upload_count(self):
+        return self.call('counters')['upload_count']
+
+    @property
+    def skipped_upload_count(self):
+        return self.call('counters')['skipped_upload_count']
+
+    def set_io_priority(self, priority):
+        '''
+        Priority of the server's driver calls for requests made from the
+        current thread, see MCLNanoDrive.set_io_priority
+        '''
+        self._io_local.priority = priority
+
+    def set_max_speed(self, max_speed):
+        self.call('set_max_speed', max_speed)
+        self.max_speed = float(max_speed)
+
+    def get_max_speed(self):
+        return self.max_speed
+
+    def set_max_accel(self, max_accel):
+        self.call('set_max_accel', max_accel)
+        self.max_accel = float(max_accel)
+
+    def get_max_accel(self):
+        return self.max_accel
+
+    def has_profile(self, bit):
+        return bool(self.prodinfo.FirmwareProfile & bit)
+
+    @property
+    def dac_bits(self):
+        return 20 if self.prodinfo.DAC_resolution >= 20 else 16
+
+    def waveform_max_points(self):
+        return WAVEFORM_MAX_POINTS[self.dac_bits]
+
+    def set_pos_ax(self, pos, axis):
+        self._cmd(OP_SET_POS_AX, axis, DOUBLE.pack(pos))
+
+    def set_pos_ax_async(self, pos, axis):
+        future = IOFuture()
+        future._set(self.set_pos_ax(pos, axis))
+        return future
+
+    def set_pos(self, x=None, y=None, z=None):
+        b = self.batch()
+        for axis, pos in ((1, x), (2, y), (3, z)):
+            if pos is not None:
+                b.set_pos_ax(pos, axis)
+        b.settle().send()
+
+    def write_axes(self, axes, positions, raw=None):
+        # raw is not sent, the server corrects the positions (see linearize)
+        order = np.argsort(axes)
+        self._cmd(OP_WRITE_AXES, axis_mask(axes), np.asarray(positions, dtype='<f8')[order].tobytes())
+
+    def write_axes_async(self, axes, positions, raw=None):
+        '''writes right away (the round trip is the write), returns done futures'''
+        b = self.batch()
+        for axis, pos in zip(axes, positions):
+            b.set_pos_ax(float(pos), axis)
+        b.send()
+        futures = [IOFuture() for _ in axes]
+        for future in futures:
+            future._set()
+        return futures
+
+    def settle(self, mode=None):
+        return self._cmd(OP_SETTLE)
+
+    def get_pos_ax(self, axis, max_age=None):
+        return float(self._cmd(OP_GET_POS_AX, axis, b'' if max_age is None else DOUBLE.pack(max_age))[0])
+
+    def singleReadN(self, axis):
+        return self.get_pos_ax(axis, 0)
+
+    def read_axes(self, axes, max_age=None):
+        pos = self._cmd(OP_READ_AXES, axis_mask(axes), b'' if max_age is None else DOUBLE.pack(max_age))
+        by_axis = dict(zip(sorted(axes), pos.tolist()))
+        return [by_axis[axis] for axis in axes]
+
+    def get_pos(self, max_age=None):
+        axes = [1, 2, 3] if self.num_axes > 2 else [1, 2]
+        pos = self.read_axes(axes, max_age)
+        return (pos[0], pos[1], pos[2] if self.num_axes > 2 else -1)
+
+    def get_commanded_pos_ax(self, axis):
+        return float(self._cmd(OP_GET_COMMANDED_POS_AX, axis)[0])
+
+    def move_slow(self, x=None, y=None, z=None):
+        move_id = self.batch().move_slow(x, y, z).send()[0][0]
+        return RemoteMove(self, int(move_id))
+
+    def move_slow_ax(self, pos, axis):
+        return self.move_slow(*[pos if a == axis else None for a in (1, 2, 3)])
+
+    def set_pos_slow(self, x=None, y=None, z=None):
+        self.batch().move_slow(x, y, z).wait_motion().send()
+
+    def stop_motion(self):
+        self._cmd(OP_STOP_MOTION)
+
+    def set_linearization(self, lmap):
+        '''the tables are sent to the server and applied there'''
+        tables = None
+        if lmap is not None:
+            tables = dict(serial=lmap.serial, reference=lmap.reference,
+                          axes=dict((str(axis), [c, m]) for axis, (c, m) in lmap.axes.items()),
+                          coupling=dict(("{},{}".format(*key), [xp, off])
+                                        for key, (xp, off) in lmap.coupling.items()))
+        self.call('set_linearization', tables)
+        self.linearization = lmap
+
+    def linearize(self, positions):
+        '''positions unchanged: the server corrects writes and uploads'''
+        return positions
+
+    def _into(self, result, out):
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+    def setup_load_waveform_ax(self, waveform, axis, period_ms, raw=False):
+        data = np.concatenate([[period_ms], np.asarray(waveform, dtype=float)]).astype('<f8')
+        self._cmd(OP_SETUP_LOAD_WAVEFORM, axis, data.tobytes())
+
+    def read_waveform_ax(self, axis, n, period_ms, out=None):
+        return self._into(self._cmd(OP_READ_WAVEFORM, axis, _doubles(n, period_ms)), out)
+
+    def trigger_waveform_acquisition(self, axis, out=None):
+        return self._into(self._cmd(OP_WAVEFORM_ACQUISITION, axis), out)
+
+    def trigger_read_waveform_ax(self, axis, out=None):
+        return self._into(self.call('trigger_read_waveform_ax', axis), out)
+
+    def wfma_setup(self, waveforms, period, iterations=1, raw=False):
+        axes = sorted(waveforms)
+        data = np.concatenate([[period, iterations]] + [np.asarray(waveforms[axis], dtype=float)
+                                                         for axis in axes]).astype('<f8')
+        self._cmd(OP_WFMA_SETUP, axis_mask(axes), data.tobytes())
+
+    def wfma_trigger_and_read(self, out=None):
+        return self._into(self._cmd(OP_WFMA_TRIGGER_AND_READ), out)
+
+    def wfma_read(self, out=None):
+        return self._into(self.call('wfma_read'), out)
+
+    def reconnect(self, timeout=60.0, backoff=0.1, max_backoff=5.0):
+        '''reconnect of the served drive, see MCLNanoDrive.reconnect'''
+        self.call('reconnect', timeout, backoff, max_backoff)
+        self.reconnect_count += 1
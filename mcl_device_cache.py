@@ -0,0 +1,79 @@
+'''
+On-disk cache of Nano-Drive product information and calibration.
+
+MCLNanoDrive reads the product info and one calibration value per axis on
+every open, several USB round trips. With a DeviceInfoCache the values are
+taken from the cache entry of the controller's serial number and checked
+against the hardware in the background after the drive is open (see
+MCLNanoDrive.revalidate_device_info), so a warm open needs only the handle
+and the serial number.
+'''
+from __future__ import division, print_function, absolute_import
+import json
+import os
+import threading
+import time
+
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    'MCL_DEVICE_CACHE', os.path.join(os.path.expanduser('~'), '.mcl_stage', 'device_cache.json'))
+
+
+class DeviceInfoCache(object):
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        '''path: JSON file, None keeps the cache in memory only'''
+        self.path = path
+        self.lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = dict()
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path) as f:
+                        self._entries = json.load(f)
+                except (IOError, ValueError) as err:
+                    print("DeviceInfoCache: ignoring unreadable", self.path, err)
+        return self._entries
+
+    def _save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write and rename, a crash never leaves a truncated file behind
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, serial):
+        '''
+        (prodinfo dict, cal dict axis -> um) cached for a serial number,
+        None if there is no entry
+        '''
+        with self.lock:
+            entry = self._load().get(str(serial))
+        if entry is None:
+            return None
+        return entry['prodinfo'], dict((int(axis), cal) for axis, cal in entry['cal'].items())
+
+    def put(self, serial, prodinfo, cal):
+        with self.lock:
+            self._load()[str(serial)] = dict(prodinfo=dict(prodinfo),
+                                             cal=dict((str(axis), c) for axis, c in cal.items()),
+                                             updated=time.time())
+            self._save()
+
+    def invalidate(self, serial=None):
+        '''drop one entry, or all of them'''
+        with self.lock:
+            entries = self._load()
+            if serial is None:
+                entries.clear()
+            else:
+                entries.pop(str(serial), None)
+            self._save()
@@ -0,0 +1,114 @@
+'''
+Several Nano-Drive controllers in one process.
+
+MCLDevicePool grabs the attached controllers, opens them by serial number
+and owns their handles. Each MCLNanoDrive has its own I/O worker, so calls
+to different controllers run in parallel: a move spanning controllers costs
+the latency of the slowest one instead of the sum.
+'''
+from __future__ import division, print_function, absolute_import
+from ctypes import c_int
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from .mcl_nanodrive import MCLNanoDrive, load_madlib
+
+
+class MCLDevicePool(object):
+
+    MAX_HANDLES = 16
+
+    def __init__(self, backend=None, madlib_path=None, debug=False, info_cache=None):
+        '''info_cache: DeviceInfoCache passed on to the drives, see MCLNanoDrive'''
+        if backend is None:
+            backend = load_madlib(madlib_path)
+        self.madlib = backend
+        self.debug = debug
+        self.info_cache = info_cache
+        self.drives = OrderedDict()  # serial -> MCLNanoDrive
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def grab_all(self):
+        '''
+        Take control of all attached controllers not yet controlled,
+        returns a dict serial -> handle of the controllers this DLL instance controls.
+        '''
+        with self._lock:
+            self.madlib.MCL_GrabAllHandles()
+            handles = (c_int*self.MAX_HANDLES)()
+            n = self.madlib.MCL_GetAllHandles(handles, self.MAX_HANDLES)
+            return OrderedDict((self.madlib.MCL_GetSerialNumber(handles[i]), handles[i])
+                               for i in range(n))
+
+    def serial_numbers(self):
+        return list(self.grab_all().keys())
+
+    def open(self, serial=None):
+        '''
+        MCLNanoDrive for the controller with this serial number, opening it
+        if needed. serial=None returns the first controller.
+        '''
+        if serial is None:
+            if self.drives:
+                return next(iter(self.drives.values()))
+            serial = self.serial_numbers()[0]
+        if serial in self.drives:
+            return self.drives[serial]
+        self.grab_all()
+        with self._lock:
+            handle = self.madlib.MCL_GetHandleBySerial(serial)
+        if not handle:
+            raise IOError("No Nano-Drive with serial number {}".format(serial))
+        drive = self.drives[serial] = MCLNanoDrive(debug=self.debug, backend=self.madlib, handle=handle,
+                                                   info_cache=self.info_cache)
+        return drive
+
+    def open_all(self):
+        return [self.open(serial) for serial in self.serial_numbers()]
+
+    def close(self, serial=None, release=True):
+        '''
+        close one controller, or all of them (and release any other handle
+        grabbed by grab_all) if serial is None.
+        release=False keeps the handles for a fast reopen in this process
+        '''
+        if serial is not None:
+            drive = self.drives.pop(serial, None)
+            if drive is not None:
+                drive.close(release)
+            return
+        while self.drives:
+            self.drives.popitem()[1].close(release)
+        if release:
+            with self._lock:
+                self.madlib.MCL_ReleaseAllHandles()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def set_pos_multi(self, moves):
+        '''
+        moves: dict MCLNanoDrive -> [x, y, z] (None for axes to leave alone)
+        All writes are queued on the controllers' I/O workers before waiting
+        for any of them.
+        '''
+        futures = []
+        for drive, pos in moves.items():
+            for axis, p in enumerate(pos, 1):
+                if p is not None and axis <= drive.num_axes:
+                    futures.append(drive.set_pos_ax_async(p, axis))
+        for future in futures:
+            future.result()
+
+    def run_parallel(self, calls):
+        '''
+        calls: list of (func, args), run concurrently, returns their results
+        '''
+        if len(calls) == 1:
+            func, args = calls[0]
+            return [func(*args)]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=4)
+        futures = [self._executor.submit(func, *args) for func, args in calls]
+        return [f.result() for f in futures]
@@ -0,0 +1,164 @@
+'''
+Single thread that executes all driver calls of one Nano-Drive handle.
+
+Calls are queued by priority (lower value first, FIFO within a priority).
+Calls submitted with the same coalesce_key while an earlier one is still
+queued replace it: only the latest arguments are executed and every caller
+gets that result. This is used to collapse repeated writes of one axis.
+'''
+from __future__ import division, print_function, absolute_import
+import atexit
+import heapq
+import itertools
+import threading
+import weakref
+
+
+PRIORITY_SCAN = 0
+PRIORITY_MOVE = 1
+PRIORITY_POLL = 2
+
+# workers still running at interpreter exit are closed before daemon threads
+# are frozen, so that late calls (eg. from __del__) do not wait forever
+_workers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_workers():
+    for worker in list(_workers):
+        worker.close()
+
+
+class IOFuture(object):
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("MCL I/O call timed out")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, fn):
+        '''call fn(future) once the call has run, on the I/O worker thread'''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as err:
+                print("IOFuture callback failed:", err)
+
+
+class _Call(object):
+    __slots__ = ('func', 'args', 'future', 'key', 'priority', 'alive')
+
+    def __init__(self, func, args, future, key, priority):
+        self.func = func
+        self.args = args
+        self.future = future
+        self.key = key
+        self.priority = priority
+        self.alive = True
+
+
+class MCLIOWorker(object):
+
+    def __init__(self, name='mcl_io'):
+        self._queue = []
+        self._count = itertools.count()
+        self._cv = threading.Condition()
+        self._pending = dict()  # coalesce_key -> queued _Call
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+        _workers.add(self)
+
+    @property
+    def closed(self):
+        return self._closing
+
+    def on_worker_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, func, args=(), priority=PRIORITY_MOVE, coalesce_key=None):
+        '''
+        queue func(*args), returns an IOFuture
+        '''
+        if self.on_worker_thread():
+            # nested call from a queued function, run it right away
+            future = IOFuture()
+            future._set(func(*args))
+            return future
+        with self._cv:
+            if self._closing:
+                raise IOError("MCL I/O worker is closed")
+            if coalesce_key is not None:
+                queued = self._pending.get(coalesce_key)
+                if queued is not None:
+                    queued.alive = False
+                    # keep the better of the two priorities
+                    priority = min(priority, queued.priority)
+                    call = _Call(func, args, queued.future, coalesce_key, priority)
+                    self._pending[coalesce_key] = call
+                    heapq.heappush(self._queue, (priority, next(self._count), call))
+                    self._cv.notify()
+                    return call.future
+            call = _Call(func, args, IOFuture(), coalesce_key, priority)
+            if coalesce_key is not None:
+                self._pending[coalesce_key] = call
+            heapq.heappush(self._queue, (priority, next(self._count), call))
+            self._cv.notify()
+        return call.future
+
+    def call(self, func, args=(), priority=PRIORITY_MOVE, coalesce_key=None):
+        '''
+        queue func(*args) and wait for the result
+        '''
+        return self.submit(func, args, priority, coalesce_key).result()
+
+    def close(self):
+        with self._cv:
+            self._closing = True
+            self._cv.notify()
+        if not self.on_worker_thread():
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._queue and not self._closing:
+                    self._cv.wait()
+                if not self._queue:
+                    return
+                call = heapq.heappop(self._queue)[2]
+                if not call.alive:
+                    continue
+                if call.key is not None:
+                    del self._pending[call.key]
+            try:
+                result = call.func(*call.args)
+            except Exception as err:
+                call.future._set(error=err)
+            else:
+                call.future._set(result)
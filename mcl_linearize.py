@@ -0,0 +1,174 @@
+'''
+Piezo linearization lookup tables.
+
+A LinearizationMap holds, per controller (keyed by serial number), the
+measured response of each axis to its command: measured = f(commanded),
+sampled on a grid, and optionally the cross-axis coupling of each axis,
+an offset g(position of another axis). Positions passed to MCLNanoDrive
+are then treated as wanted positions and turned into the commands
+
+    commanded_a = f_a^-1(p_a - sum_b g_ab(p_b))
+
+with np.interp over whole coordinate arrays, so a scan waveform is corrected
+in one call per axis before it is uploaded.
+
+The tables can come from a sensor sweep (calibrate_sensor_sweep) or be set
+from an external measurement, e.g. a registered image of a calibration grid
+(set_axis / set_coupling with reference='external').
+'''
+from __future__ import division, print_function, absolute_import
+import os
+import time
+import numpy as np
+
+
+class LinearizationMap(object):
+
+    def __init__(self, serial, reference='sensor'):
+        '''
+        serial: device_serial_number of the controller the tables belong to
+        reference: 'sensor' if measured positions are sensor readings, the
+                   sensors then read the corrected positions. 'external' if
+                   they come from elsewhere, the sensors then read commands.
+        '''
+        assert reference in ('sensor', 'external')
+        self.serial = int(serial)
+        self.reference = reference
+        self.axes = dict()     # axis -> (commanded, measured), both increasing
+        self.coupling = dict() # (axis, other axis) -> (other positions, offset on axis)
+
+    def set_axis(self, axis, commanded, measured):
+        '''response of one axis, measured positions at the commanded grid'''
+        commanded = np.asarray(commanded, dtype=float)
+        measured = np.asarray(measured, dtype=float)
+        assert commanded.shape == measured.shape and commanded.ndim == 1
+        order = np.argsort(commanded)
+        commanded, measured = commanded[order], measured[order]
+        # the inverse needs a monotonic response, flatten noise induced dips
+        measured = np.maximum.accumulate(measured)
+        self.axes[axis] = (commanded, measured)
+
+    def set_coupling(self, axis, other, other_pos, offset):
+        '''position offset of axis as a function of the position of other'''
+        other_pos = np.asarray(other_pos, dtype=float)
+        offset = np.asarray(offset, dtype=float)
+        order = np.argsort(other_pos)
+        self.coupling[(axis, other)] = (other_pos[order], offset[order])
+
+    def correct(self, positions):
+        '''
+        positions: dict axis -> wanted positions (scalars or arrays that
+                   broadcast together), axes without tables pass through
+        returns dict axis -> commanded positions
+        '''
+        out = dict()
+        for axis, p in positions.items():
+            p = np.asarray(p, dtype=float)
+            for (a, other), (xp, off) in self.coupling.items():
+                if a == axis and other in positions:
+                    p = p - np.interp(positions[other], xp, off)
+            table = self.axes.get(axis)
+            if table is not None:
+                commanded, measured = table
+                p = np.interp(p, measured, commanded)
+            out[axis] = p
+        return out
+
+    def forward(self, commanded):
+        '''approximate inverse of correct: positions reached for commands'''
+        measured = dict()
+        for axis, c in commanded.items():
+            table = self.axes.get(axis)
+            c = np.asarray(c, dtype=float)
+            measured[axis] = np.interp(c, table[0], table[1]) if table is not None else c
+        out = dict()
+        for axis, p in measured.items():
+            for (a, other), (xp, off) in self.coupling.items():
+                if a == axis and other in measured:
+                    p = p + np.interp(measured[other], xp, off)
+            out[axis] = p
+        return out
+
+    def residual(self):
+        '''dict axis -> max |measured - commanded| of the table (um)'''
+        return dict((axis, float(np.max(np.abs(m - c)))) for axis, (c, m) in self.axes.items())
+
+    @staticmethod
+    def filename(directory, serial):
+        return os.path.join(directory, 'mcl_linearization_{}.npz'.format(int(serial)))
+
+    def save(self, directory):
+        arrays = dict(serial=self.serial, reference=self.reference)
+        for axis, (c, m) in self.axes.items():
+            arrays['axis{}_commanded'.format(axis)] = c
+            arrays['axis{}_measured'.format(axis)] = m
+        for (axis, other), (xp, off) in self.coupling.items():
+            arrays['coupling{}{}_pos'.format(axis, other)] = xp
+            arrays['coupling{}{}_offset'.format(axis, other)] = off
+        fname = self.filename(directory, self.serial)
+        np.savez(fname, **arrays)
+        return fname
+
+    @classmethod
+    def load(cls, directory, serial):
+        '''map saved for a serial number, None if there is none'''
+        fname = cls.filename(directory, serial)
+        if not os.path.exists(fname):
+            return None
+        with np.load(fname) as f:
+            lmap = cls(int(f['serial']), str(f['reference']))
+            for key in f.files:
+                if key.startswith('axis') and key.endswith('_commanded'):
+                    axis = int(key[4])
+                    lmap.axes[axis] = (f[key], f['axis{}_measured'.format(axis)])
+                elif key.startswith('coupling') and key.endswith('_pos'):
+                    axis, other = int(key[8]), int(key[9])
+                    lmap.coupling[(axis, other)] = (f[key], f['coupling{}{}_offset'.format(axis, other)])
+        return lmap
+
+
+def calibrate_sensor_sweep(nd, axes=None, n_points=41, n_avg=20, margin=0.0,
+                           coupling=True, settle_time=0.02):
+    '''
+    Sweep each axis up and down over its range with the other axes held at
+    their centers, and record the sensor readings of all axes.
+    Up and down sweeps are averaged so piezo hysteresis does not bias the
+    table. Returns a LinearizationMap for nd (not yet applied).
+
+    nd: MCLNanoDrive, its current linearization is bypassed during the sweep
+    n_avg: sensor samples averaged per point
+    margin: fraction of the range left out at both ends
+    settle_time: wait after each step before reading, longer than the stage settle time
+    '''
+    if axes is None:
+        axes = sorted(nd.cal)
+    lmap = LinearizationMap(nd.device_serial_number, reference='sensor')
+    previous = nd.linearization
+    nd.set_linearization(None)
+    try:
+        center = dict((axis, 0.5*nd.cal[axis]) for axis in nd.cal)
+        for axis in axes:
+            nd.set_pos_slow(*[center.get(ax) for ax in (1, 2, 3)])
+            lo, hi = margin*nd.cal[axis], (1 - margin)*nd.cal[axis]
+            grid = np.linspace(lo, hi, n_points)
+            readings = np.zeros((2, n_points, 3))
+            for k, sweep in enumerate((grid, grid[::-1])):
+                for i, pos in enumerate(sweep):
+                    nd.set_pos_ax(pos, axis)
+                    # the sensor target is what is being measured, so settle by time
+                    time.sleep(settle_time)
+                    for other in nd.cal:
+                        readings[k, i if k == 0 else n_points - 1 - i, other - 1] = \
+                            np.mean([nd.singleReadN(other) for _ in range(n_avg)])
+            mean = readings.mean(axis=0)
+            lmap.set_axis(axis, grid, mean[:, axis-1])
+            if coupling:
+                for other in nd.cal:
+                    if other != axis:
+                        # offset relative to the reading with both axes centered
+                        ref = np.interp(center[axis], grid, mean[:, other-1])
+                        lmap.set_coupling(other, axis, mean[:, axis-1], mean[:, other-1] - ref)
+        nd.set_pos_slow(*[center.get(ax) for ax in (1, 2, 3)])
+    finally:
+        nd.set_linearization(previous)
+    return lmap
@@ -1,9 +1,18 @@
 from __future__ import division, print_function, absolute_import
 import ctypes
-from ctypes import c_int, c_byte, c_ubyte, c_short, c_double, cdll, pointer, byref
+from ctypes import (c_int, c_uint, c_byte, c_ubyte, c_short, c_ushort, c_double, c_bool,
+                    cdll, pointer, byref, POINTER)
+import os
 import time
 import numpy as np
 import threading
+from .mcl_waveform import (WAVEFORM_MAX_POINTS, check_waveform_limits, period_index_20bit,
+                           LOAD_WAVEFORM_MIN_PERIOD_MS, LOAD_WAVEFORM_MAX_PERIOD_MS,
+                           WFMA_MIN_PERIOD_MS, PERIOD_INDEX_20BIT, WFMA_PERIOD_INDICES_20BIT)
+from .mcl_trajectory import plan_move
+from .mcl_io_worker import MCLIOWorker, IOFuture, PRIORITY_SCAN, PRIORITY_MOVE, PRIORITY_POLL
+from .mcl_settle import SettleModel, SettleStats, SETTLE_MODES
+from .mcl_timing import CallTimer
 
 
 ### IMPORTANT NOTE: DLL's of the same MADLIB version can be different for different
@@ -31,21 +40,15 @@ else:
 """
 
 # tested with 64bit windows
-madlib_path = r"C:\Program Files\Mad City Labs\NanoDrive\madlib.dll"
-
-print("loading DLL:", repr(madlib_path))
+# the DLL is only loaded when the first MCLNanoDrive is created,
+# set MCL_MADLIB_PATH or pass madlib_path to use a different location
+madlib_path = os.environ.get('MCL_MADLIB_PATH',
+                             r"C:\Program Files\Mad City Labs\NanoDrive\madlib.dll")
 
-## Load DLL
-madlib = cdll.LoadLibrary(madlib_path)
+madlib = None
+_madlib_lock = threading.Lock()
+_checked_backends = set() # id() of backends whose DLL version was checked
 
-# set return types of certain function
-madlib.MCL_SingleReadZ.restype = c_double
-madlib.MCL_SingleReadN.restype = c_double
-madlib.MCL_MonitorZ.restype = c_double
-madlib.MCL_MonitorN.restype = c_double
-madlib.MCL_ReadEncoderZ.restype = c_double
-
-madlib.MCL_GetCalibration.restype = c_double
 #more...
 MCL_ERROR_CODES = {
    0: "MCL_SUCCESS",
@@ -59,7 +62,39 @@ MCL_ERROR_CODES = {
     -8: "MCL_INVALID_HANDLE"
 }
 
-SLOW_STEP_PERIOD = 0.050  #units are seconds
+# the controller dropped off the bus or its handle went stale (USB reset,
+# power cycle): MCLNanoDrive.reconnect can get it back
+DEVICE_LOST_CODES = (-2, -3, -8)
+
+
+class MCLDeviceError(IOError):
+    '''driver error return code, code is the MCL_* error number'''
+
+    def __init__(self, message, code):
+        IOError.__init__(self, message)
+        self.code = code
+
+    @property
+    def device_lost(self):
+        return self.code in DEVICE_LOST_CODES
+
+
+SLOW_STEP_PERIOD = 0.050  #units are seconds, longest step of a streamed slow move
+STREAM_MIN_PERIOD = 0.005 # shortest step of a streamed slow move
+SLOW_MAX_STEP = 0.1       # microns, step size the step rate of slow moves aims for
+
+# FirmwareProfile bits required by optional features
+PROFILE_WAVEFORM = 0x0010
+PROFILE_WFMA     = 0x0040
+PROFILE_ISS      = 0x0001
+
+# Image Scan Sync (ISS) TTL clocks and the events they can be bound to
+ISS_CLOCKS = dict(pixel=1, line=2, frame=3, aux=4)
+ISS_EVENTS = dict(X=1, Y=2, Z=3, aux=4, waveform_read=5, waveform_write=6)
+ISS_POLARITY = dict(rising=2, falling=3)
+ISS_UNBIND = 4
+
+c_double_p = POINTER(c_double)
 
 class MCLProductInformation(ctypes.Structure):
     _fields_ = [
@@ -78,74 +113,387 @@ class MCLProductInformation(ctypes.Structure):
         for fieldname, fieldtype in self._fields_:
             fieldval = self.__getattribute__(fieldname)
             print("\t", fieldname, "\t\t", fieldval, "\t\t", bin(fieldval))
-        
-        
+
+
+c_int_p = POINTER(c_int)
+c_short_p = POINTER(c_short)
+
+# (restype, argtypes) of the MadLib functions, from Madlib.h
+MADLIB_PROTOTYPES = {
+    'MCL_DLLVersion':               (None,     [c_short_p, c_short_p]),
+    'MCL_CorrectDriverVersion':     (c_bool,   []),
+
+    'MCL_InitHandle':               (c_int,    []),
+    'MCL_GrabHandle':               (c_int,    [c_short]),
+    'MCL_InitHandleOrGetExisting':  (c_int,    []),
+    'MCL_GrabHandleOrGetExisting':  (c_int,    [c_short]),
+    'MCL_GetHandleBySerial':        (c_int,    [c_short]),
+    'MCL_GrabAllHandles':           (c_int,    []),
+    'MCL_GetAllHandles':            (c_int,    [c_int_p, c_int]),
+    'MCL_NumberOfCurrentHandles':   (c_int,    []),
+    'MCL_ReleaseHandle':            (None,     [c_int]),
+    'MCL_ReleaseAllHandles':        (None,     []),
+
+    'MCL_SingleReadZ':              (c_double, [c_int]),
+    'MCL_SingleReadN':              (c_double, [c_uint, c_int]),
+    'MCL_SingleWriteZ':             (c_int,    [c_double, c_int]),
+    'MCL_SingleWriteN':             (c_int,    [c_double, c_uint, c_int]),
+    'MCL_MonitorZ':                 (c_double, [c_double, c_int]),
+    'MCL_MonitorN':                 (c_double, [c_double, c_uint, c_int]),
+    'MCL_ReadEncoderZ':             (c_double, [c_int]),
+
+    'MCL_ReadWaveFormN':            (c_int,    [c_uint, c_uint, c_double, c_double_p, c_int]),
+    'MCL_Setup_ReadWaveFormN':      (c_int,    [c_uint, c_uint, c_double, c_int]),
+    'MCL_Trigger_ReadWaveFormN':    (c_int,    [c_uint, c_uint, c_double_p, c_int]),
+    'MCL_LoadWaveFormN':            (c_int,    [c_uint, c_uint, c_double, c_double_p, c_int]),
+    'MCL_Setup_LoadWaveFormN':      (c_int,    [c_uint, c_uint, c_double, c_double_p, c_int]),
+    'MCL_Trigger_LoadWaveFormN':    (c_int,    [c_uint, c_int]),
+    'MCL_TriggerWaveformAcquisition': (c_int,  [c_uint, c_uint, c_double_p, c_int]),
+
+    'MCL_WfmaSetup':                (c_int,    [c_double_p, c_double_p, c_double_p, c_int, c_double,
+                                                c_ushort, c_int]),
+    'MCL_WfmaTriggerAndRead':       (c_int,    [c_double_p, c_double_p, c_double_p, c_int]),
+    'MCL_WfmaTrigger':              (c_int,    [c_int]),
+    'MCL_WfmaRead':                 (c_int,    [c_double_p, c_double_p, c_double_p, c_int]),
+    'MCL_WfmaStop':                 (c_int,    [c_int]),
+
+    'MCL_IssBindClockToAxis':       (c_int,    [c_int, c_int, c_int, c_int]),
+    'MCL_IssConfigurePolarity':     (c_int,    [c_int, c_int, c_int]),
+    'MCL_IssSetClock':              (c_int,    [c_int, c_int, c_int]),
+    'MCL_IssResetDefaults':         (c_int,    [c_int]),
+    'MCL_PixelClock':               (c_int,    [c_int]),
+    'MCL_LineClock':                (c_int,    [c_int]),
+    'MCL_FrameClock':               (c_int,    [c_int]),
+    'MCL_AuxClock':                 (c_int,    [c_int]),
+
+    'MCL_GetCalibration':           (c_double, [c_uint, c_int]),
+    'MCL_GetFirmwareVersion':       (c_int,    [c_short_p, c_short_p, c_int]),
+    'MCL_GetSerialNumber':          (c_int,    [c_int]),
+    'MCL_GetProductInfo':           (c_int,    [POINTER(MCLProductInformation), c_int]),
+    'MCL_PrintDeviceInfo':          (None,     [c_int]),
+    'MCL_DeviceAttached':           (c_bool,   [c_int, c_int]),
+    'MCL_GetCommandedPosition':     (c_int,    [c_double_p, c_double_p, c_double_p, c_int]),
+}
+
+
+def load_madlib(path=None):
+    '''
+    Load the MadLib DLL (once per process) and set the prototypes of all
+    functions in MADLIB_PROTOTYPES. Returns the library.
+    '''
+    global madlib
+    with _madlib_lock:
+        if madlib is None:
+            lib = cdll.LoadLibrary(path or madlib_path)
+            for name, (restype, argtypes) in MADLIB_PROTOTYPES.items():
+                func = getattr(lib, name, None)
+                if func is None:
+                    # not exported by older DLL versions
+                    continue
+                func.restype = restype
+                func.argtypes = argtypes
+            madlib = lib
+    return madlib
+
+
+
+class SlowMove(object):
+    '''
+    Handle of a slow move started with MCLNanoDrive.move_slow
+    '''
+
+    def __init__(self, targets, cv):
+        self.targets = targets
+        self.cancelled = False
+        self.superseded = False
+        self.error = None
+        self._cv = cv
+        self._done = threading.Event()
+        self._callbacks = []
+
+    def cancel(self):
+        with self._cv:
+            self.cancelled = True
+            self._cv.notify_all()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the move to end. Returns True if the targets were reached,
+        False if it was cancelled, superseded or timed out.
+        Errors from the driver are re-raised here.
+        '''
+        if not self._done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return not (self.cancelled or self.superseded)
+
+    def add_done_callback(self, func):
+        '''
+        func(move) is called on the motion thread when the move ends, right
+        away if it already has
+        '''
+        with self._cv:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _finish(self):
+        with self._cv:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
 
 class MCLNanoDrive(object):
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, backend=None, madlib_path=None, io_worker=True, handle=None,
+                 info_cache=None, reuse_handle=False, attach_timeout_ms=2000):
+        '''
+        backend: object providing the MadLib MCL_* functions, defaults to the
+                 madlib DLL. Use mcl_sim.SimMadlib() to run without hardware.
+        madlib_path: DLL location if it is not loaded yet
+        io_worker: run all driver calls on one MCLIOWorker thread, otherwise
+                   calls are serialized with self.lock on the calling thread
+        handle: use an already acquired device handle (see MCLDevicePool)
+                instead of MCL_InitHandle
+        info_cache: mcl_device_cache.DeviceInfoCache, product info and
+                calibration are taken from it and revalidated in the background
+        reuse_handle: MCL_InitHandleOrGetExisting, picks up a handle this
+                process still holds (see close(release=False))
+        attach_timeout_ms: how long to wait for a controller that does not
+                answer yet, polled in short MCL_DeviceAttached steps
+        '''
+        
+        self._closed = False
+        if backend is None:
+            backend = load_madlib(madlib_path)
+        self.madlib = backend
+        
+        # bind the hot path functions once
+        self._SingleWriteN = backend.MCL_SingleWriteN
+        self._SingleReadN = backend.MCL_SingleReadN
+        self._MonitorN = backend.MCL_MonitorN
         
         self.lock = threading.Lock()
+        self.call_timer = None # CallTimer when driver call timing is on
+        self._io_local = threading.local()
+        self._io = MCLIOWorker() if io_worker else None
+        
+        # slow moves run on a background thread, see move_slow
+        self._motion_cv = threading.Condition()
+        self._motion_thread = None
+        self._motion_closing = False
+        self._current_move = None
+        self._pending_move = None
         
         self.debug = debug
         
         self.MCL_ERROR_CODES = MCL_ERROR_CODES
         
-        ver = c_short()
-        rev = c_short()
-        madlib.MCL_DLLVersion(byref(ver), byref(rev))
-        if self.debug:
-            print("MCL_DLLVersion", ver.value, rev.value)
-            print("madlib.MCL_CorrectDriverVersion():", madlib.MCL_CorrectDriverVersion())
-        if not madlib.MCL_CorrectDriverVersion():
-            print("MCL_CorrectDriverVersion is False")
+        # the DLL version only needs checking once per process
+        if id(backend) not in _checked_backends:
+            ver = c_short()
+            rev = c_short()
+            self._io_call(self.madlib.MCL_DLLVersion, byref(ver), byref(rev))
+            if self.debug:
+                print("MCL_DLLVersion", ver.value, rev.value)
+            if not self._io_call(self.madlib.MCL_CorrectDriverVersion):
+                print("MCL_CorrectDriverVersion is False")
+            _checked_backends.add(id(backend))
         
-        handle = self._handle = madlib.MCL_InitHandle()
+        if handle is None:
+            init = self.madlib.MCL_InitHandleOrGetExisting if reuse_handle else self.madlib.MCL_InitHandle
+            handle = self._io_call(init)
+        if not handle:
+            print("MCLNanoDrive failed to grab device handle ", hex(handle))
+        self._handle = handle
         assert handle > 0
-
-        dev_attached = madlib.MCL_DeviceAttached(2000, handle)
-        print("dev_attached", dev_attached)
-
         if self.debug: print("handle:", hex(handle))
 
-        if not handle:
-            print("MCLNanoDrive failed to grab device handle ", hex(handle))
+        self.device_serial_number = self._io_call(self.madlib.MCL_GetSerialNumber, handle)
+        if self.device_serial_number < 0:
+            # not answering yet (just plugged in / powered up)
+            self.wait_attached(attach_timeout_ms)
+            self.device_serial_number = self._io_call(self.madlib.MCL_GetSerialNumber, handle)
+        if self.device_serial_number < 0:
+            raise IOError("Nano-Drive not attached: {}".format(
+                self.MCL_ERROR_CODES.get(self.device_serial_number, self.device_serial_number)))
+        if self.debug: print("MCL_GetSerialNumber", self.device_serial_number)
+        
+        self.info_cache = info_cache
+        self.info_revalidation = None # IOFuture of the background check of cached info
+        self.device_info_changes = 0 # counts stale cached info replaced by revalidation
+        cached = info_cache.get(self.device_serial_number) if info_cache is not None else None
+        if cached is None:
+            prodinfo, cal = self._read_device_info()
+            if info_cache is not None:
+                info_cache.put(self.device_serial_number, self._prodinfo_dict(prodinfo), cal)
+        else:
+            prodinfo = MCLProductInformation(**cached[0])
+            cal = cached[1]
+        self._apply_device_info(prodinfo, cal)
+        
+        self._load_waveforms = dict()
+        self._wfma_waveforms = [None, None, None]
+        self._wfma_points = 0
+        # waveform setups stay on the controller and can be triggered again:
+        # a setup identical to the one loaded is skipped (see invalidate_waveforms)
+        self.skip_redundant_uploads = True
+        self.upload_count = 0
+        self.skipped_upload_count = 0
+        self._load_setup = dict() # axis -> period_ms of _load_waveforms[axis]
+        self._wfma_setup = None   # (period, iterations) of _wfma_waveforms
+        self._read_setup = dict()
+        self._buffer_pool = dict()
 
-        self.prodinfo = MCLProductInformation()
-        madlib.MCL_GetProductInfo(byref(self.prodinfo), handle)
+        self.set_max_speed(100)  # default speed for slow movement is 100 microns/second
+        self.set_max_accel(1000) # microns/second^2
+        self.max_jerk = None
+        self.axis_limits = dict() # axis -> (max_speed, max_accel), overrides the above
         
-        if self.debug: self.prodinfo.print_info()
+        # position cache: last commanded position per axis and last sensor
+        # sample per axis as (monotonic time, position)
+        self.skip_redundant_writes = True
+        self.read_max_age = 0.0
+        self.write_count = 0
+        self.skipped_write_count = 0
+        self._cmd_pos = dict()
+        self._raw_pos = dict() # command actually written, differs with a linearization
+        self.reconnect_count = 0
+        self._last_read = dict()
+        self.linearization = None # LinearizationMap, see set_linearization
+        self.resync_commanded_position()
+        #self.get_pos()
         
-        self.device_serial_number = madlib.MCL_GetSerialNumber(handle)
-        if self.debug: print("MCL_GetSerialNumber", self.device_serial_number)
+        # settling after writes, see settle()
+        self.settle_mode = 'off'
+        self.settle_tolerance = 0.02 # microns
+        self.settle_timeout = 0.1 # seconds
+        self.settle_verify_every = 50 # in 'model' mode, poll every n-th settle to keep learning
+        self.settle_models = dict((axis, SettleModel()) for axis in self.cal)
+        self.settle_stats = SettleStats()
+        self._settle_pending = dict() # axis -> (write time, step size)
+        # written on the I/O worker (or the motion thread), taken by settle()
+        # on the caller's thread; not self.lock, _io_call may hold that
+        self._settle_lock = threading.Lock()
         
+        if cached is not None:
+            # behind any calls queued by then, at polling priority
+            priority = getattr(self._io_local, 'priority', PRIORITY_MOVE)
+            self.set_io_priority(PRIORITY_POLL)
+            self.info_revalidation = self._io_submit(self.revalidate_device_info)
+            self.set_io_priority(priority)
+
+    def wait_attached(self, timeout_ms):
+        '''poll MCL_DeviceAttached in 50 ms steps, True once attached'''
+        t_end = time.monotonic() + timeout_ms*1e-3
+        while True:
+            if self._io_call(self.madlib.MCL_DeviceAttached, 50, self._handle):
+                return True
+            if time.monotonic() > t_end:
+                return False
+
+    @staticmethod
+    def _prodinfo_dict(prodinfo):
+        return dict((name, getattr(prodinfo, name)) for name, _ in prodinfo._fields_)
+
+    def _read_device_info(self):
+        '''(MCLProductInformation, dict axis -> calibration um) from the controller'''
+        prodinfo = MCLProductInformation()
+        self._io_call(self.madlib.MCL_GetProductInfo, byref(prodinfo), self._handle)
+        cal = dict()
+        for axnum, axbitmap in [(1, 0b001), (2, 0b010), (3, 0b100)]:
+            if prodinfo.axis_bitmap & axbitmap:
+                cal[axnum] = self._io_call(self.madlib.MCL_GetCalibration, axnum, self._handle)
+        return prodinfo, cal
+
+    def _apply_device_info(self, prodinfo, cal):
+        self.prodinfo = prodinfo
+        if self.debug: self.prodinfo.print_info()
         self.cal_X = None
         self.cal_Y = None
         self.cal_Z = None
-        
         self.num_axes = 0
-    
         self.cal = dict()
-        for axname, axnum, axbitmap in [('X', 1, 0b001), ('Y', 2, 0b010), ('Z', 3, 0b100)]:
-            axvalid = bool(self.prodinfo.axis_bitmap & axbitmap)
-            if debug: print(axname, axnum, "axbitmap:", bin(axbitmap), "axvalid", axvalid)
-            
-            if not axvalid:
-                if debug: print("No %s axis, skipping" % axname)
+        for axname, axnum in [('X', 1), ('Y', 2), ('Z', 3)]:
+            if axnum not in cal:
+                if self.debug: print("No %s axis, skipping" % axname)
                 continue
-            
             self.num_axes += 1
-            
-            cal = madlib.MCL_GetCalibration(axnum, handle)
+            setattr(self, 'cal_%s' % axname, cal[axnum])
+            self.cal[axnum] = cal[axnum]
+            if self.debug: print("cal_%s: %g" % (axname, cal[axnum]))
 
-            setattr(self, 'cal_%s' % axname, cal)
-            self.cal[axnum] = cal
-            if debug: print("cal_%s: %g" % (axname, cal))
-        
-        self.set_max_speed(100)  # default speed for slow movement is 100 microns/second
-        #self.get_pos()
-        
-        self.lock 
+    def revalidate_device_info(self):
+        '''
+        read product info and calibration from the controller and update
+        the cache if they changed, returns True if the cached values were right
+        '''
+        prodinfo, cal = self._read_device_info()
+        # uploads made before were checked against the old info
+        self.invalidate_waveforms()
+        if self._prodinfo_dict(prodinfo) == self._prodinfo_dict(self.prodinfo) and cal == self.cal:
+            return True
+        print("MCLNanoDrive {}: cached device info was stale, updated".format(self.device_serial_number))
+        self._apply_device_info(prodinfo, cal)
+        # learned for the old calibration
+        self.settle_models = dict((axis, SettleModel()) for axis in self.cal)
+        self.device_info_changes += 1
+        if self.info_cache is not None:
+            self.info_cache.put(self.device_serial_number, self._prodinfo_dict(prodinfo), cal)
+        return False
+
+    def _io_call(self, func, *args, **kwargs):
+        '''
+        Execute a driver call on the I/O worker at the calling thread's
+        priority (see set_io_priority), calls with the same coalesce_key
+        that are still queued are merged.
+        '''
+        if self.call_timer is not None:
+            func = self.call_timer.wrap(func)
+        if self._io is None or self._io.closed:
+            with self.lock:
+                return func(*args)
+        return self._io.call(func, args, getattr(self._io_local, 'priority', PRIORITY_MOVE),
+                             kwargs.get('coalesce_key'))
+
+    def _io_submit(self, func, *args, **kwargs):
+        '''
+        like _io_call, but returns an IOFuture without waiting
+        '''
+        if self.call_timer is not None:
+            func = self.call_timer.wrap(func)
+        if self._io is None or self._io.closed:
+            future = IOFuture()
+            with self.lock:
+                future._set(func(*args))
+            return future
+        return self._io.submit(func, args, getattr(self._io_local, 'priority', PRIORITY_MOVE),
+                               kwargs.get('coalesce_key'))
+
+    def enable_call_timing(self, enable=True):
+        '''
+        time every driver call (count, total and max per function) in
+        call_timer, a few microseconds per call
+        '''
+        if not enable:
+            self.call_timer = None
+        elif self.call_timer is None:
+            self.call_timer = CallTimer()
+        return self.call_timer
+
+    def set_io_priority(self, priority):
+        '''
+        Priority of driver calls made from the current thread:
+        PRIORITY_SCAN, PRIORITY_MOVE (default) or PRIORITY_POLL
+        '''
+        self._io_local.priority = priority
 
     def set_max_speed(self, max_speed):
         '''
@@ -156,62 +504,280 @@ class MCLNanoDrive(object):
     def get_max_speed(self):
         return self.max_speed
     
+    def set_max_accel(self, max_accel):
+        '''
+        Units are in microns/second^2
+        '''
+        self.max_accel = float(max_accel)
+    
+    def get_max_accel(self):
+        return self.max_accel
+    
+    def set_axis_limits(self, axis, max_speed=None, max_accel=None):
+        '''
+        per axis speed/acceleration limits for slow moves, None to use
+        max_speed / max_accel
+        '''
+        if max_speed is None and max_accel is None:
+            self.axis_limits.pop(axis, None)
+        else:
+            self.axis_limits[axis] = (max_speed, max_accel)
+    
+    def plan_slow_move(self, axes, start, end, **kwargs):
+        '''
+        Trajectory from start to end (arrays over `axes`) within the speed
+        and acceleration limits, see mcl_trajectory.plan_move
+        '''
+        v = [self.axis_limits.get(ax, (None, None))[0] or self.max_speed for ax in axes]
+        a = [self.axis_limits.get(ax, (None, None))[1] or self.max_accel for ax in axes]
+        return plan_move(start, end, v, a, max_jerk=self.max_jerk, **kwargs)
+    
     def set_pos_slow(self, x=None, y=None, z=None):
         '''
         x -> axis 1
         y -> axis 2
         z -> axis 3
-        '''
-        
-        x_start, y_start, z_start = self.get_pos()
-        
-        if x is not None:
-            dx = x - x_start
-        else:
-            dx = 0
-        if y is not None:            
-            dy = y - y_start
-        else:
-            dy = 0
-        if z is not None:
-            dz = z-z_start
-        else:
-            dz = 0
-        
-        # Compute the amount of time that will be needed to make the movement.
-        dt = np.sqrt(dx**2 + dy**2 + dz**2)/self.max_speed
-            
-        # Assume dt is in ms; divide the movement into SLOW_STEP_PERIOD chunks
-        steps = int( np.ceil(dt/SLOW_STEP_PERIOD))
-        x_step = dx/steps
-        y_step = dy/steps
-        z_step = dz/steps
         
-
-        
-        for i in range(1,steps+1):
-            t1 = time.time()
-            if z is not None:
-                self.set_pos(x_start+i*x_step, y_start+i*y_step, z_start+i*z_step)
-            else:
-                self.set_pos(x_start+i*x_step, y_start+i*y_step, None)
-            t2 = time.time()
-            
-            if (t2-t1) < SLOW_STEP_PERIOD:
-                time.sleep(SLOW_STEP_PERIOD - (t2-t1))
+        blocks until the move is complete, see move_slow
+        '''
+        self.move_slow(x, y, z).wait()
+        self.settle()
         
         # Update internal variables with current position
         self.get_pos()
+
+    def move_slow(self, x=None, y=None, z=None):
+        '''
+        Start a move at max_speed on the background motion thread and
+        return a SlowMove handle immediately.
+        A move already in progress is superseded: it stops at its current
+        step and the new move continues from there, keeping the targets of
+        axes not given here.
+        '''
+        targets = dict()
+        for axis, pos in ((1, x), (2, y), (3, z)):
+            if pos is not None and axis <= self.num_axes:
+                targets[axis] = pos
+        return self._submit_slow_move(targets)
+
+    def move_slow_ax(self, pos, axis):
+        assert 1 <= axis <= self.num_axes
+        return self._submit_slow_move({axis: pos})
+
+    def stop_motion(self):
+        '''
+        cancel the running and pending slow moves
+        '''
+        with self._motion_cv:
+            for move in (self._current_move, self._pending_move):
+                if move is not None:
+                    move.cancelled = True
+            self._motion_cv.notify_all()
+
+    def _submit_slow_move(self, targets):
+        with self._motion_cv:
+            prev = self._pending_move or self._current_move
+            if prev is not None and not prev.done():
+                merged = dict(prev.targets)
+                merged.update(targets)
+                targets = merged
+                for move in (self._current_move, self._pending_move):
+                    if move is not None:
+                        move.superseded = True
+            # a pending move that never started ends here
+            dropped = self._pending_move
+            move = self._pending_move = SlowMove(targets, self._motion_cv)
+            if self._motion_thread is None:
+                self._motion_thread = threading.Thread(target=self._motion_loop, name='mcl_motion')
+                self._motion_thread.daemon = True
+                self._motion_thread.start()
+            self._motion_cv.notify_all()
+        if dropped is not None:
+            dropped._finish()
+        return move
+
+    def _motion_loop(self):
+        while True:
+            with self._motion_cv:
+                while self._pending_move is None and not self._motion_closing:
+                    self._motion_cv.wait()
+                if self._motion_closing:
+                    return
+                move = self._current_move = self._pending_move
+                self._pending_move = None
+            try:
+                self._run_slow_move(move)
+            except Exception as err:
+                move.error = err
+            finally:
+                with self._motion_cv:
+                    self._current_move = None
+                move._finish()
+
+    def _slow_move_endpoints(self, targets):
+        axes = sorted(targets)
+        end = np.array([np.clip(targets[ax], 0, self.cal[ax]) for ax in axes])
+        start = np.array([self.get_pos_ax(ax) for ax in axes])
+        return axes, start, end
+
+    def _run_slow_move(self, move):
+        axes, start, end = self._slow_move_endpoints(move.targets)
+        traj = self.plan_slow_move(axes, start, end, max_step=SLOW_MAX_STEP,
+                                   min_dt=STREAM_MIN_PERIOD, max_dt=SLOW_STEP_PERIOD)
         
+        # steps are scheduled against absolute deadlines so that time spent
+        # in the driver calls does not accumulate
+        t0 = time.monotonic()
+        for i in range(len(traj)):
+            if i > 0:
+                deadline = t0 + traj.t[i-1]
+                with self._motion_cv:
+                    while not (move.cancelled or move.superseded):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._motion_cv.wait(remaining)
+            if move.cancelled or move.superseded:
+                return
+            for ax, p in zip(axes, traj.positions[i]):
+                self.set_pos_ax(p, ax)
+
+    def motion_active(self):
+        '''True while a slow move is running or queued'''
+        return self._current_move is not None or self._pending_move is not None
+
+    def wait_motion_idle(self, timeout=None):
+        with self._motion_cv:
+            moves = [m for m in (self._current_move, self._pending_move) if m is not None]
+        for move in moves:
+            move._done.wait(timeout)
+
+    def set_pos_waveform(self, x=None, y=None, z=None):
+        '''
+        Planned move uploaded to the controller as a single waveform (blocking).
+        Falls back to a streamed slow move when the firmware has no
+        waveform support or the move does not fit into one waveform.
+        '''
+        targets = dict((axis, pos) for axis, pos in ((1, x), (2, y), (3, z))
+                       if pos is not None and axis <= self.num_axes)
+        if not targets:
+            return
+        self.stop_motion()
+        self.wait_motion_idle()
+        axes, start, end = self._slow_move_endpoints(targets)
+        max_points = self.waveform_max_points()//len(axes)
         
+        plans = []
+        if len(axes) == 1 and self.has_profile(PROFILE_WAVEFORM):
+            plans.append((dict(min_dt=LOAD_WAVEFORM_MIN_PERIOD_MS[self.dac_bits]*1e-3,
+                               max_dt=LOAD_WAVEFORM_MAX_PERIOD_MS*1e-3), None))
+        elif len(axes) > 1 and self.has_profile(PROFILE_WFMA):
+            if self.dac_bits == 20:
+                for index in WFMA_PERIOD_INDICES_20BIT:
+                    plans.append((dict(dt=PERIOD_INDEX_20BIT[index]*1e-3), index))
+            else:
+                plans.append((dict(min_dt=WFMA_MIN_PERIOD_MS*1e-3,
+                                   max_dt=LOAD_WAVEFORM_MAX_PERIOD_MS*1e-3), None))
+        for kwargs, period_index in plans:
+            traj = self.plan_slow_move(axes, start, end, max_step=SLOW_MAX_STEP,
+                                       max_points=max_points, **kwargs)
+            if len(traj) > max_points:
+                continue
+            if len(axes) == 1:
+                self.load_waveform_ax(traj.positions[:, 0], axes[0], traj.dt*1e3)
+            else:
+                period = traj.dt*1e3 if period_index is None else period_index
+                self.wfma_setup(dict((ax, traj.positions[:, k]) for k, ax in enumerate(axes)),
+                                period, iterations=1)
+                self.wfma_trigger_and_read()
+            return
         
-        
+        self._submit_slow_move(targets).wait()
+
     def __del__(self):
-        self.close()
-        
-    def close(self):
-        madlib.MCL_ReleaseHandle(self._handle)
+        if hasattr(self, '_io'):
+            self.close()
         
+    def close(self, release=True):
+        '''
+        release=False keeps the device handle in this process, a later
+        MCLNanoDrive(reuse_handle=True) picks it up without re-enumerating
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        if self._motion_thread is not None:
+            self.stop_motion()
+            with self._motion_cv:
+                self._motion_closing = True
+                self._motion_cv.notify_all()
+            self._motion_thread.join()
+            self._motion_thread = None
+            if self._pending_move is not None:
+                self._pending_move._finish()
+                self._pending_move = None
+        if release:
+            self._io_call(self.madlib.MCL_ReleaseHandle, self._handle)
+        if self._io is not None:
+            self._io.close()
+
+    def is_attached(self):
+        '''True if the handle still answers with this controller's serial number'''
+        return self._io_call(self.madlib.MCL_GetSerialNumber, self._handle) == self.device_serial_number
+
+    def _acquire_by_serial(self):
+        # handle of this controller, 0 if it is not on the bus (yet)
+        handle = self._io_call(self.madlib.MCL_GetHandleBySerial, self.device_serial_number)
+        if handle > 0:
+            return handle
+        # MCL_InitHandle hands out the first free controller, hold on to the
+        # others until this one turns up so the next call gets a new one
+        others = []
+        try:
+            while True:
+                handle = self._io_call(self.madlib.MCL_InitHandle)
+                if handle <= 0:
+                    return 0
+                if self._io_call(self.madlib.MCL_GetSerialNumber, handle) == self.device_serial_number:
+                    return handle
+                others.append(handle)
+        finally:
+            for h in others:
+                self._io_call(self.madlib.MCL_ReleaseHandle, h)
+
+    def reconnect(self, timeout=60.0, backoff=0.1, max_backoff=5.0):
+        '''
+        Get a new handle for this controller after it dropped off the bus
+        (MCLDeviceError.device_lost), retrying with exponential backoff
+        for up to timeout seconds, then move back to the last commanded
+        position. Raises MCLDeviceError if the controller does not return.
+        '''
+        target = dict(self._cmd_pos)
+        self.stop_motion()
+        self._io_call(self.madlib.MCL_ReleaseHandle, self._handle)
+        t_end = time.monotonic() + timeout
+        delay = backoff
+        while True:
+            handle = self._acquire_by_serial()
+            if handle > 0:
+                break
+            if time.monotonic() + delay > t_end:
+                raise MCLDeviceError("Nano-Drive {} did not come back within {} s".format(
+                    self.device_serial_number, timeout), -3)
+            time.sleep(delay)
+            delay = min(2*delay, max_backoff)
+        self._handle = handle
+        self.reconnect_count += 1
+        self.invalidate_waveforms()
+        print("MCLNanoDrive {}: reconnected".format(self.device_serial_number))
+        # the controller may have been power cycled: start from what it
+        # holds now and go back slowly
+        self.resync_commanded_position()
+        with self._settle_lock:
+            self._settle_pending.clear()
+        if any(abs(self._cmd_pos[axis] - pos) > self.settle_tolerance for axis, pos in target.items()):
+            self.move_slow(*[target.get(axis) for axis in (1, 2, 3)]).wait()
+
     def move_rel(self, dx, dy, dz=0):
         pass
         #TODO
@@ -227,45 +793,264 @@ class MCLNanoDrive(object):
             assert 0 <= z <= self.cal_Z
             self.set_pos_ax(z, 3)
         
-        #madlib.MCL_DeviceAttached(200, self._handle)
-        # MCL_DeviceAttached can be used as a simple wait function. In this case
-        # it is being used to allow the nanopositioner to finish its motion before 
-        # reading its position. (standard 200)
-        #madlib.MCL_DeviceAttached(100, self._handle)
+        # wait for the stage to reach the new position (settle_mode), this
+        # replaces a fixed MCL_DeviceAttached(200) delay
+        self.settle()
         
     def set_pos_ax(self, pos, axis):
         if self.debug: print("set_pos_ax ", pos, axis)
         assert 1 <= axis <= self.num_axes
         assert 0 <= pos <= self.cal[axis]
-        self.handle_err(madlib.MCL_SingleWriteN(c_double(pos), axis, self._handle))
+        # queued writes to the same axis collapse to the latest position
+        self._io_call(self._write_ax, pos, axis, coalesce_key=('write', axis))
         
+    def set_pos_ax_async(self, pos, axis):
+        '''
+        queue a write of one axis and return an IOFuture, so that writes
+        to several controllers can be in flight at the same time
+        '''
+        assert 1 <= axis <= self.num_axes
+        assert 0 <= pos <= self.cal[axis]
+        return self._io_submit(self._write_ax, pos, axis, coalesce_key=('write', axis))
+
+    def write_axes(self, axes, positions, raw=None):
+        '''
+        write positions to axes and settle, without range checks: for
+        positions validated in bulk beforehand (see mcl_transform).
+        raw: the commands for positions, corrected beforehand (see
+        linearize), skips the per-call linearization
+        '''
+        if raw is None:
+            raw = [None]*len(axes)
+        for axis, pos, r in zip(axes, positions, raw):
+            self._io_call(self._write_ax, float(pos), axis, r, coalesce_key=('write', axis))
+        self.settle()
+
+    def write_axes_async(self, axes, positions, raw=None):
+        '''queue unchecked writes like write_axes, returns their IOFutures'''
+        if raw is None:
+            raw = [None]*len(axes)
+        return [self._io_submit(self._write_ax, float(pos), axis, r, coalesce_key=('write', axis))
+                for axis, pos, r in zip(axes, positions, raw)]
+
+    def _write_ax(self, pos, axis, raw=None):
+        # runs on the I/O worker, so the cache matches what was written
+        if self.skip_redundant_writes and self._cmd_pos.get(axis) == pos:
+            self.skipped_write_count += 1
+            return
+        if raw is None:
+            raw = pos if self.linearization is None else float(self.linearize({axis: pos})[axis])
+        else:
+            raw = float(raw)
+        self.handle_err(self._SingleWriteN(raw, axis, self._handle))
+        self.write_count += 1
+        prev = self._cmd_pos.get(axis, pos)
+        self._cmd_pos[axis] = pos
+        self._raw_pos[axis] = raw
+        self._last_read.pop(axis, None)
+        with self._settle_lock:
+            self._settle_pending[axis] = (time.monotonic(), abs(pos - prev))
+        
+    def get_commanded_pos_ax(self, axis):
+        '''
+        last commanded position of an axis, from the cache (no USB traffic)
+        '''
+        if axis not in self._cmd_pos:
+            self.resync_commanded_position()
+        return self._cmd_pos[axis]
+    
+    def resync_commanded_position(self):
+        '''
+        reseed the commanded position cache from the controller, needed if
+        something else (front panel, another program) moved the stage
+        '''
+        pos = self.getCommandedPosition()
+        self._raw_pos = dict((axis, pos[axis-1]) for axis in self.cal)
+        if self.linearization is None:
+            self._cmd_pos = dict(self._raw_pos)
+        else:
+            self._cmd_pos = dict((axis, float(p))
+                                 for axis, p in self.linearization.forward(self._raw_pos).items())
+        self._last_read.clear()
+    
+    def invalidate_position_cache(self, axis=None):
+        if axis is None:
+            self._cmd_pos.clear()
+            self._raw_pos.clear()
+            self._last_read.clear()
+        else:
+            self._cmd_pos.pop(axis, None)
+            self._raw_pos.pop(axis, None)
+            self._last_read.pop(axis, None)
+
+    def set_linearization(self, lmap):
+        '''
+        Correct all following writes and waveform uploads with a
+        mcl_linearize.LinearizationMap (None: write positions unchanged).
+        Positions passed in and the commanded position cache stay in
+        corrected coordinates.
+        '''
+        if lmap is not None and lmap.serial != self.device_serial_number:
+            raise ValueError("linearization is for serial {}, device is {}".format(
+                lmap.serial, self.device_serial_number))
+        self.linearization = lmap
+        self.resync_commanded_position()
+
+    def linearize(self, positions):
+        '''
+        commands for wanted positions, dict axis -> scalar or array. Axes
+        not given are taken at their commanded positions for the cross-axis
+        terms. Scans correct their whole grid or waveforms in one call and
+        pass the result as raw to write_axes or the waveform setups.
+        '''
+        lmap = self.linearization
+        if lmap is None:
+            return positions
+        wanted = dict(self._cmd_pos)
+        wanted.update(positions)
+        raw = lmap.correct(wanted)
+        return dict((axis, np.clip(raw[axis], 0, self.cal[axis])) for axis in positions)
+
+    def _settle_target(self, axis):
+        # sensor reading expected once the stage has arrived
+        if self.linearization is not None and self.linearization.reference == 'external':
+            return self._raw_pos[axis]
+        return self._cmd_pos[axis]
+    
+    def settle(self, mode=None):
+        '''
+        Wait until the axes written since the last call are at their
+        commanded positions.
+        
+        mode (default settle_mode):
+            'off'   return right away
+            'poll'  read the sensors until every axis is within
+                    settle_tolerance or settle_timeout has passed since its
+                    write, and record the settle time in settle_models
+            'model' wait the settle time predicted from the step sizes,
+                    polls (and learns) until the models have enough samples
+                    and then every settle_verify_every-th call
+        
+        returns False if an axis timed out
+        '''
+        if mode is None:
+            mode = self.settle_mode
+        assert mode in SETTLE_MODES
+        with self._settle_lock:
+            pending, self._settle_pending = self._settle_pending, dict()
+        if mode == 'off' or not pending:
+            return True
+        
+        if mode == 'model' and (self.settle_stats.count + 1) % self.settle_verify_every:
+            predicted = [(t_write, self.settle_models[axis].predict(step))
+                         for axis, (t_write, step) in pending.items()]
+            if all(t is not None for _, t in predicted):
+                deadline = max(t_write + t for t_write, t in predicted)
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+                self.settle_stats.add(max(t for _, t in predicted), predicted=True)
+                return True
+        return self._settle_poll(pending)
+    
+    def _settle_poll(self, pending):
+        settle_time = 0.0
+        timed_out = False
+        while pending:
+            for axis in list(pending):
+                t_write, step = pending[axis]
+                pos = self.singleReadN(axis)
+                elapsed = time.monotonic() - t_write
+                if abs(pos - self._settle_target(axis)) <= self.settle_tolerance:
+                    self.settle_models[axis].add(step, elapsed)
+                elif elapsed > self.settle_timeout:
+                    timed_out = True
+                else:
+                    continue
+                settle_time = max(settle_time, elapsed)
+                del pending[axis]
+        self.settle_stats.add(settle_time, timeout=timed_out)
+        if timed_out and self.debug:
+            print("MCLNanoDrive settle timed out after", settle_time)
+        return not timed_out
     
-    def get_pos_ax(self, axis):
+    def reset_settle_model(self):
+        for model in self.settle_models.values():
+            model.reset()
+        self.settle_stats.reset()
+    
+    def get_pos_ax(self, axis, max_age=None):
+        '''
+        Read the position of an axis. A sensor sample not older than max_age
+        seconds (default read_max_age), taken after the last write to that
+        axis, is returned without a new read.
+        '''
+        if max_age is None:
+            max_age = self.read_max_age
+        if max_age > 0:
+            sample = self._last_read.get(axis)
+            if sample is not None and time.monotonic() - sample[0] <= max_age:
+                return sample[1]
         pos = float(self.singleReadN(axis))
         if self.debug: print("get_pos_ax", axis, pos)
         return pos
     
-    def get_pos(self):
-        self.x_pos = self.singleReadN(1)
-        self.y_pos = self.singleReadN(2)
+    def get_pos(self, max_age=None):
+        axes = [1, 2, 3] if self.num_axes > 2 else [1, 2]
+        pos = self.read_axes(axes, max_age)
+        self.x_pos, self.y_pos = pos[:2]
         if self.num_axes > 2:
-            self.z_pos = self.singleReadN(3)
+            self.z_pos = pos[2]
         else:
             self.z_pos = -1
             
         return (self.x_pos, self.y_pos, self.z_pos)
     
+    def read_axes(self, axes, max_age=None):
+        '''
+        Positions of several axes, the reads not served by the cache (see
+        get_pos_ax) are done in a single I/O worker call
+        '''
+        if max_age is None:
+            max_age = self.read_max_age
+        pos = dict()
+        if max_age > 0:
+            now = time.monotonic()
+            for axis in axes:
+                sample = self._last_read.get(axis)
+                if sample is not None and now - sample[0] <= max_age:
+                    pos[axis] = sample[1]
+        todo = [axis for axis in axes if axis not in pos]
+        if todo:
+            pos.update(zip(todo, self._io_call(self._read_axes, todo)))
+        return [pos[axis] for axis in axes]
+    
+    def _read_axes(self, axes):
+        # runs on the I/O worker
+        result = []
+        for axis in axes:
+            resp = self._SingleReadN(axis, self._handle)
+            if resp < 0 and resp in self.MCL_ERROR_CODES:
+                raise MCLDeviceError("MCL singleReadN Error: {}".format(self.MCL_ERROR_CODES[resp]),
+                                     int(resp))
+            self._last_read[axis] = (time.monotonic(), resp)
+            result.append(float(resp))
+        return result
+    
     def singleReadN(self, axis):
-        with self.lock:
-            resp = madlib.MCL_SingleReadN(axis, self._handle)
+        resp = self._io_call(self._SingleReadN, axis, self._handle, coalesce_key=('read', axis))
         if resp < 0 and resp in self.MCL_ERROR_CODES:
-            raise IOError("MCL singleReadN Error: {}".format(self.MCL_ERROR_CODES[resp]))
+            raise MCLDeviceError("MCL singleReadN Error: {}".format(self.MCL_ERROR_CODES[resp]),
+                                 int(resp))
             #print('singleReadN', self.MCL_ERROR_CODES[resp])
+        self._last_read[axis] = (time.monotonic(), resp)
         return resp
     
     def monitorN(self, pos, axis):
-        with self.lock:
-            resp = madlib.MCL_MonitorN(pos, axis, self._handle)
+        raw = pos if self.linearization is None else float(self.linearize({axis: pos})[axis])
+        resp = self._io_call(self._MonitorN, raw, axis, self._handle)
+        self._cmd_pos[axis] = pos
+        self._raw_pos[axis] = raw
         if resp < 0 and resp in self.MCL_ERROR_CODES:
             #raise IOError(self.MCL_ERROR_CODES[resp])
             print('monitorN', pos, axis, self.MCL_ERROR_CODES[resp])        
@@ -275,7 +1060,8 @@ class MCLNanoDrive(object):
         xCom = c_double()
         yCom = c_double()
         zCom = c_double()
-        resp = madlib.MCL_GetCommandedPosition(byref(xCom), byref(yCom), byref(zCom), self._handle)
+        resp = self._io_call(self.madlib.MCL_GetCommandedPosition,
+                             byref(xCom), byref(yCom), byref(zCom), self._handle)
         if resp < 0:
             #raise IOError(self.MCL_ERROR_CODES[resp])
             print('getCommandedPosition',  self.MCL_ERROR_CODES[resp])        
@@ -288,30 +1074,267 @@ class MCLNanoDrive(object):
         #assert 0 <= pos <= self.cal[axis]
         pos = np.clip(pos, 0, self.cal[axis])
         
-        start = self.get_pos_ax(axis)
-        
-        dl = pos - start
-        dt = abs(dl) / self.max_speed
-        
-        # Assume dt is in ms; divide the movement into SLOW_STEP_PERIOD chunks
-        steps = int(np.ceil(dt/SLOW_STEP_PERIOD))
-        l_step = dl/steps
-        
-        print("\t", steps, l_step, dl, dt, start)        
-        
-        for i in range(1,steps+1):
-            t1 = time.time()         
-            self.set_pos_ax(start+i*l_step, axis)
-            t2 = time.time()
-            
-            if (t2-t1) < SLOW_STEP_PERIOD:
-                time.sleep(SLOW_STEP_PERIOD - (t2-t1))
+        self.move_slow_ax(pos, axis).wait()
         # Update internal variables with current position
         self.get_pos()
         
+    def has_profile(self, bit):
+        return bool(self.prodinfo.FirmwareProfile & bit)
+
+    @property
+    def dac_bits(self):
+        return 20 if self.prodinfo.DAC_resolution >= 20 else 16
+
+    def waveform_max_points(self):
+        return WAVEFORM_MAX_POINTS[self.dac_bits]
+
+    def _prep_waveform(self, waveform, axis):
+        wf = np.ascontiguousarray(waveform, dtype=np.float64)
+        assert wf.ndim == 1
+        assert 1 <= axis <= self.num_axes
+        if not 1 <= len(wf) <= self.waveform_max_points():
+            raise ValueError("waveform length {} not in [1, {}]".format(len(wf), self.waveform_max_points()))
+        check_waveform_limits(wf, 0, self.cal[axis])
+        return wf
+
+    def setup_load_waveform_ax(self, waveform, axis, period_ms, raw=False):
+        '''
+        Upload a position waveform (microns) for one axis, points spaced by
+        period_ms. Motion starts on trigger_load_waveform_ax.
+        raw: waveform is already corrected (see linearize)
+        '''
+        wf = self._prep_waveform(waveform, axis)
+        if not raw:
+            wf = self.linearize({axis: wf})[axis]
+        if self.skip_redundant_uploads and self._load_setup.get(axis) == period_ms \
+                and np.array_equal(self._load_waveforms[axis], wf):
+            self.skipped_upload_count += 1
+            return
+        # keep a reference, the array must outlive the setup call
+        self._load_waveforms[axis] = wf
+        self._load_setup.pop(axis, None)
+        self._wfma_setup = None # the controller has one waveform setup at a time
+        self.handle_err(self._io_call(self.madlib.MCL_Setup_LoadWaveFormN,
+                axis, len(wf), period_ms, wf.ctypes.data_as(c_double_p), self._handle))
+        self._load_setup[axis] = period_ms
+        self.upload_count += 1
+
+    def trigger_load_waveform_ax(self, axis):
+        self.invalidate_position_cache(axis)
+        self.handle_err(self._io_call(self.madlib.MCL_Trigger_LoadWaveFormN, axis, self._handle))
+
+    def load_waveform_ax(self, waveform, axis, period_ms):
+        '''
+        Setup and run a position waveform on one axis in a single call
+        '''
+        wf = self._prep_waveform(waveform, axis)
+        wf = self.linearize({axis: wf})[axis]
+        self.invalidate_position_cache(axis)
+        # replaces the axis' setup and a multi-axis one
+        self._load_setup.pop(axis, None)
+        self._wfma_setup = None
+        self.handle_err(self._io_call(self.madlib.MCL_LoadWaveFormN,
+                axis, len(wf), period_ms, wf.ctypes.data_as(c_double_p), self._handle))
+
+    def wfma_setup(self, waveforms, period, iterations=1, raw=False):
+        '''
+        Setup a multi-axis waveform.
+        waveforms: dict axis -> position array, all of the same length
+        period: ms between points (16 bit) or period index (20 bit)
+        iterations: number of repeats, 0 is infinite
+        raw: waveforms are already corrected (see linearize)
+        '''
+        wfs = [None, None, None]
+        n = None
+        for axis, wf in waveforms.items():
+            wf = self._prep_waveform(wf, axis)
+            if n is not None and len(wf) != n:
+                raise ValueError("all axis waveforms must have the same length")
+            n = len(wf)
+            wfs[axis-1] = wf
+        if n*len(waveforms) > self.waveform_max_points():
+            raise ValueError("multi-axis waveform too long: {} points per axis".format(n))
+        if self.linearization is not None and not raw:
+            corrected = self.linearize(dict((axis, wfs[axis-1]) for axis in waveforms))
+            for axis, wf in corrected.items():
+                wfs[axis-1] = wf
+        if self.skip_redundant_uploads and self._wfma_setup == (period, iterations) \
+                and all((a is None and b is None) or (a is not None and b is not None
+                                                      and np.array_equal(a, b))
+                        for a, b in zip(self._wfma_waveforms, wfs)):
+            self.skipped_upload_count += 1
+            return
+        self._wfma_waveforms = wfs
+        self._load_setup.clear() # replaced by this setup
+        ptrs = [wf.ctypes.data_as(c_double_p) if wf is not None else None for wf in wfs]
+        self._wfma_points = n
+        self._wfma_setup = None
+        self.handle_err(self._io_call(self.madlib.MCL_WfmaSetup, ptrs[0], ptrs[1], ptrs[2], n, period,
+                                      iterations, self._handle))
+        self._wfma_setup = (period, iterations)
+        self.upload_count += 1
+
+    def invalidate_waveforms(self):
+        '''forget the loaded waveform setups, the next setups upload again'''
+        self._load_setup.clear()
+        self._wfma_setup = None
+
+    def wfma_trigger(self):
+        self.invalidate_position_cache()
+        self.handle_err(self._io_call(self.madlib.MCL_WfmaTrigger, self._handle))
+
+    def wfma_stop(self):
+        self._wfma_setup = None # not relied upon after a stop
+        self.handle_err(self._io_call(self.madlib.MCL_WfmaStop, self._handle))
+
+    def get_buffer(self, shape, key=None):
+        '''
+        Return a reusable float64 buffer of the given shape from the pool.
+        The same array is handed out again on the next call with the same
+        shape/key, copy the data if it needs to be kept.
+        '''
+        if isinstance(shape, int):
+            shape = (shape,)
+        k = (key, tuple(shape))
+        buf = self._buffer_pool.get(k)
+        if buf is None:
+            buf = self._buffer_pool[k] = np.empty(shape, dtype=np.float64)
+        return buf
+
+    def _out_buffer(self, out, shape, key):
+        if out is None:
+            return self.get_buffer(shape, key)
+        if out.dtype != np.float64 or not out.flags['C_CONTIGUOUS'] or out.shape != tuple(shape):
+            raise ValueError("out must be a C-contiguous float64 array of shape {}".format(shape))
+        return out
+
+    def _read_period_arg(self, period_ms):
+        if self.prodinfo.ADC_resolution >= 20:
+            return period_index_20bit(period_ms)
+        return period_ms
+
+    def read_waveform_ax(self, axis, n, period_ms, out=None):
+        '''
+        Read n position samples of one axis, spaced by period_ms, in a single
+        driver call. Data is written into `out` (float64, shape (n,)) or into
+        a pooled buffer, which is returned.
+        '''
+        assert 1 <= axis <= self.num_axes
+        assert 1 <= n <= self.waveform_max_points()
+        out = self._out_buffer(out, (n,), ('read', axis))
+        self.handle_err(self._io_call(self.madlib.MCL_ReadWaveFormN,
+                axis, n, self._read_period_arg(period_ms),
+            out.ctypes.data_as(c_double_p), self._handle))
+        return out
+
+    def setup_read_waveform_ax(self, axis, n, period_ms):
+        assert 1 <= axis <= self.num_axes
+        assert 1 <= n <= self.waveform_max_points()
+        self.handle_err(self._io_call(self.madlib.MCL_Setup_ReadWaveFormN,
+                axis, n, self._read_period_arg(period_ms), self._handle))
+        self._read_setup[axis] = n
+
+    def trigger_read_waveform_ax(self, axis, out=None):
+        '''
+        Trigger a read setup with setup_read_waveform_ax, returns samples
+        '''
+        n = self._read_setup[axis]
+        out = self._out_buffer(out, (n,), ('read', axis))
+        self.handle_err(self._io_call(self.madlib.MCL_Trigger_ReadWaveFormN,
+                axis, n, out.ctypes.data_as(c_double_p), self._handle))
+        return out
+
+    def trigger_waveform_acquisition(self, axis, out=None):
+        '''
+        Run the load waveform and read waveform set up on `axis` together,
+        returns the position samples recorded during the motion.
+        '''
+        n = self._read_setup[axis]
+        out = self._out_buffer(out, (n,), ('read', axis))
+        self.invalidate_position_cache(axis)
+        self.handle_err(self._io_call(self.madlib.MCL_TriggerWaveformAcquisition,
+                axis, n, out.ctypes.data_as(c_double_p), self._handle))
+        return out
+
+    def _wfma_out(self, out):
+        n = self._wfma_points
+        out = self._out_buffer(out, (3, n), 'wfma')
+        ptrs = [out[i].ctypes.data_as(c_double_p) if self._wfma_waveforms[i] is not None else None
+                for i in range(3)]
+        return out, ptrs
+
+    def wfma_trigger_and_read(self, out=None):
+        '''
+        Run a finite multi-axis waveform and read back positions of all axes.
+        returns array of shape (3, points), rows are axes 1..3, rows of
+        axes without a waveform are left untouched.
+        '''
+        out, ptrs = self._wfma_out(out)
+        self.invalidate_position_cache()
+        self.handle_err(self._io_call(self.madlib.MCL_WfmaTriggerAndRead,
+                                      ptrs[0], ptrs[1], ptrs[2], self._handle))
+        return out
+
+    def wfma_read(self, out=None):
+        '''
+        Read back the last multi-axis waveform run started with wfma_trigger,
+        see wfma_trigger_and_read
+        '''
+        out, ptrs = self._wfma_out(out)
+        self.handle_err(self._io_call(self.madlib.MCL_WfmaRead, ptrs[0], ptrs[1], ptrs[2], self._handle))
+        return out
+
+    # Image Scan Sync clocks
+
+    def _iss_clock(self, clock):
+        return ISS_CLOCKS.get(clock, clock)
+
+    def iss_pulse(self, clock):
+        '''250 ns pulse on an ISS clock ('pixel', 'line', 'frame', 'aux' or 1-4)'''
+        clock = self._iss_clock(clock)
+        func = [self.madlib.MCL_PixelClock, self.madlib.MCL_LineClock,
+                self.madlib.MCL_FrameClock, self.madlib.MCL_AuxClock][clock-1]
+        self.handle_err(self._io_call(func, self._handle))
+
+    def iss_set_clock(self, clock, high):
+        '''
+        hold a clock high or low, this unbinds it from the axes
+        (not from the waveform events)
+        '''
+        self.handle_err(self._io_call(self.madlib.MCL_IssSetClock, self._iss_clock(clock),
+                                      int(bool(high)), self._handle))
+
+    def iss_bind(self, clock, event, polarity='rising'):
+        '''
+        pulse a clock on every read of an axis or on a waveform event.
+        event: 'X', 'Y', 'Z', 'aux', 'waveform_read' (every recorded point),
+               'waveform_write' (before the first and after the last point)
+               or 1-6
+        An event drives one clock only, binding another clock replaces it.
+        '''
+        self.handle_err(self._io_call(self.madlib.MCL_IssBindClockToAxis, self._iss_clock(clock),
+                                      ISS_POLARITY[polarity], ISS_EVENTS.get(event, event),
+                                      self._handle))
+
+    def iss_unbind(self, clock, event):
+        self.handle_err(self._io_call(self.madlib.MCL_IssBindClockToAxis, self._iss_clock(clock),
+                                      ISS_UNBIND, ISS_EVENTS.get(event, event), self._handle))
+
+    def iss_set_polarity(self, clock, polarity):
+        '''polarity of the pulses from iss_pulse, "rising" or "falling"'''
+        self.handle_err(self._io_call(self.madlib.MCL_IssConfigurePolarity, self._iss_clock(clock),
+                                      ISS_POLARITY[polarity], self._handle))
+
+    def iss_reset(self):
+        '''
+        ISS defaults: rising edges, pixel clock on waveform_read,
+        line clock on waveform_write, no axis bound
+        '''
+        self.handle_err(self._io_call(self.madlib.MCL_IssResetDefaults, self._handle))
+
     def handle_err(self, retcode):
         if retcode < 0:
-            raise IOError(self.MCL_ERROR_CODES[retcode])
+            raise MCLDeviceError(self.MCL_ERROR_CODES[retcode], retcode)
         return retcode
         
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+'''
+Visit order for point list scans.
+
+The stage time between two points grows with the distance (planned moves
+and settling both scale with step size), so the points are ordered to keep
+the total travel short: a greedy nearest neighbour tour improved with 2-opt
+moves. Both are vectorized over candidate points: a few hundred points take
+well under a second, a couple of thousand about a second.
+'''
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+
+def path_length(points, order, start=None):
+    '''total travel visiting points[order], from start if given'''
+    p = points[order]
+    length = np.sum(np.linalg.norm(np.diff(p, axis=0), axis=1))
+    if start is not None and len(p):
+        length += np.linalg.norm(p[0] - start)
+    return length
+
+
+def nearest_neighbor_order(points, start=None):
+    '''
+    greedy tour: always go to the closest point not visited yet.
+    start: position the stage starts from, default the first point
+    '''
+    points = np.asarray(points, dtype=float)
+    n = len(points)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    remaining = np.ones(n, dtype=bool)
+    order = np.empty(n, dtype=int)
+    cur = points[0] if start is None else np.asarray(start, dtype=float)
+    idx = np.arange(n)
+    for k in range(n):
+        cand = idx[remaining]
+        d2 = np.sum((points[cand] - cur)**2, axis=1)
+        nxt = cand[np.argmin(d2)]
+        order[k] = nxt
+        remaining[nxt] = False
+        cur = points[nxt]
+    return order
+
+
+def two_opt(points, order, start=None, max_passes=10, tol=1e-9):
+    '''
+    Improve an open tour by reversing segments while that shortens it.
+    Each pass tries, for every edge, all later edges at once.
+    start: fixed position before the first point (the first point may
+    then change), otherwise the first point stays first.
+    '''
+    points = np.asarray(points, dtype=float)
+    if start is not None:
+        # a virtual point 0 at the start position that is never moved
+        pts = np.vstack([np.asarray(start, dtype=float)[None, :], points])
+        route = np.concatenate([[0], np.asarray(order) + 1])
+    else:
+        pts = points
+        route = np.array(order)
+    n = len(route)
+    if n < 4:
+        return np.asarray(order)
+    for _ in range(max_passes):
+        improved = False
+        p = pts[route]
+        for i in range(n - 2):
+            a, b = p[i], p[i+1]
+            c = p[i+2:]                  # candidate j = i+2 .. n-1
+            d = p[i+3:]                  # their successors, none for the last point
+            d_ab = np.linalg.norm(b - a)
+            d_ac = np.linalg.norm(c - a, axis=1)
+            d_cd = np.linalg.norm(d - c[:-1], axis=1)
+            d_bd = np.linalg.norm(d - b, axis=1)
+            delta = d_ac - d_ab
+            delta[:-1] += d_bd - d_cd
+            j = np.argmin(delta)
+            if delta[j] < -tol:
+                j += i + 2
+                route[i+1:j+1] = route[i+1:j+1][::-1]
+                p[i+1:j+1] = p[i+1:j+1][::-1]
+                improved = True
+        if not improved:
+            break
+    if start is not None:
+        return route[1:] - 1
+    return route
+
+
+def plan_visit_order(points, start=None, two_opt_passes=10):
+    '''nearest neighbour tour from start, improved with two_opt'''
+    order = nearest_neighbor_order(points, start)
+    if two_opt_passes > 0:
+        order = two_opt(points, order, start, max_passes=two_opt_passes)
+    return order
+
+
+def mask_to_points(mask, h_array, v_array):
+    '''
+    (N, 2) h, v coordinates of the True pixels of a (len(v_array), len(h_array)) mask
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    assert mask.shape == (len(v_array), len(h_array))
+    jj, ii = np.nonzero(mask)
+    return np.column_stack([np.asarray(h_array, dtype=float)[ii],
+                            np.asarray(v_array, dtype=float)[jj]])
@@ -0,0 +1,286 @@
+'''
+Scan of an arbitrary list of points (or the True pixels of an ROI mask)
+with the MCL stage, visited in a travel-optimized order.
+'''
+from __future__ import division, print_function, absolute_import
+import time
+import numpy as np
+from ScopeFoundry import Measurement, h5_io
+from .mcl_nanodrive import PRIORITY_SCAN
+from .mcl_path import plan_visit_order, mask_to_points, path_length
+from .mcl_quadtree import QuadTreeImage
+
+
+class MCLStagePointScan(Measurement):
+    '''
+    Set the points with set_points (N x 2 h, v or N x 3 h, v, third axis)
+    or set_mask before starting.
+
+    Subclasses override collect_point(point_i, visit_i) and store results
+    with store(name, point_i, value): every result is kept per point (not
+    per visit) and saved next to the point coordinates.
+    '''
+
+    name = 'mcl_point_scan'
+
+    def setup(self):
+        S = self.settings
+        S.New("h_axis", initial="X", dtype=str, choices=("X", "Y", "Z"))
+        S.New("v_axis", initial="Y", dtype=str, choices=("X", "Y", "Z"))
+        S.New("n_points", initial=0, dtype=int, ro=True)
+        S.New("pixel_time", initial=0.0, dtype=float, unit='s', vmin=0, spinbox_decimals=4, si=False)
+        S.New("optimize_order", initial=True, dtype=bool)
+        S.New("two_opt_passes", initial=10, dtype=int, vmin=0)
+        # longer steps go through the planned slow move, shorter ones are a single write
+        S.New("slow_move_distance", initial=2.0, dtype=float, unit='um', vmin=0, si=False)
+        S.New("path_length", initial=0.0, dtype=float, unit='um', ro=True, si=False)
+        S.New("save_h5", initial=True, dtype=bool)
+
+        self.ax_map = dict(X=0, Y=1, Z=2)
+        self.stage = self.app.hardware.mcl_xyz_stage
+        self.points = np.zeros((0, 2))
+
+    def set_points(self, points):
+        points = np.array(points, dtype=float)
+        if points.ndim != 2 or points.shape[1] not in (2, 3):
+            raise ValueError("points must be an N x 2 or N x 3 array, got shape {}".format(points.shape))
+        if not np.all(np.isfinite(points)):
+            raise ValueError("points must be finite")
+        self.points = points
+        self.settings['n_points'] = len(points)
+
+    def set_mask(self, mask, h_array, v_array):
+        '''points at the True pixels of mask, shape (len(v_array), len(h_array))'''
+        self.set_points(mask_to_points(mask, h_array, v_array))
+
+    def point_coords(self, point):
+        '''stage [x, y, z] of a point, the third column drives the remaining axis'''
+        coords = [None, None, None]
+        for c, ax_i in enumerate(self.point_axes()):
+            coords[ax_i] = point[c]
+        return coords
+
+    def sample_xyz(self, points):
+        '''(N, 3) sample positions of points, other axes at their current position'''
+        xyz = np.tile(self.stage.sample_position(), (len(points), 1))
+        xyz[:, self.point_axes()] = points
+        return xyz
+
+    def check_limits(self):
+        T = self.stage.transform
+        T.validate(T.to_stage(self.sample_xyz(self.points)))
+
+    def store(self, name, point_i, value):
+        '''keep a result for a point, arrays are allocated on first use'''
+        arr = self.point_data.get(name)
+        if arr is None:
+            value = np.asarray(value)
+            arr = self.point_data[name] = np.full((len(self.points),) + value.shape, np.nan,
+                                                 dtype=np.result_type(value.dtype, np.float64))
+        arr[point_i] = value
+
+    def collect_point(self, point_i, visit_i):
+        time.sleep(self.settings['pixel_time'])
+
+    def run(self):
+        S = self.settings
+        if S['h_axis'] == S['v_axis']:
+            raise ValueError("h_axis and v_axis must differ")
+        if not len(self.points):
+            raise ValueError("no points to scan, use set_points or set_mask")
+        self.check_limits()
+
+        for drive in self.stage.drives:
+            drive.set_io_priority(PRIORITY_SCAN)
+        self.stage.scan_owner = self
+        try:
+            self.scan_points()
+        finally:
+            self.stage.scan_owner = None
+            if S['save_h5']:
+                self.save_h5()
+
+    def scan_points(self, progress=(0, 100)):
+        '''
+        visit self.points in the planned order and collect_point at each,
+        fills self.order, point_data, visit_time and readback.
+        progress: range of the progress bar covered by this pass
+        '''
+        S = self.settings
+        N = len(self.points)
+        cur = self.stage.sample_position()[self.point_axes()]
+        if not np.all(np.isfinite(cur)):
+            cur = None
+        if S['optimize_order']:
+            self.order = plan_visit_order(self.points, cur, S['two_opt_passes'])
+        else:
+            self.order = np.arange(N)
+        S['path_length'] = path_length(self.points, self.order, cur)
+
+        # stage positions of all points, converted, checked and linearized up front
+        T = self.stage.transform
+        stage_pos = T.to_stage(self.sample_xyz(self.points))
+        T.validate(stage_pos)
+        targets = T.targets(stage_pos, T.groups_for(T.affected(['XYZ'[a] for a in self.point_axes()])))
+
+        self.point_data = dict()
+        self.visit_time = np.full(N, np.nan)
+        self.readback = np.full((N, 3), np.nan)
+        prev = cur
+        for visit_i, point_i in enumerate(self.order):
+            if self.interrupt_measurement_called:
+                break
+            p = self.points[point_i]
+            coords = self.point_coords(p)
+            if prev is None or np.max(np.abs(p - prev)) > S['slow_move_distance']:
+                self.stage.move_pos_slow(*coords)
+            else:
+                self.stage.write_targets(targets, point_i)
+            prev = p
+            self.readback[point_i] = self.read_xyz()
+            self.visit_time[point_i] = time.monotonic()
+            self.collect_point(point_i, visit_i)
+            self.set_progress(progress[0] + (progress[1] - progress[0])*(visit_i + 1)/N)
+
+    def point_axes(self):
+        '''stage axis index (0..2 for X, Y, Z) of each point column'''
+        S = self.settings
+        h, v = self.ax_map[S['h_axis']], self.ax_map[S['v_axis']]
+        other = ({0, 1, 2} - {h, v}).pop()
+        return [h, v, other][:self.points.shape[1]]
+
+    def read_xyz(self):
+        '''(3,) stage X, Y, Z position, NaN for a missing axis'''
+        pos = np.full(3, np.nan)
+        for i, ax in enumerate('XYZ'):
+            if ax == 'Z' and not self.stage.has_z:
+                continue
+            pos[i] = self.stage.axis_drive[ax].get_pos_ax(self.stage.MCL_AXIS_ID[ax])
+        return pos
+
+    def save_h5(self):
+        self.h5_file = h5_io.h5_base_file(app=self.app, measurement=self)
+        try:
+            M = h5_io.h5_create_measurement_group(measurement=self, h5group=self.h5_file)
+            self.save_h5_data(M)
+        finally:
+            self.h5_file.close()
+
+    def save_h5_data(self, M):
+        M['points'] = self.points
+        M['order'] = self.order
+        M['visit_time'] = self.visit_time
+        M['readback'] = self.readback
+        for name, arr in self.point_data.items():
+            M[name] = arr
+
+
+class MCLStageAdaptiveScan(MCLStagePointScan):
+    '''
+    Adaptive 2D scan: samples a coarse grid, then repeatedly refines the
+    quadtree cells whose signal changes by more than the threshold across
+    the cell, down to the target step. Flat areas stay at the coarse step.
+
+    collect_point must store the refinement signal with
+    store(signal_name, point_i, value). image is the full resolution
+    resampled image after each level.
+    '''
+
+    name = 'mcl_adaptive_scan'
+
+    def setup(self):
+        MCLStagePointScan.setup(self)
+        S = self.settings
+        S.New("h0", initial=25.0, dtype=float, unit='um', si=False)
+        S.New("h1", initial=45.0, dtype=float, unit='um', si=False)
+        S.New("v0", initial=25.0, dtype=float, unit='um', si=False)
+        S.New("v1", initial=45.0, dtype=float, unit='um', si=False)
+        S.New("coarse_h_cells", initial=16, dtype=int, vmin=1)
+        S.New("coarse_v_cells", initial=16, dtype=int, vmin=1)
+        # target step is the coarse step / 2**levels
+        S.New("levels", initial=3, dtype=int, vmin=0, vmax=10)
+        S.New("signal_name", initial='signal', dtype=str)
+        S.New("threshold_mode", initial='relative', dtype=str, choices=('relative', 'absolute'))
+        # relative: fraction of the signal range of the coarse grid
+        S.New("threshold", initial=0.1, dtype=float, vmin=0, spinbox_decimals=4)
+        S.New("fine_step_h", initial=0.0, dtype=float, unit='um', ro=True, si=False)
+        S.New("fine_step_v", initial=0.0, dtype=float, unit='um', ro=True, si=False)
+        S.New("sample_fraction", initial=0.0, dtype=float, ro=True, spinbox_decimals=4)
+        self.image = None
+
+    def setup_tree(self):
+        S = self.settings
+        self.tree = QuadTreeImage(S['coarse_h_cells'], S['coarse_v_cells'], S['levels'])
+        self.h_array = np.linspace(S['h0'], S['h1'], self.tree.shape[1])
+        self.v_array = np.linspace(S['v0'], S['v1'], self.tree.shape[0])
+        S['fine_step_h'] = (S['h1'] - S['h0'])/(self.tree.shape[1] - 1)
+        S['fine_step_v'] = (S['v1'] - S['v0'])/(self.tree.shape[0] - 1)
+
+    def run(self):
+        S = self.settings
+        if S['h_axis'] == S['v_axis']:
+            raise ValueError("h_axis and v_axis must differ")
+        self.setup_tree()
+        tree = self.tree
+        self.set_points(tree.node_coords(tree.initial_samples(), self.h_array, self.v_array))
+        self.check_limits()
+
+        for drive in self.stage.drives:
+            drive.set_io_priority(PRIORITY_SCAN)
+        passes = []
+        self.stage.scan_owner = self
+        try:
+            nodes = tree.initial_samples()
+            threshold = S['threshold']
+            for level in range(S['levels'] + 1):
+                self.set_points(tree.node_coords(nodes, self.h_array, self.v_array))
+                # the number of later points is not known, each level gets an equal share
+                span = 100.0/(S['levels'] + 1)
+                self.scan_points(progress=(level*span, (level + 1)*span))
+                passes.append((nodes, self.points, self.order, self.visit_time,
+                               self.readback, self.point_data))
+                signal = self.point_data.get(S['signal_name'], np.full(len(nodes), np.nan))
+                tree.add_samples(nodes, signal)
+                self.image = tree.resample()
+                S['sample_fraction'] = tree.n_samples/tree.values.size
+                if self.interrupt_measurement_called or level == S['levels']:
+                    break
+                if level == 0 and S['threshold_mode'] == 'relative':
+                    finite = signal[np.isfinite(signal)]
+                    threshold = S['threshold']*np.ptp(finite) if len(finite) else np.inf
+                nodes = tree.refine(threshold)
+                if not len(nodes):
+                    break
+        finally:
+            self.stage.scan_owner = None
+            self.merge_passes(passes)
+            if S['save_h5'] and passes:
+                self.save_h5()
+
+    def merge_passes(self, passes):
+        '''concatenate the per level point records, visit order becomes global'''
+        if not passes:
+            return
+        offsets = np.cumsum([0] + [len(p[1]) for p in passes])
+        self.nodes = np.vstack([p[0] for p in passes])
+        self.points = np.vstack([p[1] for p in passes])
+        self.order = np.concatenate([p[2] + off for p, off in zip(passes, offsets)])
+        self.visit_time = np.concatenate([p[3] for p in passes])
+        self.readback = np.vstack([p[4] for p in passes])
+        self.level = np.concatenate([np.full(len(p[1]), k) for k, p in enumerate(passes)])
+        point_data = dict()
+        for k, p in enumerate(passes):
+            for name, arr in p[5].items():
+                if name not in point_data:
+                    point_data[name] = np.full((len(self.points),) + arr.shape[1:], np.nan)
+                point_data[name][offsets[k]:offsets[k+1]] = arr
+        self.point_data = point_data
+
+    def save_h5_data(self, M):
+        MCLStagePointScan.save_h5_data(self, M)
+        M['nodes'] = self.nodes
+        M['level'] = self.level
+        M['leaves'] = self.tree.leaves
+        M['h_array'] = self.h_array
+        M['v_array'] = self.v_array
+        M['image'] = self.image
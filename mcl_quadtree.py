@@ -0,0 +1,104 @@
+'''
+Quadtree sampled image for adaptive scans.
+
+The image lives on a fine grid of (n_v*2**levels + 1, n_h*2**levels + 1)
+nodes. Each leaf cell is sampled at its four corners; refining a leaf splits
+it into four and adds the (at most five) missing nodes of its children.
+Only sampled nodes hold values, resample() fills the leaves bilinearly from
+their corners for display. All bookkeeping works on arrays of leaves at once.
+'''
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+
+class QuadTreeImage(object):
+
+    def __init__(self, n_h, n_v, levels):
+        '''
+        n_h, n_v: number of coarse cells along h and v
+        levels: number of times a coarse cell can be split
+        '''
+        self.levels = levels
+        self.base = 2**levels
+        self.shape = (n_v*self.base + 1, n_h*self.base + 1)
+        self.values = np.full(self.shape, np.nan)
+        self.sampled = np.zeros(self.shape, dtype=bool)
+        jj, ii = np.mgrid[0:n_v, 0:n_h]
+        # leaves: (n, 3) of v node, h node of the first corner and size in nodes
+        self.leaves = np.column_stack([jj.ravel()*self.base, ii.ravel()*self.base,
+                                       np.full(jj.size, self.base)])
+
+    @property
+    def n_samples(self):
+        return int(self.sampled.sum())
+
+    def initial_samples(self):
+        '''(n, 2) v, h nodes of the coarse grid'''
+        jj, ii = np.mgrid[0:self.shape[0]:self.base, 0:self.shape[1]:self.base]
+        return np.column_stack([jj.ravel(), ii.ravel()])
+
+    def add_samples(self, nodes, values):
+        nodes = np.asarray(nodes)
+        self.values[nodes[:, 0], nodes[:, 1]] = values
+        self.sampled[nodes[:, 0], nodes[:, 1]] = True
+
+    def corner_values(self, leaves=None):
+        '''(n, 4) values at the corners of leaves, NaN where not sampled'''
+        if leaves is None:
+            leaves = self.leaves
+        j0, i0, s = leaves.T
+        return np.column_stack([self.values[j0, i0], self.values[j0, i0 + s],
+                                self.values[j0 + s, i0], self.values[j0 + s, i0 + s]])
+
+    def refine_metric(self):
+        '''
+        per leaf signal range over its corners, the change of the signal
+        across the cell: large at edges, ~0 over flat areas
+        '''
+        c = self.corner_values()
+        with np.errstate(invalid='ignore'):
+            metric = np.nanmax(c, axis=1) - np.nanmin(c, axis=1)
+        metric[~np.isfinite(metric)] = 0
+        return metric
+
+    def refine(self, threshold):
+        '''
+        split every leaf whose refine_metric exceeds threshold and that is
+        not at full resolution yet. returns the (n, 2) new nodes to sample
+        '''
+        split = (self.refine_metric() > threshold) & (self.leaves[:, 2] > 1)
+        parents = self.leaves[split]
+        if not len(parents):
+            return np.zeros((0, 2), dtype=int)
+        j0, i0, s = parents.T
+        h = s//2
+        children = [np.column_stack([j0 + dj*h, i0 + di*h, h])
+                    for dj, di in ((0, 0), (0, 1), (1, 0), (1, 1))]
+        self.leaves = np.vstack([self.leaves[~split]] + children)
+        # center and edge midpoints of each parent
+        nodes = np.vstack([np.column_stack([j0 + dj*h, i0 + di*h])
+                           for dj, di in ((1, 1), (0, 1), (1, 0), (1, 2), (2, 1))])
+        nodes = nodes[~self.sampled[nodes[:, 0], nodes[:, 1]]]
+        flat = np.unique(np.ravel_multi_index(nodes.T, self.shape))
+        return np.column_stack(np.unravel_index(flat, self.shape))
+
+    def resample(self):
+        '''full resolution image, each leaf filled bilinearly from its corners'''
+        out = np.full(self.shape, np.nan)
+        for s in np.unique(self.leaves[:, 2]):
+            leaves = self.leaves[self.leaves[:, 2] == s]
+            c = self.corner_values(leaves)
+            t = np.linspace(0, 1, s + 1)
+            ty, tx = t[None, :, None], t[None, None, :]
+            patch = ((1 - ty)*(1 - tx)*c[:, 0, None, None] + (1 - ty)*tx*c[:, 1, None, None] +
+                     ty*(1 - tx)*c[:, 2, None, None] + ty*tx*c[:, 3, None, None])
+            d = np.arange(s + 1)
+            out[leaves[:, 0, None, None] + d[None, :, None],
+                leaves[:, 1, None, None] + d[None, None, :]] = patch
+        return out
+
+    def node_coords(self, nodes, h_array, v_array):
+        '''(n, 2) h, v position of nodes, h_array/v_array: positions of all fine nodes'''
+        nodes = np.asarray(nodes)
+        return np.column_stack([np.asarray(h_array)[nodes[:, 1]],
+                                np.asarray(v_array)[nodes[:, 0]]])
@@ -0,0 +1,239 @@
+'''
+Continuous position recording at controller sample rates.
+
+MCLPositionRecorder runs a background thread that pulls blocks of position
+samples with the controller's waveform read functions (one driver call per
+block instead of one per sample) and appends them to a PositionRingBuffer,
+optionally backed by a numpy.memmap file, and to any number of sinks such as
+H5PositionSink. Memory use is fixed by the ring size however long it runs.
+
+Other code can use the live data without copies: ring.data is the
+(channels, capacity) sample array, and listeners added with add_listener are
+called with a view of every new block.
+'''
+from __future__ import division, print_function, absolute_import
+import threading
+import time
+import numpy as np
+from .mcl_nanodrive import PROFILE_WFMA, PRIORITY_POLL
+from .mcl_waveform import period_index_20bit
+
+# longest a 'read' block may hold the drive's I/O worker: scan and move
+# calls queued meanwhile wait at most this long
+READ_MAX_HOLD_MS = 20.0
+
+
+class PositionRingBuffer(object):
+    '''
+    Fixed size ring of position samples, stored channel-major so that each
+    block of one channel is a contiguous slice.
+
+    data: (n_channels, n_blocks*block) samples
+    block_t0: (n_blocks, n_channels) time.monotonic() of the first sample of
+              each block and channel, sample k of a block is at t0 + k*dt
+    '''
+
+    def __init__(self, n_channels, block, n_blocks, dt, filename=None):
+        self.n_channels = n_channels
+        self.block = block
+        self.n_blocks = n_blocks
+        self.dt = dt
+        shape = (n_channels, n_blocks*block)
+        if filename:
+            self.data = np.memmap(filename, dtype=np.float64, mode='w+', shape=shape)
+        else:
+            self.data = np.zeros(shape)
+        self.data[:] = np.nan
+        self.block_t0 = np.full((n_blocks, n_channels), np.nan)
+        self.blocks_written = 0
+        self.lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return self.n_blocks*self.block
+
+    def next_block(self):
+        '''(block index, data view) of the slot the next block is written to'''
+        j = self.blocks_written % self.n_blocks
+        return j, self.data[:, j*self.block:(j+1)*self.block]
+
+    def commit_block(self, j, t0):
+        with self.lock:
+            self.block_t0[j] = t0
+            self.blocks_written += 1
+
+    def latest(self, n=None):
+        '''
+        copy of the last n samples (default: all complete blocks in the ring),
+        oldest first. returns (t, data), both (n_channels, n)
+        '''
+        with self.lock:
+            # the slot after the newest block may be being overwritten
+            n_valid = min(self.blocks_written, self.n_blocks - 1)*self.block
+            n = n_valid if n is None else min(n, n_valid)
+            end = (self.blocks_written % self.n_blocks)*self.block
+            idx = np.arange(end - n, end) % self.capacity
+            data = self.data[:, idx]
+            t0 = self.block_t0[idx//self.block].T
+        t = t0 + self.dt*(idx % self.block)
+        return t, data
+
+    def last_sample(self):
+        '''(n_channels,) most recent position, NaN before the first block'''
+        with self.lock:
+            if not self.blocks_written:
+                return np.full(self.n_channels, np.nan)
+            j = (self.blocks_written - 1) % self.n_blocks
+            return self.data[:, (j+1)*self.block - 1].copy()
+
+    def flush(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+
+
+class H5PositionSink(object):
+    '''
+    Appends recorded blocks to chunked, resizable datasets in an h5py group:
+    'positions' (samples, n_channels) and 'block_t0' (blocks, n_channels)
+    '''
+
+    def __init__(self, h5_group, n_channels, block, dt, names=None):
+        # blocks can be short (READ_MAX_HOLD_MS), chunks hold several of them
+        self.positions = h5_group.create_dataset('positions', shape=(0, n_channels),
+                                                 maxshape=(None, n_channels), dtype='f8',
+                                                 chunks=(block*max(1, 4096//block), n_channels))
+        self.block_t0 = h5_group.create_dataset('block_t0', shape=(0, n_channels),
+                                                maxshape=(None, n_channels), dtype='f8',
+                                                chunks=(64, n_channels))
+        self.positions.attrs['dt'] = dt
+        self.positions.attrs['block'] = block
+        if names is not None:
+            self.positions.attrs['channels'] = np.array(names, dtype='S')
+
+    def write_block(self, t0, data):
+        n = data.shape[1]
+        i = self.positions.shape[0]
+        self.positions.resize(i + n, axis=0)
+        self.positions[i:i+n] = data.T
+        k = self.block_t0.shape[0]
+        self.block_t0.resize(k + 1, axis=0)
+        self.block_t0[k] = t0
+
+    def close(self):
+        self.positions.file.flush()
+
+
+class MCLPositionRecorder(object):
+
+    def __init__(self, nanodrive, axes=(1, 2), period_ms=1.0, block=200,
+                 ring_seconds=60.0, ring_file=None, mode='read'):
+        '''
+        nanodrive: MCLNanoDrive to record from
+        axes: controller axes, one ring channel each
+        period_ms: time between samples
+        block: samples per driver call. In 'read' mode it is cut to
+               READ_MAX_HOLD_MS of samples, each read holds the drive's I/O
+               for block*period_ms and runs at PRIORITY_POLL, behind the
+               queued scan and move calls
+        ring_seconds: history kept in the ring buffer
+        ring_file: back the ring with a numpy.memmap at this path
+        mode: 'read' reads the axes one after the other with MCL_ReadWaveFormN,
+              'wfma' samples all axes together with a multi-axis waveform
+              holding the commanded position. Every block replaces the
+              controller's waveform setup and resets the drive's position
+              cache: nothing else may move the stage or use waveforms
+              meanwhile (MclXYZStageHW refuses it during scans)
+        '''
+        assert mode in ('read', 'wfma')
+        if mode == 'wfma' and not nanodrive.has_profile(PROFILE_WFMA):
+            raise IOError("Nano-Drive firmware does not support multi-axis waveforms")
+        self.nd = nanodrive
+        self.axes = tuple(axes)
+        self.period_ms = period_ms
+        self.mode = mode
+        per_call = len(self.axes) if mode == 'wfma' else 1
+        self.block = int(min(block, nanodrive.waveform_max_points()//per_call))
+        if mode == 'read':
+            self.block = max(1, min(self.block, int(READ_MAX_HOLD_MS/period_ms)))
+        n_blocks = max(2, int(np.ceil(ring_seconds*1e3/period_ms/self.block)))
+        self.ring = PositionRingBuffer(len(self.axes), self.block, n_blocks, period_ms*1e-3,
+                                       filename=ring_file)
+        self.sinks = []
+        self.listeners = []
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def add_listener(self, func):
+        '''
+        func(t0, data) is called on the recorder thread for every block,
+        data is a (n_channels, block) view into the ring, copy to keep it
+        '''
+        self.listeners.append(func)
+
+    def remove_listener(self, func):
+        self.listeners.remove(func)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name='mcl_recorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.mode == 'wfma':
+            self.nd.wfma_stop()
+        self.ring.flush()
+        for sink in self.sinks:
+            sink.close()
+
+    def _run(self):
+        self.nd.set_io_priority(PRIORITY_POLL)
+        try:
+            while not self._stop.is_set():
+                j, view = self.ring.next_block()
+                if self.mode == 'wfma':
+                    t0 = self._read_block_wfma(view)
+                else:
+                    t0 = self._read_block(view)
+                self.ring.commit_block(j, t0)
+                for sink in self.sinks:
+                    sink.write_block(t0, view)
+                for func in self.listeners:
+                    func(t0, view)
+        except Exception as err:
+            self.error = err
+            print("MCLPositionRecorder stopped:", err)
+
+    def _read_block(self, view):
+        t0 = np.empty(len(self.axes))
+        for c, axis in enumerate(self.axes):
+            t0[c] = time.monotonic()
+            # the driver writes straight into the ring
+            self.nd.read_waveform_ax(axis, self.block, self.period_ms, out=view[c])
+        return t0
+
+    def _read_block_wfma(self, view):
+        hold = dict((axis, np.full(self.block, self.nd.get_commanded_pos_ax(axis)))
+                    for axis in self.axes)
+        period = period_index_20bit(self.period_ms) if self.nd.dac_bits == 20 else self.period_ms
+        self.nd.wfma_setup(hold, period, iterations=1)
+        t0 = np.full(len(self.axes), time.monotonic())
+        samples = self.nd.wfma_trigger_and_read()
+        for c, axis in enumerate(self.axes):
+            view[c] = samples[axis-1]
+        return t0
@@ -0,0 +1,491 @@
+'''
+Local stage server: one process owns the Nano-Drive handle and serves it
+to others (analysis scripts, autofocus, a second GUI) over a Unix socket or
+TCP on localhost. mcl_client.MCLStageClient is the other end.
+
+Run it stand-alone with
+
+    python -m ScopeFoundry_HW.mcl_stage.mcl_server [--address 127.0.0.1:47555] [--sim]
+
+or from MclXYZStageHW with server_mode='host'.
+
+Protocol: every message is a frame of one or more commands, all
+little-endian. Each frame is answered by one frame with a result per
+command, in order, so a batch of commands costs a single round trip.
+
+    frame:     <I payload bytes> <H number of commands>, then per command
+    request:   <B opcode> <B axis or axis bitmask> <I bytes> payload
+    response:  <B status> <B kind> <I bytes> payload
+
+Request payloads are float64 values, except OP_CALL (UTF-8 JSON
+[method, [args]] for the less frequent calls in CALL_METHODS). Results are
+empty, a float64 array (<B ndim> <I dim>*ndim, then the values) or JSON.
+Commands after a failed one are skipped; the error carries the exception
+type, message and MCL error code.
+'''
+from __future__ import division, print_function, absolute_import
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .mcl_io_worker import PRIORITY_MOVE
+from .mcl_linearize import LinearizationMap
+
+
+DEFAULT_ADDRESS = '127.0.0.1:47555'
+
+FRAME_HEADER = struct.Struct('<IH')
+CMD_HEADER = struct.Struct('<BBI')
+DOUBLE = struct.Struct('<d')
+
+OP_SET_POS_AX = 1           # axis, [pos]
+OP_GET_POS_AX = 2           # axis, [] or [max_age] -> [pos]
+OP_READ_AXES = 3            # axis bitmask, [] or [max_age] -> positions
+OP_WRITE_AXES = 4           # axis bitmask, positions; range checked, then settles
+OP_SETTLE = 5
+OP_GET_COMMANDED_POS_AX = 6 # axis -> [pos]
+OP_MOVE_SLOW = 7            # axis bitmask, targets; starts the move -> [move id]
+OP_WAIT_MOTION = 8          # [], [move id] or [move id, timeout] -> [1 if the targets were reached]
+OP_STOP_MOTION = 9
+OP_SETUP_LOAD_WAVEFORM = 10 # axis, [period_ms, waveform...]
+OP_READ_WAVEFORM = 11       # axis, [n, period_ms] -> samples
+OP_WAVEFORM_ACQUISITION = 12 # axis -> samples, after the load and read setups
+OP_WFMA_SETUP = 13          # axis bitmask, [period, iterations, waveforms in axis order...]
+OP_WFMA_TRIGGER_AND_READ = 14 # -> (3, n) samples
+OP_CALL = 255               # JSON [method, [args]]
+
+OP_NAMES = dict((v, k[3:].lower()) for k, v in list(globals().items()) if k.startswith('OP_'))
+
+# opcodes that make at most one driver call (or only start or stop a slow
+# move): frames of only these are queued on the driver's I/O worker as a
+# single call, skipping the thread pool hand-off; everything else (settles,
+# waits, waveforms) runs on the pool
+INLINE_OPS = frozenset((OP_SET_POS_AX, OP_GET_POS_AX, OP_READ_AXES, OP_GET_COMMANDED_POS_AX,
+                        OP_MOVE_SLOW, OP_STOP_MOTION))
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_SKIPPED = 2
+
+KIND_NONE = 0
+KIND_ARRAY = 1
+KIND_JSON = 2
+
+# MCLNanoDrive methods reachable with OP_CALL
+CALL_METHODS = ('set_max_speed', 'get_max_speed', 'set_max_accel', 'get_max_accel', 'set_axis_limits',
+                'set_pos_slow', 'set_pos_waveform', 'motion_active', 'wait_motion_idle',
+                'reset_settle_model', 'resync_commanded_position', 'invalidate_position_cache',
+                'load_waveform_ax', 'trigger_load_waveform_ax', 'setup_read_waveform_ax',
+                'trigger_read_waveform_ax', 'wfma_trigger', 'wfma_stop', 'wfma_read',
+                'iss_pulse', 'iss_set_clock', 'iss_bind', 'iss_unbind', 'iss_set_polarity', 'iss_reset',
+                'is_attached', 'reconnect', 'invalidate_waveforms')
+
+# plain attributes clients may set, see MCLStageClient.__setattr__
+REMOTE_ATTRIBUTES = ('read_max_age', 'skip_redundant_writes', 'settle_mode', 'settle_tolerance',
+                     'settle_timeout', 'settle_verify_every', 'max_jerk', 'skip_redundant_uploads')
+
+
+def parse_address(address):
+    '''('unix', path) or ('tcp', (host, port)) for 'unix:/path', 'host:port' or 'port' '''
+    if address.startswith('unix:'):
+        return 'unix', address[5:]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+def axis_mask(axes):
+    mask = 0
+    for axis in axes:
+        mask |= 1 << (axis - 1)
+    return mask
+
+
+def mask_axes(mask):
+    return [axis for axis in (1, 2, 3) if mask & (1 << (axis - 1))]
+
+
+def encode_frame(parts, n):
+    '''frame of n encoded commands or results'''
+    payload = b''.join(parts)
+    return FRAME_HEADER.pack(len(payload), n) + payload
+
+
+def encode_array(values):
+    a = np.ascontiguousarray(values, dtype='<f8')
+    return struct.pack('<B{}I'.format(a.ndim), a.ndim, *a.shape) + a.tobytes()
+
+
+def decode_array(data):
+    ndim = data[0]
+    shape = struct.unpack_from('<{}I'.format(ndim), data, 1)
+    return np.frombuffer(data, dtype='<f8', offset=1 + 4*ndim).reshape(shape)
+
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("cannot send {!r}".format(obj))
+
+
+def encode_json(obj):
+    return json.dumps(obj, default=_json_default).encode('utf-8')
+
+
+def encode_result(result):
+    if result is None:
+        return CMD_HEADER.pack(STATUS_OK, KIND_NONE, 0)
+    if isinstance(result, np.ndarray):
+        data, kind = encode_array(result), KIND_ARRAY
+    else:
+        data, kind = encode_json(result), KIND_JSON
+    return CMD_HEADER.pack(STATUS_OK, kind, len(data)) + data
+
+
+def encode_error(err, status=STATUS_ERROR):
+    data = encode_json([type(err).__name__, str(err), getattr(err, 'code', None)])
+    return CMD_HEADER.pack(status, KIND_JSON, len(data)) + data
+
+
+def iter_commands(payload, n):
+    '''(opcode or status, axis or kind, data) of the n commands of a frame payload'''
+    offset = 0
+    for _ in range(n):
+        a, b, size = CMD_HEADER.unpack_from(payload, offset)
+        offset += CMD_HEADER.size
+        yield a, b, payload[offset:offset + size]
+        offset += size
+
+
+def _doubles(data):
+    return np.frombuffer(data, dtype='<f8')
+
+
+# finished moves a connection remembers for late waits
+MAX_FINISHED_MOVES = 64
+
+
+class _Connection(object):
+    '''per client state'''
+
+    def __init__(self):
+        self.priority = PRIORITY_MOVE
+        self.moves = OrderedDict() # move id -> SlowMove started by this client
+        self.last_move_id = 0 # 0: none yet
+
+    def add_move(self, move):
+        self.last_move_id += 1
+        self.moves[self.last_move_id] = move
+        finished = [i for i, m in self.moves.items() if m.done()]
+        for i in finished[:len(finished) - MAX_FINISHED_MOVES]:
+            del self.moves[i]
+        return self.last_move_id
+
+    def get_move(self, move_id):
+        '''SlowMove of an id, 0 for the last one (None if there is none)'''
+        move_id = int(move_id) or self.last_move_id
+        if move_id == 0:
+            return None
+        if move_id not in self.moves:
+            raise ValueError("move {} is no longer known to the server".format(move_id))
+        return self.moves[move_id]
+
+
+class MCLStageServer(object):
+
+    def __init__(self, nanodrive, address=DEFAULT_ADDRESS, max_workers=4):
+        '''
+        nanodrive: the MCLNanoDrive to serve, stays owned by the caller
+        max_workers: driver calls run on a thread pool, clients waiting for
+                     a slow move do not hold up the others
+        '''
+        self.nd = nanodrive
+        self.address = address
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='mcl_server')
+        self.server = None
+        self.loop = None
+        self.thread = None
+        self.n_clients = 0
+        self.handlers = {
+            OP_SET_POS_AX: self._set_pos_ax,
+            OP_GET_POS_AX: self._get_pos_ax,
+            OP_READ_AXES: self._read_axes,
+            OP_WRITE_AXES: self._write_axes,
+            OP_SETTLE: lambda conn, axis, data: self.nd.settle(),
+            OP_GET_COMMANDED_POS_AX: self._get_commanded_pos_ax,
+            OP_MOVE_SLOW: self._move_slow,
+            OP_WAIT_MOTION: self._wait_motion,
+            OP_STOP_MOTION: lambda conn, axis, data: self.nd.stop_motion(),
+            OP_SETUP_LOAD_WAVEFORM: self._setup_load_waveform,
+            OP_READ_WAVEFORM: self._read_waveform,
+            OP_WAVEFORM_ACQUISITION: lambda conn, axis, data: self.nd.trigger_waveform_acquisition(axis).copy(),
+            OP_WFMA_SETUP: self._wfma_setup,
+            OP_WFMA_TRIGGER_AND_READ: lambda conn, axis, data: self.nd.wfma_trigger_and_read().copy(),
+            OP_CALL: self._call,
+        }
+
+    # command execution, on the thread pool or the I/O worker (INLINE_OPS)
+
+    def execute(self, conn, payload, n):
+        '''run the commands of a request frame, returns the response frame'''
+        # pool threads serve every client, set this one's priority each time
+        self.nd.set_io_priority(conn.priority)
+        parts = []
+        failed = None
+        for op, axis, data in iter_commands(payload, n):
+            if failed is not None:
+                parts.append(encode_error(failed, STATUS_SKIPPED))
+                continue
+            try:
+                handler = self.handlers.get(op)
+                if handler is None:
+                    raise ValueError("unknown opcode {}".format(op))
+                parts.append(encode_result(handler(conn, axis, data)))
+            except Exception as err:
+                failed = err
+                parts.append(encode_error(err))
+        return encode_frame(parts, n)
+
+    def _set_pos_ax(self, conn, axis, data):
+        self.nd.set_pos_ax(DOUBLE.unpack(data)[0], axis)
+
+    def _get_pos_ax(self, conn, axis, data):
+        max_age = DOUBLE.unpack(data)[0] if data else None
+        return np.array([self.nd.get_pos_ax(axis, max_age)])
+
+    def _read_axes(self, conn, mask, data):
+        max_age = DOUBLE.unpack(data)[0] if data else None
+        return np.array(self.nd.read_axes(mask_axes(mask), max_age))
+
+    def _write_axes(self, conn, mask, data):
+        for axis, pos in zip(mask_axes(mask), _doubles(data)):
+            self.nd.set_pos_ax(float(pos), axis)
+        self.nd.settle()
+
+    def _get_commanded_pos_ax(self, conn, axis, data):
+        return np.array([self.nd.get_commanded_pos_ax(axis)])
+
+    def _move_slow(self, conn, mask, data):
+        targets = [None, None, None]
+        for axis, pos in zip(mask_axes(mask), _doubles(data)):
+            targets[axis-1] = float(pos)
+        return np.array([conn.add_move(self.nd.move_slow(*targets))], dtype=float)
+
+    def _wait_motion(self, conn, axis, data):
+        values = _doubles(data)
+        move = conn.get_move(values[0] if len(values) else 0)
+        timeout = float(values[1]) if len(values) > 1 else None
+        if move is None:
+            self.nd.wait_motion_idle(timeout)
+            return np.array([1.0])
+        return np.array([float(move.wait(timeout))])
+
+    def _setup_load_waveform(self, conn, axis, data):
+        values = _doubles(data)
+        self.nd.setup_load_waveform_ax(values[1:], axis, float(values[0]))
+
+    def _read_waveform(self, conn, axis, data):
+        n, period_ms = _doubles(data)
+        return self.nd.read_waveform_ax(axis, int(n), float(period_ms)).copy()
+
+    def _wfma_setup(self, conn, mask, data):
+        values = _doubles(data)
+        axes = mask_axes(mask)
+        wfs = values[2:].reshape(len(axes), -1)
+        self.nd.wfma_setup(dict(zip(axes, wfs)), float(values[0]), int(values[1]))
+
+    def _call(self, conn, axis, data):
+        name, args = json.loads(data.decode('utf-8'))
+        special = getattr(self, '_call_' + name, None)
+        if special is not None:
+            return special(conn, *args)
+        if name not in CALL_METHODS:
+            raise ValueError("{} is not available remotely".format(name))
+        result = getattr(self.nd, name)(*args)
+        if isinstance(result, np.ndarray):
+            result = result.copy() # pooled buffers are reused by the next call
+        return result
+
+    def _call_device_info(self, conn):
+        nd = self.nd
+        info = dict(serial=nd.device_serial_number, num_axes=nd.num_axes,
+                    cal=dict((str(axis), cal) for axis, cal in nd.cal.items()),
+                    prodinfo=nd._prodinfo_dict(nd.prodinfo),
+                    max_speed=nd.max_speed, max_accel=nd.max_accel)
+        for name in REMOTE_ATTRIBUTES:
+            info[name] = getattr(nd, name)
+        return info
+
+    def _call_settle_stats(self, conn):
+        s = self.nd.settle_stats
+        return dict(count=s.count, timeouts=s.timeouts, predicted=s.predicted, last=s.last, total=s.total)
+
+    def _call_counters(self, conn):
+        nd = self.nd
+        return dict(write_count=nd.write_count, skipped_write_count=nd.skipped_write_count,
+                    upload_count=nd.upload_count, skipped_upload_count=nd.skipped_upload_count)
+
+    def _call_move_done(self, conn, move_id):
+        move = conn.get_move(move_id)
+        return True if move is None else move.done()
+
+    def _call_move_cancel(self, conn, move_id):
+        move = conn.get_move(move_id)
+        if move is not None:
+            move.cancel()
+
+    def _call_set_attr(self, conn, name, value):
+        if name not in REMOTE_ATTRIBUTES:
+            raise ValueError("{} cannot be set remotely".format(name))
+        setattr(self.nd, name, value)
+
+    def _call_set_io_priority(self, conn, priority):
+        conn.priority = priority
+        self.nd.set_io_priority(priority) # for the rest of this frame
+
+    def _call_set_linearization(self, conn, tables):
+        lmap = None
+        if tables is not None:
+            lmap = LinearizationMap(tables['serial'], tables['reference'])
+            for axis, (c, m) in tables['axes'].items():
+                lmap.axes[int(axis)] = (np.array(c), np.array(m))
+            for key, (xp, off) in tables['coupling'].items():
+                axis, other = key.split(',')
+                lmap.coupling[(int(axis), int(other))] = (np.array(xp), np.array(off))
+        self.nd.set_linearization(lmap)
+
+    # asyncio side
+
+    def _submit_io(self, loop, conn, payload, n):
+        '''
+        queue a frame as one call on the driver's I/O worker, returns an
+        asyncio future, or None without a worker. The event loop never waits
+        for the worker: a waveform or another client holding it only delays
+        this frame.
+        '''
+        io = getattr(self.nd, '_io', None)
+        if io is None or io.closed:
+            return None
+        response = loop.create_future()
+        def resolve(io_future):
+            loop.call_soon_threadsafe(_copy_result, io_future, response)
+        try:
+            io.submit(self.execute, (conn, payload, n), conn.priority).add_done_callback(resolve)
+        except IOError:
+            return None # closed in the meantime
+        return response
+
+    async def _serve_client(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = _Connection()
+        loop = asyncio.get_running_loop()
+        self.n_clients += 1
+        try:
+            while True:
+                size, n = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                payload = await reader.readexactly(size)
+                response = None
+                if all(op in INLINE_OPS for op, axis, data in iter_commands(payload, n)):
+                    response = self._submit_io(loop, conn, payload, n)
+                if response is None:
+                    response = loop.run_in_executor(self.executor, self.execute, conn, payload, n)
+                writer.write(await response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # client went away
+        finally:
+            self.n_clients -= 1
+            writer.close()
+
+    async def start(self):
+        kind, addr = parse_address(self.address)
+        if kind == 'unix':
+            if os.path.exists(addr):
+                os.remove(addr) # left over from a server that did not shut down
+            self.server = await asyncio.start_unix_server(self._serve_client, path=addr)
+        else:
+            self.server = await asyncio.start_server(self._serve_client, host=addr[0], port=addr[1])
+        self.loop = asyncio.get_running_loop()
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start_thread(self):
+        '''serve on an event loop thread of its own, returns once listening'''
+        started = threading.Event()
+        errors = []
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.start())
+            except Exception as err:
+                errors.append(err)
+                started.set()
+                return
+            started.set()
+            loop.run_forever()
+            self.server.close()
+            loop.run_until_complete(self.server.wait_closed())
+            loop.close()
+        self.thread = threading.Thread(target=run, name='mcl_server')
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+    def stop(self):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+        self.executor.shutdown(wait=False)
+
+
+def _copy_result(io_future, future):
+    if future.cancelled(): # the client went away
+        return
+    try:
+        future.set_result(io_future.result(0))
+    except Exception as err:
+        future.set_exception(err)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve a Nano-Drive to other processes")
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help="host:port or unix:/path")
+    parser.add_argument('--sim', action='store_true', help="serve the simulated driver")
+    parser.add_argument('--madlib-path')
+    args = parser.parse_args()
+    from .mcl_nanodrive import MCLNanoDrive
+    backend = None
+    if args.sim:
+        from .mcl_sim import SimMadlib
+        backend = SimMadlib()
+    nd = MCLNanoDrive(backend=backend, madlib_path=args.madlib_path)
+    server = MCLStageServer(nd, args.address)
+    print("serving Nano-Drive {} on {}".format(nd.device_serial_number, args.address))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown(wait=False)
+        nd.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''
+Settle time bookkeeping for MCLNanoDrive.settle
+
+SettleModel learns, per axis, how long the stage takes to get within
+tolerance after a step: a least squares line t = a + b*|step| over the most
+recent moves. Once it has enough samples the drive can wait the predicted
+time instead of polling the sensor.
+'''
+from __future__ import division, print_function, absolute_import
+from collections import deque
+import numpy as np
+
+
+SETTLE_MODES = ('off', 'poll', 'model')
+
+
+class SettleModel(object):
+
+    def __init__(self, history=64, min_samples=8, margin=1.2):
+        '''
+        history: number of recent (step, settle time) samples kept
+        min_samples: samples needed before predict() returns an estimate
+        margin: factor applied to the predicted time
+        '''
+        self.samples = deque(maxlen=history)
+        self.min_samples = min_samples
+        self.margin = margin
+        self._fit = None
+
+    def add(self, step, settle_time):
+        self.samples.append((abs(step), settle_time))
+        self._fit = None
+
+    def reset(self):
+        self.samples.clear()
+        self._fit = None
+
+    def fit(self):
+        '''(intercept, slope) of settle time vs step size, None if too few samples'''
+        if len(self.samples) < self.min_samples:
+            return None
+        if self._fit is None:
+            steps, times = np.array(self.samples).T
+            if np.ptp(steps) > 0:
+                slope, intercept = np.polyfit(steps, times, 1)
+                slope = max(slope, 0.0)
+            else:
+                slope, intercept = 0.0, times.mean()
+            # the fit is a mean, cover the spread of the samples too
+            resid = times - (intercept + slope*steps)
+            self._fit = (intercept + resid.std(), slope)
+        return self._fit
+
+    def predict(self, step):
+        '''predicted settle time (s) for a step, None if not trained yet'''
+        fit = self.fit()
+        if fit is None:
+            return None
+        intercept, slope = fit
+        return max(0.0, self.margin*(intercept + slope*abs(step)))
+
+
+class SettleStats(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.timeouts = 0
+        self.predicted = 0
+        self.last = 0.0
+        self.total = 0.0
+
+    def add(self, settle_time, timeout=False, predicted=False):
+        self.count += 1
+        self.timeouts += int(timeout)
+        self.predicted += int(predicted)
+        self.last = settle_time
+        self.total += settle_time
+
+    @property
+    def mean(self):
+        return self.total/self.count if self.count else 0.0
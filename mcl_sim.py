@@ -0,0 +1,538 @@
+'''
+In-process simulation of the MadLib driver.
+
+SimMadlib implements the MCL_* functions used by MCLNanoDrive with the same
+call signatures as the ctypes DLL, so it can be passed as the `backend` of
+MCLNanoDrive to run and benchmark this package without hardware.
+
+Each simulated call costs a configurable USB latency, axes follow commanded
+positions with a first order lag (settle_tau) and reads add gaussian noise.
+'''
+from __future__ import division, print_function, absolute_import
+import time
+import threading
+import numpy as np
+
+
+MCL_SUCCESS = 0
+MCL_DEV_NOT_ATTACHED = -3
+MCL_USAGE_ERROR = -4
+MCL_ARGUMENT_ERROR = -6
+MCL_INVALID_AXIS = -7
+MCL_INVALID_HANDLE = -8
+
+
+def _val(x):
+    '''plain python value of a ctypes scalar or byref() argument'''
+    x = getattr(x, '_obj', x)
+    return getattr(x, 'value', x)
+
+
+def _array(ptr, n):
+    '''numpy view of a ctypes double pointer, None for NULL'''
+    if not ptr:
+        return None
+    return np.ctypeslib.as_array(ptr, shape=(n,))
+
+
+class SimAxis(object):
+
+    def __init__(self, cal, settle_tau, nonlinearity=0.0):
+        self.cal = cal
+        self.settle_tau = settle_tau
+        self.nonlinearity = nonlinearity
+        self.t_cmd = 0.0
+        self.start = 0.0
+        self.target = 0.0
+
+    def command(self, pos, t):
+        self.start = self.position(t)
+        self.target = pos
+        self.t_cmd = t
+
+    def response(self, pos):
+        '''static position reached for a command, bowed by nonlinearity*cal/pi'''
+        if not self.nonlinearity:
+            return pos
+        return pos + self.nonlinearity*self.cal/np.pi*np.sin(np.pi*np.asarray(pos)/self.cal)
+
+    def position(self, t):
+        target = self.response(self.target)
+        if self.settle_tau <= 0:
+            return target
+        return target + (self.start - target)*np.exp(-(t - self.t_cmd)/self.settle_tau)
+
+
+class SimNanoDrive(object):
+
+    def __init__(self, serial, cal=(75.0, 75.0, 50.0), settle_tau=0.002,
+                 product_id=0x2203, dac_bits=16, adc_bits=16, firmware_profile=0x0051,
+                 nonlinearity=0.0):
+        self.serial = serial
+        self.axes = [SimAxis(c, settle_tau, nonlinearity) for c in cal]
+        self.product_id = product_id
+        self.dac_bits = dac_bits
+        self.adc_bits = adc_bits
+        self.firmware_profile = firmware_profile
+        self.read_setup = dict()
+        self.load_setup = dict()
+        self.wfma = None
+        self.wfma_adc = None
+        self.iss = dict(bind=dict(), polarity=dict(), level=dict(), pulses=[0, 0, 0, 0])
+        self.detached_until = 0.0 # monotonic time, see SimMadlib.unplug
+
+
+class SimMadlib(object):
+    '''
+    Drop-in replacement for the madlib ctypes library.
+
+    write_latency, read_latency: seconds spent in each single write/read call
+    call_latency: seconds spent in any other device call
+    noise: rms position noise of reads (microns)
+    waveform_time_scale: fraction of real time spent running waveforms
+    nonlinearity: static piezo bow, peak deviation as a fraction of the range/pi
+    '''
+
+    def __init__(self, n_devices=1, serials=None, cal=(75.0, 75.0, 50.0),
+                 write_latency=150e-6, read_latency=250e-6, call_latency=200e-6,
+                 settle_tau=0.002, noise=0.002, waveform_time_scale=1.0, seed=0,
+                 nonlinearity=0.0):
+        if serials is None:
+            serials = [1600 + i for i in range(n_devices)]
+        self.devices = [SimNanoDrive(s, cal=cal, settle_tau=settle_tau, nonlinearity=nonlinearity)
+                        for s in serials]
+        self.write_latency = write_latency
+        self.read_latency = read_latency
+        self.call_latency = call_latency
+        self.noise = noise
+        self.waveform_time_scale = waveform_time_scale
+        self.rng = np.random.RandomState(seed)
+        self.handles = dict()  # handle -> SimNanoDrive
+        self.stale_handles = set() # handles of unplugged devices
+        self._next_handle = 1
+        self._lock = threading.Lock()
+        self.call_count = 0
+
+    # simulation helpers
+
+    def _delay(self, dt):
+        self.call_count += 1
+        if dt > 0:
+            time.sleep(dt)
+
+    def _dev(self, handle):
+        return self.handles.get(_val(handle))
+
+    def _axis(self, dev, axis):
+        axis = _val(axis)
+        if not 1 <= axis <= len(dev.axes):
+            return None
+        return dev.axes[axis-1]
+
+    def _read(self, ax, t=None):
+        if t is None:
+            t = time.monotonic()
+        return float(ax.position(t) + self.noise*self.rng.standard_normal())
+
+    def _grab(self, dev):
+        for h, d in self.handles.items():
+            if d is dev:
+                return h
+        with self._lock:
+            h = self._next_handle
+            self._next_handle += 1
+            self.handles[h] = dev
+        return h
+
+    def _free_devices(self):
+        owned = set(id(d) for d in self.handles.values())
+        now = time.monotonic()
+        return [d for d in self.devices if id(d) not in owned and d.detached_until <= now]
+
+    def _lost(self, handle):
+        # error code for a handle that does not map to a device
+        return MCL_DEV_NOT_ATTACHED if _val(handle) in self.stale_handles else MCL_INVALID_HANDLE
+
+    def unplug(self, serial=None, duration=1.0, power_cycle=False):
+        '''
+        simulate a USB drop: the device's handles go stale and it can only
+        be grabbed again after duration seconds. power_cycle also resets
+        its axes to 0
+        '''
+        dev = self.devices[0] if serial is None else [d for d in self.devices if d.serial == serial][0]
+        dev.detached_until = time.monotonic() + duration
+        for h, d in list(self.handles.items()):
+            if d is dev:
+                del self.handles[h]
+                self.stale_handles.add(h)
+        if power_cycle:
+            for ax in dev.axes:
+                ax.command(0.0, time.monotonic())
+
+    def _run_waveform(self, dev, axis_waveforms, period_ms, adc=None):
+        '''
+        step axes through waveforms, sampling positions into adc arrays
+        '''
+        n = len(next(iter(axis_waveforms.values())))
+        t0 = time.monotonic()
+        period = period_ms*1e-3*self.waveform_time_scale
+        for ax, wf in axis_waveforms.items():
+            ax.command(float(wf[-1]), t0)
+        # ISS: bound clocks pulse before the first and after the last point
+        # of a position waveform, and on every recorded point
+        self._iss_event(dev, 6, 2)
+        if adc:
+            for ax, out in adc.items():
+                wf = axis_waveforms.get(ax)
+                if wf is None:
+                    wf = np.full(n, ax.target)
+                out[:] = ax.response(wf) + self.noise*self.rng.standard_normal(n)
+            self._iss_event(dev, 5, n)
+        time.sleep(n*period)
+
+    def _iss_event(self, dev, event, count=1):
+        bind = dev.iss['bind'].get(event)
+        if bind is not None:
+            dev.iss['pulses'][bind[0]-1] += count
+
+    # driver information
+
+    def MCL_DLLVersion(self, ver, rev):
+        ver._obj.value = 1
+        rev._obj.value = 8
+
+    def MCL_CorrectDriverVersion(self):
+        return True
+
+    # handle management
+
+    def MCL_InitHandle(self):
+        self._delay(self.call_latency)
+        free = self._free_devices()
+        return self._grab(free[0]) if free else 0
+
+    def MCL_InitHandleOrGetExisting(self):
+        h = self.MCL_InitHandle()
+        if not h and self.handles:
+            h = min(self.handles)
+        return h
+
+    def MCL_GrabHandle(self, device):
+        return self.MCL_InitHandle()
+
+    def MCL_GrabHandleOrGetExisting(self, device):
+        return self.MCL_InitHandleOrGetExisting()
+
+    def MCL_GrabAllHandles(self):
+        self._delay(self.call_latency)
+        for dev in self._free_devices():
+            self._grab(dev)
+        return len(self.handles)
+
+    def MCL_GetAllHandles(self, handles, size):
+        size = _val(size)
+        hs = sorted(self.handles)[:size]
+        for i, h in enumerate(hs):
+            handles[i] = h
+        return len(hs)
+
+    def MCL_NumberOfCurrentHandles(self):
+        return len(self.handles)
+
+    def MCL_GetHandleBySerial(self, serial):
+        serial = _val(serial)
+        for h, dev in self.handles.items():
+            if dev.serial == serial:
+                return h
+        return 0
+
+    def MCL_ReleaseHandle(self, handle):
+        self.handles.pop(_val(handle), None)
+
+    def MCL_ReleaseAllHandles(self):
+        self.handles.clear()
+
+    # standard movement
+
+    def MCL_SingleWriteN(self, position, axis, handle):
+        self._delay(self.write_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return self._lost(handle)
+        ax = self._axis(dev, axis)
+        if ax is None:
+            return MCL_INVALID_AXIS
+        pos = _val(position)
+        if not 0 <= pos <= ax.cal:
+            return MCL_ARGUMENT_ERROR
+        ax.command(pos, time.monotonic())
+        return MCL_SUCCESS
+
+    def MCL_SingleReadN(self, axis, handle):
+        self._delay(self.read_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return float(self._lost(handle))
+        ax = self._axis(dev, axis)
+        if ax is None:
+            return float(MCL_INVALID_AXIS)
+        self._iss_event(dev, _val(axis))
+        return self._read(ax)
+
+    def MCL_MonitorN(self, position, axis, handle):
+        ret = self.MCL_SingleWriteN(position, axis, handle)
+        if ret < 0:
+            return float(ret)
+        return self.MCL_SingleReadN(axis, handle)
+
+    def MCL_SingleWriteZ(self, position, handle):
+        return self.MCL_SingleWriteN(position, 3, handle)
+
+    def MCL_SingleReadZ(self, handle):
+        return self.MCL_SingleReadN(3, handle)
+
+    def MCL_MonitorZ(self, position, handle):
+        return self.MCL_MonitorN(position, 3, handle)
+
+    def MCL_GetCommandedPosition(self, x, y, z, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return self._lost(handle)
+        for ref, ax in zip((x, y, z), dev.axes):
+            ref._obj.value = ax.target
+        return MCL_SUCCESS
+
+    # waveforms
+
+    def MCL_Setup_LoadWaveFormN(self, axis, n, milliseconds, waveform, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        if self._axis(dev, axis) is None:
+            return MCL_INVALID_AXIS
+        dev.load_setup[_val(axis)] = (np.array(_array(waveform, _val(n))), _val(milliseconds))
+        return MCL_SUCCESS
+
+    def MCL_Trigger_LoadWaveFormN(self, axis, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        if _val(axis) not in dev.load_setup:
+            return MCL_USAGE_ERROR
+        wf, ms = dev.load_setup[_val(axis)]
+        self._run_waveform(dev, {self._axis(dev, axis): wf}, ms)
+        return MCL_SUCCESS
+
+    def MCL_LoadWaveFormN(self, axis, n, milliseconds, waveform, handle):
+        ret = self.MCL_Setup_LoadWaveFormN(axis, n, milliseconds, waveform, handle)
+        if ret < 0:
+            return ret
+        return self.MCL_Trigger_LoadWaveFormN(axis, handle)
+
+    def MCL_Setup_ReadWaveFormN(self, axis, n, milliseconds, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        if self._axis(dev, axis) is None:
+            return MCL_INVALID_AXIS
+        dev.read_setup[_val(axis)] = (_val(n), _val(milliseconds))
+        return MCL_SUCCESS
+
+    def MCL_Trigger_ReadWaveFormN(self, axis, n, waveform, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        setup = dev.read_setup.get(_val(axis))
+        if setup is None or setup[0] != _val(n):
+            return MCL_USAGE_ERROR
+        ax = self._axis(dev, axis)
+        out = _array(waveform, setup[0])
+        period = setup[1]*1e-3*self.waveform_time_scale
+        t0 = time.monotonic()
+        t = t0 + period*np.arange(setup[0])
+        out[:] = ax.target + (ax.start - ax.target)*np.exp(-(t - ax.t_cmd)/max(ax.settle_tau, 1e-12))
+        out += self.noise*self.rng.standard_normal(setup[0])
+        self._iss_event(dev, 5, setup[0])
+        time.sleep(setup[0]*period)
+        return MCL_SUCCESS
+
+    def MCL_ReadWaveFormN(self, axis, n, milliseconds, waveform, handle):
+        ret = self.MCL_Setup_ReadWaveFormN(axis, n, milliseconds, handle)
+        if ret < 0:
+            return ret
+        return self.MCL_Trigger_ReadWaveFormN(axis, n, waveform, handle)
+
+    def MCL_TriggerWaveformAcquisition(self, axis, n, waveform, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        axis = _val(axis)
+        if axis not in dev.load_setup or axis not in dev.read_setup:
+            return MCL_USAGE_ERROR
+        wf, ms = dev.load_setup[axis]
+        ax = self._axis(dev, axis)
+        self._run_waveform(dev, {ax: wf}, ms, adc={ax: _array(waveform, _val(n))})
+        return MCL_SUCCESS
+
+    def MCL_WfmaSetup(self, wf_x, wf_y, wf_z, n, milliseconds, iterations, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        n = _val(n)
+        wfs = dict()
+        for ax, ptr in zip(dev.axes, (wf_x, wf_y, wf_z)):
+            if ptr:
+                wfs[ax] = np.array(_array(ptr, n))
+        dev.wfma = (wfs, n, _val(milliseconds), _val(iterations))
+        return MCL_SUCCESS
+
+    def MCL_WfmaTrigger(self, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        if dev.wfma is None:
+            return MCL_USAGE_ERROR
+        wfs, n, ms, iterations = dev.wfma
+        dev.wfma_adc = dict((ax, np.empty(n)) for ax in dev.axes)
+        self._run_waveform(dev, wfs, ms, adc=dev.wfma_adc)
+        return MCL_SUCCESS
+
+    def MCL_WfmaRead(self, adc_x, adc_y, adc_z, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        if dev.wfma_adc is None:
+            return MCL_USAGE_ERROR
+        n = dev.wfma[1]
+        for ax, ptr in zip(dev.axes, (adc_x, adc_y, adc_z)):
+            if ptr:
+                _array(ptr, n)[:] = dev.wfma_adc[ax]
+        return MCL_SUCCESS
+
+    def MCL_WfmaTriggerAndRead(self, adc_x, adc_y, adc_z, handle):
+        ret = self.MCL_WfmaTrigger(handle)
+        if ret < 0:
+            return ret
+        return self.MCL_WfmaRead(adc_x, adc_y, adc_z, handle)
+
+    def MCL_WfmaStop(self, handle):
+        self._delay(self.call_latency)
+        return MCL_SUCCESS if self._dev(handle) else MCL_INVALID_HANDLE
+
+    # ISS clocks
+
+    def _iss(self, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        return dev.iss if dev is not None else None
+
+    def _clock_pulse(self, clock, handle):
+        iss = self._iss(handle)
+        if iss is None:
+            return MCL_INVALID_HANDLE
+        iss['pulses'][clock-1] += 1
+        return MCL_SUCCESS
+
+    def MCL_PixelClock(self, handle):
+        return self._clock_pulse(1, handle)
+
+    def MCL_LineClock(self, handle):
+        return self._clock_pulse(2, handle)
+
+    def MCL_FrameClock(self, handle):
+        return self._clock_pulse(3, handle)
+
+    def MCL_AuxClock(self, handle):
+        return self._clock_pulse(4, handle)
+
+    def MCL_IssSetClock(self, clock, mode, handle):
+        iss = self._iss(handle)
+        if iss is None:
+            return MCL_INVALID_HANDLE
+        iss['level'][_val(clock)] = _val(mode)
+        return MCL_SUCCESS
+
+    def MCL_IssBindClockToAxis(self, clock, mode, axis, handle):
+        iss = self._iss(handle)
+        if iss is None:
+            return MCL_INVALID_HANDLE
+        if _val(mode) == 4:
+            iss['bind'].pop(_val(axis), None)
+        else:
+            iss['bind'][_val(axis)] = (_val(clock), _val(mode))
+        return MCL_SUCCESS
+
+    def MCL_IssConfigurePolarity(self, clock, mode, handle):
+        iss = self._iss(handle)
+        if iss is None:
+            return MCL_INVALID_HANDLE
+        iss['polarity'][_val(clock)] = _val(mode)
+        return MCL_SUCCESS
+
+    def MCL_IssResetDefaults(self, handle):
+        iss = self._iss(handle)
+        if iss is None:
+            return MCL_INVALID_HANDLE
+        iss['bind'] = {5: (1, 2), 6: (2, 2)}
+        iss['polarity'] = dict()
+        iss['level'] = dict()
+        return MCL_SUCCESS
+
+    # device information
+
+    def MCL_GetCalibration(self, axis, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return float(MCL_INVALID_HANDLE)
+        ax = self._axis(dev, axis)
+        if ax is None:
+            return float(MCL_INVALID_AXIS)
+        return ax.cal
+
+    def MCL_GetSerialNumber(self, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        return dev.serial if dev is not None else self._lost(handle)
+
+    def MCL_GetProductInfo(self, pi, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        pi = getattr(pi, '_obj', pi)
+        pi.axis_bitmap = (1 << len(dev.axes)) - 1
+        pi.ADC_resolution = dev.adc_bits
+        pi.DAC_resolution = dev.dac_bits
+        pi.Product_id = dev.product_id
+        pi.FirmwareVersion = 1
+        pi.FirmwareProfile = dev.firmware_profile
+        return MCL_SUCCESS
+
+    def MCL_GetFirmwareVersion(self, version, profile, handle):
+        self._delay(self.call_latency)
+        dev = self._dev(handle)
+        if dev is None:
+            return MCL_INVALID_HANDLE
+        version._obj.value = 1
+        profile._obj.value = dev.firmware_profile
+        return MCL_SUCCESS
+
+    def MCL_DeviceAttached(self, milliseconds, handle):
+        # like the DLL, waits the full time either way
+        time.sleep(_val(milliseconds)*1e-3)
+        return self._dev(handle) is not None
+
+    def MCL_PrintDeviceInfo(self, handle):
+        dev = self._dev(handle)
+        if dev is not None:
+            print("SimNanoDrive serial", dev.serial, "axes", len(dev.axes))
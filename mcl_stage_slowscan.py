@@ -1,23 +1,68 @@
-from __future__ import division, print_function
-#import numpy as np
+from __future__ import division, print_function, absolute_import
+import numpy as np
 from ScopeFoundry.scanning import BaseRaster2DSlowScan, BaseRaster2DFrameSlowScan
 #from ScopeFoundry import Measurement, LQRange
+import os
+import sys
 import time
+import hashlib
+import threading
+from .mcl_nanodrive import PROFILE_WAVEFORM, PROFILE_WFMA, PROFILE_ISS, PRIORITY_SCAN, MCLDeviceError
+from .mcl_timing import PhaseTimer
+from .mcl_checkpoint import ScanCheckpoint
+from .mcl_waveform import (waveform_timing, waveform_timing_indexed, line_waveform, pixel_mean,
+                           LOAD_WAVEFORM_MIN_PERIOD_MS, WFMA_MIN_PERIOD_MS, WFMA_MAX_PERIOD_MS)
 
-class MCLStage2DSlowScan(BaseRaster2DSlowScan):
-    
-    name = "MCLStage2DSlowScan"
-    def __init__(self, app):
-        BaseRaster2DSlowScan.__init__(self, app, h_limits=(1,74), v_limits=(1,74),
-                                      h_spinbox_step = 0.1, v_spinbox_step=0.1,
-                                      h_unit="um", v_unit="um")        
+# per pixel timestamps of the scan loop and the phases between them,
+# 'move' includes settling, 'other' is the base scan loop and GUI
+TIMING_STAMPS = ('start', 'moved', 'read', 'collected')
+TIMING_PHASES = ('move', 'readback', 'collect', 'other')
+
+class MCLStageScanMixin(object):
+    '''
+    Stage side of the MCL raster scans, shared by the single frame
+    (BaseRaster2DSlowScan) and frame series (BaseRaster2DFrameSlowScan)
+    scans: stage grid, hysteresis correction, timing, checkpoints and
+    recovery from USB drops. List it before the ScopeFoundry base class.
+    Frame and stack scans can also be resumed in a later run from their
+    checkpoint (Resume_From_Checkpoint); a single frame scan recovers
+    within its run only.
+    '''
     
     def setup(self):
-        BaseRaster2DSlowScan.setup(self)
+        super(MCLStageScanMixin, self).setup()
         
         self.settings.New("h_axis", initial="X", dtype=str, choices=("X", "Y", "Z"))
         self.settings.New("v_axis", initial="Y", dtype=str, choices=("X", "Y", "Z"))
         
+        # h offset added on reverse lines to cancel the forward/reverse
+        # (hysteresis) shift, 'auto' updates it from the position readback
+        self.settings.New("hysteresis_correction", initial="off", dtype=str,
+                          choices=("off", "fixed", "auto"))
+        self.settings.New("reverse_offset", initial=0.0, dtype=float, unit='um',
+                          spinbox_decimals=4, si=False)
+        # line transitions up to this distance are a single write instead of a slow move
+        self.settings.New("fast_line_step", initial=1.0, dtype=float, unit='um', vmin=0,
+                          spinbox_decimals=3, si=False)
+        # ISS clock pulses when the stage reaches each pixel / line / frame,
+        # for detectors that latch on the controller's TTL edges
+        self.settings.New("iss_pulses", initial=False, dtype=bool)
+        # per pixel timing of the scan loop and of the driver calls,
+        # shown as p50/p95 in ms and saved with the scan
+        self.settings.New("timing", initial=False, dtype=bool)
+        self.settings.New("timing_summary", initial="", dtype=str, ro=True)
+        self.timer = None
+        # USB drops (MCLDeviceError.device_lost): reconnect the stage and
+        # repeat the current line, at most max_recoveries times per scan
+        self.settings.New("auto_recover", initial=True, dtype=bool)
+        self.settings.New("max_recoveries", initial=10, dtype=int, vmin=0)
+        self.settings.New("recoveries", initial=0, dtype=int, ro=True)
+        # progress record <save_dir>/<name>_checkpoint.json, see mcl_checkpoint,
+        # updated at line starts but at most every checkpoint_interval
+        self.settings.New("checkpoint", initial=True, dtype=bool)
+        self.settings.New("checkpoint_interval", initial=5.0, dtype=float, unit='s', vmin=0, si=False)
+        self.scan_checkpoint = None
+        
         self.ax_map = dict(X=0, Y=1, Z=2)
         #Hardware
         self.stage = self.app.hardware.mcl_xyz_stage
@@ -40,25 +85,316 @@ class MCLStage2DSlowScan(BaseRaster2DSlowScan):
 
         
     def setup_figure(self):
-        BaseRaster2DSlowScan.setup_figure(self)
-        self.set_details_widget(widget=self.settings.New_UI(include=['h_axis', 'v_axis']))
+        super(MCLStageScanMixin, self).setup_figure()
+        self.set_details_widget(widget=self.settings.New_UI(
+            include=['h_axis', 'v_axis', 'scan_type', 'hysteresis_correction', 'reverse_offset',
+                     'iss_pulses', 'timing', 'timing_summary', 'auto_recover', 'recoveries',
+                     'checkpoint']))
+    
+    def update_display(self):
+        super(MCLStageScanMixin, self).update_display()
+        self.update_timing_summary()
+        
+    def compute_scan_arrays(self):
+        super(MCLStageScanMixin, self).compute_scan_arrays()
+        self.find_reverse_lines()
         
+    def find_reverse_lines(self):
+        '''
+        Sets scan_reverse, True for pixels on lines scanned towards lower h
+        (e.g. every other line of scan_type 'serpentine'), whatever order
+        the scan arrays were computed in.
+        '''
+        h = np.asarray(self.scan_h_positions, dtype=float)
+        v = np.asarray(self.scan_v_positions)
+        line_start = np.ones(len(v), dtype=bool)
+        line_start[1:] = v[1:] != v[:-1]
+        starts = np.flatnonzero(line_start)
+        ends = np.append(starts[1:], len(v)) - 1
+        reverse = h[ends] < h[starts]
+        self.scan_reverse = np.repeat(reverse, ends - starts + 1)
+        
+    def reverse_offset(self):
+        '''h correction applied to reverse lines'''
+        if self.settings['hysteresis_correction'] == 'off':
+            return 0.0
+        return self.settings['reverse_offset']
+    
+    def h_offset(self, pixel_i):
+        '''h correction for a pixel'''
+        reverse = getattr(self, 'scan_reverse', None)
+        if reverse is None or not reverse[pixel_i]:
+            return 0.0
+        return self.reverse_offset()
+    
+    def _update_hysteresis(self, h):
+        # readback - nominal pixel position (without the reverse offset),
+        # per scan direction
+        S = self.settings
+        if S['hysteresis_correction'] != 'auto':
+            return
+        h_read = self.stage.settings[S['h_axis'].lower() + '_position']
+        reverse = int(self.scan_reverse[self.pixel_i])
+        self.hyst_err_sum[reverse] += h_read - h
+        self.hyst_err_n[reverse] += 1
+        
+    def _calibrate_hysteresis(self):
+        # offset that makes reverse readback match forward readback,
+        # estimated from the lines since the last update. The reverse
+        # error includes the offset in use, so the correction goes to
+        # zero once they match; half steps average out readback noise
+        S = self.settings
+        if S['hysteresis_correction'] != 'auto' or min(self.hyst_err_n) < 2:
+            return
+        err_fwd, err_rev = self.hyst_err_sum/self.hyst_err_n
+        S['reverse_offset'] += 0.5*(err_fwd - err_rev)
+        self.hyst_err_sum[:] = 0
+        self.hyst_err_n[:] = 0
+
+    def setup_timing(self):
+        '''
+        allocate the timing arrays for this scan, wrap collect_pixel to
+        timestamp it and turn on driver call timing
+        '''
+        self.timer = None
+        # left over if a subclass skipped finish_timing
+        self.__dict__.pop('collect_pixel', None)
+        if not self.settings['timing']:
+            return
+        # one row per pixel of every frame, frame scans save them all
+        n = self.Npixels*int(self.settings['n_frames'] if hasattr(self.settings, 'n_frames') else 1)
+        self.timer = PhaseTimer(TIMING_STAMPS, n, TIMING_PHASES)
+        self.timing_settle = np.full(n, np.nan)
+        self.stage.nanodrive.enable_call_timing().reset()
+        collect_pixel = self.collect_pixel
+        def timed_collect_pixel(*args):
+            result = collect_pixel(*args)
+            self.timing_stamp(3)
+            return result
+        self.collect_pixel = timed_collect_pixel
+
+    def timing_index(self):
+        '''timer row of the current pixel'''
+        return getattr(self, 'scan_frame_i', 0)*self.Npixels + getattr(self, 'pixel_i', 0)
+
+    def timing_stamp(self, k):
+        if self.timer is not None:
+            self.timer.stamp(self.timing_index(), k)
+
+    def timed_move(self, pixel_i):
+        # stage.write_targets, with the settle time out of nanodrive.settle_stats
+        if self.timer is None:
+            self.stage.write_targets(self.scan_targets, pixel_i)
+            return
+        stats = self.stage.nanodrive.settle_stats
+        n = stats.count
+        self.stage.write_targets(self.scan_targets, pixel_i)
+        self.timing_stamp(1)
+        if stats.count != n:
+            self.timing_settle[self.timing_index()] = stats.last
+
+    def update_timing_summary(self):
+        if self.timer is not None:
+            settle = dict(settle=self.timing_settle)
+            self.settings['timing_summary'] = self.timer.summary(extra=settle)
+
+    def finish_timing(self):
+        '''restore collect_pixel and save the timing table to the h5 file'''
+        if self.timer is None:
+            return
+        self.__dict__.pop('collect_pixel', None)
+        self.update_timing_summary()
+        nd = self.stage.nanodrive
+        if self.settings['save_h5'] and hasattr(self, 'h5_meas_group'):
+            M = self.h5_meas_group
+            M['timing_timestamps'] = self.timer.t
+            M['timing_timestamps'].attrs['columns'] = np.array(TIMING_STAMPS, dtype='S')
+            M['timing_durations'] = self.timer.durations(0, len(self.timer.t))
+            M['timing_durations'].attrs['columns'] = np.array(TIMING_PHASES, dtype='S')
+            M['timing_settle'] = self.timing_settle
+            names, table = nd.call_timer.table()
+            M['timing_calls'] = table
+            M['timing_calls'].attrs['columns'] = np.array(['count', 'total', 'max'], dtype='S')
+            M['timing_calls'].attrs['names'] = np.array(names, dtype='S')
+        nd.enable_call_timing(False)
+        self.timer = None
+
+    def checkpoint_path(self):
+        return os.path.join(self.app.settings['save_dir'], self.name + '_checkpoint.json')
+
+    def setup_checkpoint(self):
+        S = self.settings
+        S['recoveries'] = 0
+        self.scan_checkpoint = None
+        if not S['checkpoint']:
+            return
+        h5_file = getattr(self, 'h5_file', None) if S['save_h5'] else None
+        self.scan_checkpoint = ScanCheckpoint(self.checkpoint_path(), S['checkpoint_interval'],
+                                              h5_file, **self.checkpoint_info())
+        self.checkpoint_line(force=True)
+
+    def checkpoint_info(self):
+        '''fixed part of the checkpoint record'''
+        info = dict(measurement=self.name, Npixels=int(self.Npixels))
+        if hasattr(self.settings, 'n_frames'):
+            info['n_frames'] = int(self.settings['n_frames'])
+        return info
+
+    def checkpoint_state(self):
+        '''
+        frame_i and pixel_i: first line not known to be complete, all
+        pixels before it are in the h5 file
+        '''
+        return dict(frame_i=int(getattr(self, 'scan_frame_i', 0)),
+                    pixel_i=self.line_start(getattr(self, 'pixel_i', 0)),
+                    recoveries=self.settings['recoveries'])
+
+    def checkpoint_line(self, force=False):
+        if self.scan_checkpoint is not None:
+            self.scan_checkpoint.update(force, **self.checkpoint_state())
+
+    def resume_state(self):
+        '''last checkpoint record of an unfinished run, None if there is none'''
+        state = ScanCheckpoint.load(self.checkpoint_path())
+        if state is None or state['status'] == 'finished':
+            print("{}: nothing to resume".format(self.name))
+            return None
+        return state
+
+    def finish_checkpoint(self):
+        '''last record: finished, interrupted or failed (called from post_scan_cleanup)'''
+        if self.scan_checkpoint is None:
+            return
+        err = sys.exc_info()[1]
+        if err is not None:
+            status = 'failed'
+        elif self.interrupt_measurement_called:
+            status = 'interrupted'
+        else:
+            status = 'finished'
+        self.scan_checkpoint.update(True, status, error=repr(err) if err is not None else '',
+                                    **self.checkpoint_state())
+        self.scan_checkpoint = None
+
+    def line_start(self, pixel_i):
+        '''first pixel of the line pixel_i is on'''
+        starts = np.flatnonzero(self.scan_slow_move[:pixel_i+1])
+        return int(starts[-1]) if len(starts) else 0
+
+    def line_end(self, pixel_i):
+        '''first pixel after the line pixel_i is on'''
+        starts = np.flatnonzero(self.scan_slow_move[pixel_i+1:])
+        return pixel_i + 1 + int(starts[0]) if len(starts) else self.Npixels
+
+    def with_recovery(self, move, *args):
+        '''
+        run a stage move. If a controller drops off the bus, reconnect
+        (stage.recover_connection), scan the current line again up to
+        pixel_i and retry: pixels collected just before the drop may
+        have been taken while the stage was already lost
+        '''
+        S = self.settings
+        replay = False
+        while True:
+            try:
+                if replay:
+                    self.replay_line()
+                return move(*args)
+            except MCLDeviceError as err:
+                if not (err.device_lost and S['auto_recover'] and S['recoveries'] < S['max_recoveries']):
+                    raise
+                S['recoveries'] += 1
+                print("{}: {} at pixel {}, reconnecting".format(self.name, err, self.pixel_i))
+                self.stage.recover_connection()
+                self.checkpoint_line(force=True)
+                replay = True
+
+    def replay_line(self):
+        '''move through and collect the pixels of the current line before pixel_i again'''
+        i = self.pixel_i
+        i0 = self.line_start(i)
+        try:
+            for p in range(i0, i):
+                self.pixel_i = p
+                if p == i0:
+                    self.move_position_start(self.scan_h_positions[p], self.scan_v_positions[p])
+                else:
+                    self.move_pixel(p)
+                kk, jj, ii = self.scan_index_array[p]
+                self._collect(p, kk, jj, ii)
+        finally:
+            self.pixel_i = i
+
+    def setup_stage_grid(self):
+        '''
+        stage positions of all pixels, converted with the stage transform
+        and bounds checked in one go before anything moves, and the
+        commands written per pixel (update_scan_targets)
+        '''
+        S = self.settings
+        T = self.stage.transform
+        self.scan_fixed = self.stage.sample_position()
+        xyz = np.tile(self.scan_fixed, (self.Npixels, 1))
+        xyz[:, self.ax_map[S['h_axis']]] = self.scan_h_positions
+        xyz[:, self.ax_map[S['v_axis']]] = self.scan_v_positions
+        self.scan_stage_pos = T.to_stage(xyz)
+        self.scan_h_dir = T.direction(S['h_axis'])
+        # only channels that move are written per pixel
+        self.scan_groups = T.groups_for(T.affected(self.scan_axes()))
+        self.scan_stage_check = self.scan_stage_pos + \
+            np.outer(self.scan_reverse*self.reverse_offset(), self.scan_h_dir)
+        T.validate(self.scan_stage_check)
+        self.update_scan_targets()
+
+    def update_scan_targets(self, i0=0, i1=None):
+        '''
+        scan_targets (see StageTransform.targets) of pixels i0..i1 of the
+        current frame: converted and linearized in one call per controller,
+        pixel moves write a row of them
+        '''
+        T = self.stage.transform
+        if i0 == 0 and i1 is None:
+            self.scan_targets = T.targets(self.scan_grid(), self.scan_groups)
+            # reverse_offset each row was computed with
+            self.scan_targets_offset = np.full(self.Npixels, self.reverse_offset())
+            return
+        rows = slice(i0, i1)
+        for old, new in zip(self.scan_targets, T.targets(self.scan_grid(rows), self.scan_groups)):
+            old[2][rows] = new[2]
+            old[3][rows] = new[3]
+        self.scan_targets_offset[rows] = self.reverse_offset()
+
+    def scan_axes(self):
+        '''sample axes moved by the pixel writes'''
+        S = self.settings
+        return [S['h_axis'], S['v_axis']]
+
+    def scan_grid(self, pixels=slice(None)):
+        '''stage positions (n, n_channels) of pixels of the current frame, with the h correction'''
+        offset = self.scan_reverse[pixels]*self.reverse_offset()
+        return self.scan_stage_pos[pixels] + np.outer(offset, self.scan_h_dir)
 
     def pre_scan_setup(self):
-        BaseRaster2DSlowScan.pre_scan_setup(self)
-        if hasattr(self.app.settings, 'open_shutter_before_scan'):
-            if self.app.settings.open_shutter_before_scan.val:
-                self.app.hardware.shutter_servo.settings['shutter_open'] = True
-                time.sleep(0.5)
-                
+        super(MCLStageScanMixin, self).pre_scan_setup()
+        recorder = self.stage.recorder
+        if recorder is not None and recorder.running and recorder.mode == 'wfma':
+            # its hold waveforms would pull the stage back and replace ours
+            raise IOError("the 'wfma' position recorder is running, stop it or use recorder_mode 'read'")
+        self.hyst_err_sum = np.zeros(2)
+        self.hyst_err_n = np.zeros(2, dtype=int)
+        self.setup_stage_grid()
+        self.setup_timing()
+        self.scan_frame_i = 0
+        self.setup_checkpoint()
+        # pauses the stage's position polling
+        self.stage.scan_owner = self
                 
     def post_scan_cleanup(self):
-        if hasattr(self.app.settings, 'close_shutter_after_scan'):
-            if self.app.settings.close_shutter_after_scan.val:
-                self.app.hardware.shutter_servo.settings['shutter_open'] = False  
-            
+        self.stage.scan_owner = None
+        self.finish_timing()
+        self.finish_checkpoint()
+        super(MCLStageScanMixin, self).post_scan_cleanup()
 
-        
 
     def move_position_start(self, h,v):
         #self.stage.y_position.update_value(x)
@@ -66,34 +402,108 @@ class MCLStage2DSlowScan(BaseRaster2DSlowScan):
         
         S = self.settings
         
-        coords = [None, None, None]
-        coords[self.ax_map[S['h_axis']]] = h
-        coords[self.ax_map[S['v_axis']]] = v
+        # driver calls from the scan thread go ahead of GUI polling
+        self.stage.nanodrive.set_io_priority(PRIORITY_SCAN)
+        
+        coords = self.scan_coords(h + self.h_offset(getattr(self, 'pixel_i', 0)), v)
         
         #self.stage.move_pos_slow(x,y,None)
         self.stage.move_pos_slow(*coords)
         self.stage.settings.x_position.read_from_hardware()
         self.stage.settings.y_position.read_from_hardware()
         self.stage.settings.z_position.read_from_hardware()
+        if getattr(self, 'pixel_i', 0) == 0:
+            self.iss_pulse('frame')
+    
+    def scan_coords(self, h, v):
+        '''stage [x, y, z] for scan position h, v, None for axes not moved'''
+        S = self.settings
+        coords = [None, None, None]
+        coords[self.ax_map[S['h_axis']]] = h
+        coords[self.ax_map[S['v_axis']]] = v
+        return coords
+    
+    def iss_pulse(self, clock):
+        if self.settings['iss_pulses']:
+            self.stage.nanodrive.iss_pulse(clock)
     
     def move_position_slow(self, h,v, dh,dv):
-        self.move_position_start(h, v)
+        self._calibrate_hysteresis()
+        if self.reverse_offset() != self.scan_targets_offset[self.pixel_i]:
+            # the auto correction changed the offset, redo this line's targets
+            self.update_scan_targets(self.pixel_i, self.line_end(self.pixel_i))
+        self.checkpoint_line()
+        self.iss_pulse('line')
+        if self.is_short_line_step(h, v):
+            self.move_position_fast(h, v, dh, dv)
+        else:
+            self.timing_stamp(0)
+            self.with_recovery(self.move_position_start, h, v)
+            self.timing_stamp(2)
+            self.iss_pulse('pixel')
+            
+    def is_short_line_step(self, h, v):
+        '''
+        True if the stage is this close to the start of the next line
+        that a single write does it (serpentine line to line steps)
+        '''
+        i = getattr(self, 'pixel_i', 0)
+        if i == 0:
+            return False
+        step = max(abs(h - self.scan_h_positions[i-1]), abs(v - self.scan_v_positions[i-1]))
+        return step <= self.settings['fast_line_step']
 
     def move_position_fast(self,  h,v, dh,dv):
         #self.stage.x_position.update_value(x)
         S = self.settings        
-        coords = [None, None, None]
-        coords[self.ax_map[S['h_axis']]] = h
-        coords[self.ax_map[S['v_axis']]] = v
-        self.stage.move_pos_fast(*coords)
+        self.timing_stamp(0)
+        self.with_recovery(self.move_pixel, self.pixel_i)
         #self.stage.move_pos_fast(x, y, None)
         #self.current_stage_pos_arrow.setPos(x, y)
+        self.timing_stamp(2)
+        self._update_hysteresis(h)
+        self.iss_pulse('pixel')
+
+    def move_pixel(self, pixel_i):
+        '''fast move to a pixel and read back the position'''
+        self.timed_move(pixel_i)
         self.stage.settings.x_position.read_from_hardware()
         self.stage.settings.y_position.read_from_hardware()
         self.stage.settings.z_position.read_from_hardware()
         
     
-class MCLStage2DFrameSlowScan(BaseRaster2DFrameSlowScan):
+class MCLStage2DSlowScan(MCLStageScanMixin, BaseRaster2DSlowScan):
+    '''
+    Single frame raster scan. USB drops are recovered within the run, a
+    scan that stopped cannot be resumed in a later run: the base scan
+    loop always starts at the first pixel.
+    '''
+    
+    name = "MCLStage2DSlowScan"
+    def __init__(self, app):
+        BaseRaster2DSlowScan.__init__(self, app, h_limits=(1,74), v_limits=(1,74),
+                                      h_spinbox_step = 0.1, v_spinbox_step=0.1,
+                                      h_unit="um", v_unit="um")        
+    
+    def pre_scan_setup(self):
+        MCLStageScanMixin.pre_scan_setup(self)
+        if hasattr(self.app.settings, 'open_shutter_before_scan'):
+            if self.app.settings.open_shutter_before_scan.val:
+                self.app.hardware.shutter_servo.settings['shutter_open'] = True
+                time.sleep(0.5)
+                
+    def post_scan_cleanup(self):
+        MCLStageScanMixin.post_scan_cleanup(self)
+        if hasattr(self.app.settings, 'close_shutter_after_scan'):
+            if self.app.settings.close_shutter_after_scan.val:
+                self.app.hardware.shutter_servo.settings['shutter_open'] = False  
+            
+    def _collect(self, pixel_i, k, j, i):
+        # collect_pixel of a replayed pixel, see replay_line
+        self.collect_pixel(pixel_i, k, j, i)
+            
+    
+class MCLStage2DFrameSlowScan(MCLStageScanMixin, BaseRaster2DFrameSlowScan):
     
     name = "MCLStage2DFrameSlowScan"
     
@@ -101,43 +511,195 @@ class MCLStage2DFrameSlowScan(BaseRaster2DFrameSlowScan):
         BaseRaster2DFrameSlowScan.__init__(self, app, h_limits=(0,75), v_limits=(0,75), h_unit="um", v_unit="um")        
     
     def setup(self):
-        MCLStage2DSlowScan.setup(self)
+        MCLStageScanMixin.setup(self)
+        self.add_operation('Resume_From_Checkpoint', self.resume_from_checkpoint)
 
-    def move_position_start(self, h,v):
-        MCLStage2DSlowScan.move_position_start(self, h, v)
-    
-    def move_position_slow(self, h,v, dh,dv):
-        MCLStage2DSlowScan.move_position_slow(self, h,v, dh,dv)
+    def resume_from_checkpoint(self):
+        '''
+        set n_frames to the frames a stopped scan did not finish, from its
+        checkpoint. The frames before it are in the h5 file named in the
+        checkpoint, the new run saves the rest to a new file.
+        '''
+        state = self.resume_state()
+        if state is None:
+            return
+        self.settings['n_frames'] = state['n_frames'] - state['frame_i']
+        print("{}: resuming at frame {} of {}, earlier frames in {}".format(
+            self.name, state['frame_i'], state['n_frames'], state.get('h5_file')))
         
-    def move_position_fast(self,  h,v, dh,dv):
-        MCLStage2DSlowScan.move_position_fast(self,  h,v, dh,dv)
-    
-    def on_new_stage_limits(self):
-        MCLStage2DSlowScan.on_new_stage_limits(self)
+    def on_new_frame(self, frame_i):
+        self.scan_frame_i = frame_i
+        self.pixel_i = 0
+        self.checkpoint_line(force=True)
+        
+    def _collect(self, pixel_i, k, j, i):
+        # frame scans pass the frame to collect_pixel
+        self.collect_pixel(pixel_i, self.scan_frame_i, k, j, i)
         
         
 class MCLStage3DStackSlowScan(MCLStage2DFrameSlowScan):
+    '''
+    Stack of 2D frames along stack_axis.
+    
+    stack_mode:
+        'sequential' moves to each plane in on_new_frame
+        'pipelined' starts the move to the next plane, together with the
+            flyback to the first pixel, at the end of each frame so that it
+            overlaps with the frame being processed and saved
+        'continuous' (focus sweep) moves the stack axis with every pixel,
+            from plane i towards plane i+1 during frame i
+    '''
     
     def setup(self):
         MCLStage2DFrameSlowScan.setup(self)
         
         self.settings.New("stack_axis", initial="Z", dtype=str, choices=("X", "Y", "Z"))
         self.settings.New_Range('stack', dtype=float)
+        self.settings.New("stack_mode", initial="sequential", dtype=str,
+                          choices=("sequential", "pipelined", "continuous"))
         
         self.settings.stack_num.add_listener(self.settings.n_frames.update_value, int)
         
-    def on_new_frame(self, frame_i):
+    def stack_planes(self):
+        '''
+        (start, end) positions of the planes from the settings, raises
+        ValueError for settings that cannot be scanned
+        '''
         S = self.settings
-        stack_range = S.ranges['stack']
+        if S['stack_axis'] in (S['h_axis'], S['v_axis']):
+            raise ValueError("stack_axis must differ from h_axis and v_axis")
+        z = np.array(S.ranges['stack'].array, dtype=float)
+        if len(z) < S['n_frames']:
+            raise ValueError("stack has {} planes for {} frames".format(len(z), S['n_frames']))
+        z = z[:S['n_frames']]
+        # continuous mode sweeps frame i from z[i] to z_end[i]
+        dz = np.diff(z) if len(z) > 1 else np.zeros(1)
+        z_end = z + np.append(dz, dz[-1])
+        z_max = self.stage.settings[S['stack_axis'].lower() + '_max']
+        check = np.concatenate([z, z_end]) if S['stack_mode'] == 'continuous' else z
+        if not np.all(np.isfinite(check)) or check.min() < 0 or check.max() > z_max:
+            raise ValueError("stack positions outside of 0..{} um".format(z_max))
+        return z, z_end
         
-        stack_pos_i = stack_range.array[frame_i]
-        coords = [None, None, None]
-        coords[self.ax_map[S['stack_axis']]] = stack_pos_i
+    def pre_scan_setup(self):
+        # settings and planes are checked before the parent takes the
+        # stage; if this raises, run() still calls post_scan_cleanup
+        self.stack_positions = None
+        z, z_end = self.stack_planes()
+        S = self.settings
+        self.stack_positions = z
+        self.stack_end_positions = z_end
+        self.stack_ax = S['stack_axis']
+        self.stack_dir = self.stage.transform.direction(self.stack_ax)
+        self.stack_move = None
+        self.stack_frame_i = 0
+        MCLStage2DFrameSlowScan.pre_scan_setup(self)
+        # planes are known only now, the first frame's record has them
+        if self.scan_checkpoint is not None:
+            self.scan_checkpoint.info.update(stack_axis=self.stack_ax, stack_mode=S['stack_mode'],
+                                             stack_positions=[float(zi) for zi in z])
+    
+    def scan_axes(self):
+        return MCLStage2DFrameSlowScan.scan_axes(self) + [self.stack_ax]
+
+    def setup_stage_grid(self):
+        MCLStage2DFrameSlowScan.setup_stage_grid(self)
+        # the pixel grid is at the current stack position, planes are
+        # added along the stack direction; the grid is affine in z so
+        # checking the lowest and highest plane covers all of them
+        S = self.settings
+        z, z_end = self.stack_positions, self.stack_end_positions
+        z0 = self.scan_fixed[self.ax_map[self.stack_ax]]
+        check = np.concatenate([z, z_end]) if S['stack_mode'] == 'continuous' else z
+        for zc in (check.min(), check.max()):
+            self.stage.transform.validate(self.scan_stage_check + (zc - z0)*self.stack_dir)
+
+    def post_scan_cleanup(self):
+        S = self.settings
+        if self.stack_positions is not None and S['save_h5'] and hasattr(self, 'h5_meas_group'):
+            self.h5_meas_group['stack_positions'] = self.stack_positions
+            if S['stack_mode'] == 'continuous':
+                self.h5_meas_group['stack_end_positions'] = self.stack_end_positions
+        MCLStage2DFrameSlowScan.post_scan_cleanup(self)
+    
+    def stack_z(self, pixel_i):
+        '''stack axis position of a pixel (or array of pixels) in the current frame'''
+        i = self.stack_frame_i
+        if self.settings['stack_mode'] != 'continuous':
+            return self.stack_positions[i]
+        f = pixel_i/self.Npixels
+        return self.stack_positions[i] + f*(self.stack_end_positions[i] - self.stack_positions[i])
+    
+    def scan_coords(self, h, v):
+        coords = MCLStage2DFrameSlowScan.scan_coords(self, h, v)
+        if self.settings['stack_mode'] == 'continuous':
+            coords[self.ax_map[self.stack_ax]] = self.stack_z(getattr(self, 'pixel_i', 0))
+        return coords
+    
+    def scan_grid(self, pixels=slice(None)):
+        z = self.stack_z(np.arange(self.Npixels)[pixels])
+        z0 = self.scan_fixed[self.ax_map[self.stack_ax]]
+        return MCLStage2DFrameSlowScan.scan_grid(self, pixels) + np.outer(z - z0, self.stack_dir)
+    
+    def _start_stack_move(self, frame_i):
+        # next plane and first pixel in one background slow move
+        coords = self.scan_coords(self.scan_h_positions[0] + self.h_offset(0),
+                                  self.scan_v_positions[0])
+        coords[self.ax_map[self.stack_ax]] = self.stack_positions[frame_i]
+        moves = []
+        for drive, pos in self.stage.group_by_drive(*coords).items():
+            moves.append(drive.move_slow(*pos))
+        self.stack_move = (frame_i, moves)
         
-        self.stage.move_pos_slow(*coords)
-        self.stage.settings.x_position.read_from_hardware()
-        self.stage.settings.y_position.read_from_hardware()
-        self.stage.settings.z_position.read_from_hardware()
+    def on_end_frame(self, frame_i):
+        if self.settings['stack_mode'] == 'pipelined' and frame_i + 1 < len(self.stack_positions):
+            self._start_stack_move(frame_i + 1)
+        
+    def on_new_frame(self, frame_i):
+        MCLStage2DFrameSlowScan.on_new_frame(self, frame_i)
+        self.stack_frame_i = frame_i
+        if frame_i > 0:
+            # the pixel targets of this plane, in one go
+            self.update_scan_targets()
+        self.with_recovery(self._move_to_plane, frame_i)
+        self.stage.poll_positions()
+        
+    def _move_to_plane(self, frame_i):
+        S = self.settings
+        if S['stack_mode'] == 'sequential':
+            coords = [None, None, None]
+            coords[self.ax_map[S['stack_axis']]] = self.stack_positions[frame_i]
+            self.stage.move_pos_slow(*coords)
+        else:
+            if self.stack_move is None or self.stack_move[0] != frame_i:
+                # first frame (or no on_end_frame call): start it now
+                self._start_stack_move(frame_i)
+            # a failed move is started again on retry
+            moves = self.stack_move[1]
+            self.stack_move = None
+            for move in moves:
+                move.wait()
+            for drive in self.stage.drives:
+                drive.settle()
+        
+    def resume_from_checkpoint(self):
+        '''
+        set the stack range to the planes a stopped stack did not finish,
+        from its checkpoint. The frames before it are in the h5 file named
+        in the checkpoint, the new run saves the rest to a new file.
+        '''
+        state = self.resume_state()
+        if state is None:
+            return
+        z = state['stack_positions'][state['frame_i']:]
+        S = self.settings
+        S['stack_axis'] = state['stack_axis']
+        S['stack_mode'] = state['stack_mode']
+        S['stack_num'] = len(z)
+        S['stack_min'] = z[0]
+        S['stack_max'] = z[-1]
+        print("{}: resuming at plane {} of {} ({} um), earlier planes in {}".format(
+            self.name, state['frame_i'], len(state['stack_positions']), z[0], state.get('h5_file')))
         
 
 
@@ -157,12 +719,294 @@ class Delay_MCL_2DSlowScan(MCLStage2DSlowScan):
     def collect_pixel(self, pixel_num, k, j, i):
         time.sleep(self.settings['pixel_time'])
         
-    def post_scan_cleanup(self):
-        pass
-        
     def update_display(self):
         #MCLStage2DSlowScan.update_display(self)
         self.stage.settings.x_position.read_from_hardware()
         self.stage.settings.y_position.read_from_hardware()
         if self.stage.nanodrive.num_axes > 2:
-            self.stage.settings.z_position.read_from_hardware()
\ No newline at end of file
+            self.stage.settings.z_position.read_from_hardware()
+
+
+class MCLWaveformScanMixin(object):
+    '''
+    Hardware-timed stepping of MCLStage2DWaveformScan, on top of a
+    MCLStageScanMixin scan class
+    '''
+
+    def setup(self):
+        super(MCLWaveformScanMixin, self).setup()
+        self.settings.New("waveform_mode", initial="line", dtype=str, choices=("line", "frame"))
+        self.settings.New("waveform_period", initial=0.0, dtype=float, ro=True,
+                          unit='ms', spinbox_decimals=4)
+        self.settings.New("waveform_oversample", initial=1, dtype=int, ro=True)
+        self.settings.New("record_positions", initial=True, dtype=bool)
+        self.settings.New("hardware_gated", initial=False, dtype=bool)
+        # waveform uploads of the last scan, setups identical to the loaded
+        # one are only triggered again (MCLNanoDrive.skip_redundant_uploads)
+        self.settings.New("waveform_uploads", initial=0, dtype=int, ro=True)
+        # built and linearized waveforms, kept across scans until the scan
+        # coordinates, timing or linearization change
+        self.wf_cache = dict()
+        self.wf_cache_key = None
+        self.wf_cache_lmap = None
+
+    def setup_figure(self):
+        super(MCLWaveformScanMixin, self).setup_figure()
+        self.set_details_widget(widget=self.settings.New_UI(
+            include=['h_axis', 'v_axis', 'waveform_mode', 'waveform_period', 'waveform_oversample',
+                     'record_positions', 'hardware_gated', 'waveform_uploads']))
+
+    def pre_scan_setup(self):
+        super(MCLWaveformScanMixin, self).pre_scan_setup()
+        self.setup_waveforms()
+
+    def setup_waveforms(self):
+        S = self.settings
+        nd = self.stage.nanodrive
+
+        # waveforms run per controller axis: h and v must each map to one
+        # axis of this controller (no sample rotation or skew)
+        T = self.stage.transform
+        ch_h, self.wf_h_scale, self.wf_h_offset = T.axis_map(S['h_axis'])
+        ch_v, self.wf_v_scale, self.wf_v_offset = T.axis_map(S['v_axis'])
+        if T.channels[ch_h][0] is not nd or T.channels[ch_v][0] is not nd:
+            raise ValueError("waveform scans need h_axis and v_axis on the same controller")
+        self.wf_h_axis = T.channels[ch_h][1]
+        self.wf_v_axis = T.channels[ch_v][1]
+
+        if S['hardware_gated']:
+            if not nd.has_profile(PROFILE_ISS):
+                raise IOError("Nano-Drive has no Image Scan Sync option, cannot run hardware gated")
+            # the pixel clock is driven by the position recording
+            S['record_positions'] = True
+            self.stage.settings['iss_pixel_bind'] = 'waveform_read'
+            self.stage.settings['iss_line_bind'] = 'waveform_write'
+
+        # pixel index of the start of each line
+        slow = np.array(self.scan_slow_move, dtype=bool)
+        slow[0] = True
+        self.wf_line_bounds = np.append(np.flatnonzero(slow), self.Npixels)
+
+        if S['waveform_mode'] == 'frame':
+            if not nd.has_profile(PROFILE_WFMA):
+                raise IOError("Nano-Drive firmware does not support multi-axis waveforms")
+            if nd.dac_bits == 20:
+                self.wf_period_arg, period_ms, oversample = waveform_timing_indexed(S['pixel_time'])
+            else:
+                period_ms, oversample = waveform_timing(S['pixel_time'], WFMA_MIN_PERIOD_MS,
+                                                        WFMA_MAX_PERIOD_MS)
+                self.wf_period_arg = period_ms
+            if 2*self.Npixels*oversample > nd.waveform_max_points():
+                raise ValueError("frame too large for a hardware waveform, use waveform_mode='line'")
+        else:
+            if not nd.has_profile(PROFILE_WAVEFORM):
+                raise IOError("Nano-Drive firmware does not support waveforms")
+            period_ms, oversample = waveform_timing(S['pixel_time'],
+                                                    LOAD_WAVEFORM_MIN_PERIOD_MS[nd.dac_bits])
+            self.wf_period_arg = period_ms
+            max_line = np.diff(self.wf_line_bounds).max()
+            if max_line*oversample > nd.waveform_max_points():
+                raise ValueError("line too long for a hardware waveform: {} points".format(
+                                 max_line*oversample))
+
+        S['waveform_period'] = period_ms
+        S['waveform_oversample'] = oversample
+        # actual pixel time on the controller clock
+        self.wf_pixel_time = period_ms*oversample*1e-3
+        self.wf_thread = None
+        self.wf_t0 = time.monotonic()
+        self.wf_i0 = 0
+        self.wf_next_line_start = 0
+        self.wf_pending = None
+
+        # readback buffers are allocated once per scan, the driver writes
+        # straight into slices of them
+        self.wf_h_readback = np.full(self.Npixels, np.nan)
+        self.wf_v_readback = np.full(self.Npixels, np.nan)
+        if S['record_positions']:
+            if S['waveform_mode'] == 'frame':
+                self.wf_samples = np.zeros((3, self.Npixels*oversample))
+            else:
+                self.wf_samples = np.zeros(self.Npixels*oversample)
+
+        key = hashlib.sha1()
+        for a in (self.scan_h_positions, self.scan_v_positions, self.scan_reverse):
+            key.update(np.ascontiguousarray(a).tobytes())
+        key.update(repr((S['h_axis'], S['v_axis'], S['waveform_mode'], oversample, self.wf_period_arg,
+                         self.wf_h_axis, self.wf_v_axis, self.wf_h_scale, self.wf_h_offset,
+                         self.wf_v_scale, self.wf_v_offset, self.reverse_offset())).encode())
+        if key.digest() != self.wf_cache_key or nd.linearization is not self.wf_cache_lmap:
+            self.wf_cache = dict()
+            self.wf_cache_key = key.digest()
+            self.wf_cache_lmap = nd.linearization
+        self.wf_upload_count0 = nd.upload_count
+
+    def _wf_cached(self, key, build):
+        wf = self.wf_cache.get(key)
+        if wf is None:
+            wf = self.wf_cache[key] = build()
+        return wf
+
+    def _wf_frame(self):
+        # corrected for the linearization once, uploaded raw
+        o = self.settings['waveform_oversample']
+        h = self.scan_h_positions + self.scan_reverse*self.reverse_offset()
+        h = self.wf_h_scale*h + self.wf_h_offset
+        v = self.wf_v_scale*self.scan_v_positions + self.wf_v_offset
+        return self.stage.nanodrive.linearize({self.wf_h_axis: line_waveform(h, o),
+                                               self.wf_v_axis: line_waveform(v, o)})
+
+    def _wf_coords(self, h, v):
+        coords = [None, None, None]
+        coords[self.ax_map[self.settings['h_axis']]] = h
+        coords[self.ax_map[self.settings['v_axis']]] = v
+        return coords
+
+    def _wf_wait_done(self):
+        if self.wf_thread is not None:
+            self.wf_thread.join()
+            self.wf_thread = None
+        if self.wf_pending is not None:
+            i0, i1 = self.wf_pending
+            self.wf_pending = None
+            o = self.settings['waveform_oversample']
+            if self.settings['waveform_mode'] == 'frame':
+                samples = self.stage.nanodrive.wfma_read(self.wf_samples)
+                self.wf_h_readback[:] = pixel_mean(samples[self.wf_h_axis-1], o)
+                self.wf_v_readback[:] = pixel_mean(samples[self.wf_v_axis-1], o)
+                self.wf_h_readback[:] = (self.wf_h_readback - self.wf_h_offset)/self.wf_h_scale
+                self.wf_v_readback[:] = (self.wf_v_readback - self.wf_v_offset)/self.wf_v_scale
+            else:
+                h = pixel_mean(self.wf_samples[i0*o:i1*o], o)
+                self.wf_h_readback[i0:i1] = (h - self.wf_h_offset)/self.wf_h_scale
+                self.wf_v_readback[i0:i1] = self.scan_v_positions[i0:i1]
+
+    def _wf_fire(self, trigger_func, i0, i1):
+        self._wf_wait_done()
+        # the trigger call may block until the waveform is done,
+        # run it off the scan thread so collect_pixel can proceed
+        self.wf_thread = threading.Thread(target=trigger_func, name='mcl_waveform')
+        self.wf_thread.daemon = True
+        self.wf_t0 = time.monotonic()
+        self.wf_i0 = i0
+        if self.settings['record_positions']:
+            self.wf_pending = (i0, i1)
+        self.wf_thread.start()
+
+    def _wf_pace(self):
+        deadline = self.wf_t0 + (self.pixel_i - self.wf_i0)*self.wf_pixel_time
+        dt = deadline - time.monotonic()
+        if dt > 0:
+            time.sleep(dt)
+
+    def iss_pulse(self, clock):
+        if self.settings['hardware_gated'] and clock == 'frame':
+            self.stage.nanodrive.iss_pulse(clock)
+
+    def move_position_start(self, h, v):
+        self._wf_wait_done()
+        super(MCLWaveformScanMixin, self).move_position_start(h, v)
+        if self.settings['waveform_mode'] == 'frame':
+            nd = self.stage.nanodrive
+            # repeated frames: the driver skips the upload, only the trigger goes out
+            nd.wfma_setup(self._wf_cached('frame', self._wf_frame), self.wf_period_arg, iterations=1,
+                          raw=True)
+            self._wf_fire(nd.wfma_trigger, 0, self.Npixels)
+
+    def move_position_slow(self, h, v, dh, dv):
+        if self.settings['waveform_mode'] == 'frame':
+            self._wf_pace()
+            return
+        self._wf_wait_done()
+        self.checkpoint_line()
+        nd = self.stage.nanodrive
+        i0 = self.pixel_i
+        i1 = self.wf_line_bounds[np.searchsorted(self.wf_line_bounds, i0, side='right')]
+        h_offset = self.h_offset(i0)
+        if i0 > 0:
+            # line start pixel 0 was already reached by move_position_start
+            if self.is_short_line_step(h, v):
+                self.stage.write_targets(self.scan_targets, i0)
+            else:
+                self.stage.move_pos_slow(*self._wf_coords(h + h_offset, v))
+        self.wf_next_line_start = i1
+        def build():
+            # the stage is at the line start, v of this line for the cross-axis terms
+            h_line = self.wf_h_scale*(self.scan_h_positions[i0:i1] + h_offset) + self.wf_h_offset
+            wf = line_waveform(h_line, self.settings['waveform_oversample'])
+            return nd.linearize({self.wf_h_axis: wf})[self.wf_h_axis]
+        wf = self._wf_cached(('line', i0, h_offset), build)
+        nd.setup_load_waveform_ax(wf, self.wf_h_axis, self.wf_period_arg, raw=True)
+        if self.settings['record_positions']:
+            o = self.settings['waveform_oversample']
+            nd.setup_read_waveform_ax(self.wf_h_axis, len(wf), self.wf_period_arg)
+            out = self.wf_samples[i0*o:i1*o]
+            self._wf_fire(lambda: nd.trigger_waveform_acquisition(self.wf_h_axis, out), i0, i1)
+        else:
+            self._wf_fire(lambda: nd.trigger_load_waveform_ax(self.wf_h_axis), i0, i1)
+
+    def move_position_fast(self, h, v, dh, dv):
+        if self.settings['waveform_mode'] == 'line' and self.pixel_i == self.wf_next_line_start:
+            # line started without a slow move (eg. first pixel of the scan)
+            self.move_position_slow(h, v, dh, dv)
+            return
+        self.timing_stamp(0)
+        self._wf_pace()
+        self.timing_stamp(1)
+        self.timing_stamp(2)
+
+    def post_scan_cleanup(self):
+        try:
+            self.finish_waveforms()
+        finally:
+            super(MCLWaveformScanMixin, self).post_scan_cleanup()
+
+    def finish_waveforms(self):
+        self._wf_wait_done()
+        nd = self.stage.nanodrive
+        if self.settings['waveform_mode'] == 'frame':
+            nd.wfma_stop()
+        self.settings['waveform_uploads'] = nd.upload_count - self.wf_upload_count0
+        if self.settings['record_positions'] and self.settings['save_h5'] \
+                and hasattr(self, 'h5_meas_group'):
+            self.h5_meas_group['h_readback'] = self.wf_h_readback
+            self.h5_meas_group['v_readback'] = self.wf_v_readback
+
+
+class MCLStage2DWaveformScan(MCLWaveformScanMixin, MCLStage2DSlowScan):
+    """
+    Raster scan where the stage is stepped by the Nano-Drive's own clock.
+
+    In "line" mode each line is uploaded with MCL_Setup_LoadWaveFormN on the
+    h axis and fired with MCL_Trigger_LoadWaveFormN; in "frame" mode the
+    whole frame is uploaded as a multi-axis waveform (MCL_WfmaSetup).
+    move_position_fast does no USB traffic, it only waits for the pixel's
+    deadline relative to the waveform start so that collect_pixel stays in
+    step with the stage.
+
+    With record_positions the controller also samples the stage position
+    during each waveform, giving per-pixel true positions in
+    wf_h_readback / wf_v_readback (scan order, like scan_h_positions).
+
+    With hardware_gated the ISS pixel clock is bound to the position
+    recording (waveform_oversample edges per pixel) and the line clock to
+    the waveform start/end, so detectors can latch on the controller's
+    edges instead of the timing of collect_pixel.
+    """
+
+    name = "MCLStage2DWaveformScan"
+
+
+class MCLStage2DFrameWaveformScan(MCLWaveformScanMixin, MCLStage2DFrameSlowScan):
+    """
+    Repeated frames (n_frames) of MCLStage2DWaveformScan.
+
+    The frame ("frame" mode) or line ("line" mode) waveforms are built once
+    and uploaded with the first frame; later frames only move back to the
+    first pixel and trigger the setup already on the controller, as long as
+    the waveforms are unchanged (MCLNanoDrive.skip_redundant_uploads).
+    In "line" mode this holds for lines that repeat, all lines of a
+    scan without a reverse line correction (scan_type 'raster').
+    """
+
+    name = "MCLStage2DFrameWaveformScan"
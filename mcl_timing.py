@@ -0,0 +1,103 @@
+'''
+Low overhead timing of the slow scan loop
+
+PhaseTimer keeps one row of time.perf_counter() timestamps per pixel in an
+array allocated before the scan, so recording a phase is a single store.
+Phase durations and percentiles are only computed when displayed or saved.
+'''
+from __future__ import division, print_function, absolute_import
+from collections import OrderedDict
+import time
+import numpy as np
+
+
+class PhaseTimer(object):
+
+    def __init__(self, stamps, n, phases=None):
+        '''
+        stamps: names of the timestamps taken for each pixel, in order
+        n: number of pixels
+        phases: names of the durations between consecutive stamps, the last
+                one runs to the first stamp of the next pixel
+        '''
+        self.stamps = tuple(stamps)
+        self.phases = tuple(phases or stamps)
+        assert len(self.phases) == len(self.stamps)
+        self.t = np.full((n, len(self.stamps)), np.nan)
+        self.last_i = -1
+
+    def stamp(self, i, k):
+        self.t[i, k] = time.perf_counter()
+        self.last_i = i
+
+    def durations(self, i0=0, i1=None):
+        '''(n, n_phases) seconds spent in each phase, NaN where not recorded'''
+        if i1 is None:
+            i1 = self.last_i + 1
+        t = self.t[i0:i1+1]
+        d = np.full((i1 - i0, len(self.phases)), np.nan)
+        if len(d):
+            d[:, :-1] = np.diff(t[:len(d)], axis=1)
+            d[:len(t)-1, -1] = t[1:, 0] - t[:len(t)-1, -1]
+        return d
+
+    def percentiles(self, q=(50, 95, 99), window=1000, extra=None):
+        '''
+        OrderedDict phase -> percentiles (s) over the last `window` pixels.
+        extra: dict name -> (n,) per pixel durations to include
+        '''
+        i1 = self.last_i + 1
+        i0 = max(0, i1 - window)
+        d = self.durations(i0, i1)
+        result = OrderedDict()
+        columns = list(zip(self.phases, d.T))
+        for name, values in (extra or {}).items():
+            columns.append((name, values[i0:i1]))
+        for name, values in columns:
+            values = values[np.isfinite(values)]
+            if len(values):
+                result[name] = np.percentile(values, q)
+        return result
+
+    def summary(self, q=(50, 95), **kwargs):
+        '''one line text summary in ms'''
+        parts = []
+        for name, p in self.percentiles(q, **kwargs).items():
+            parts.append("{} {}".format(name, "/".join("{:.2f}".format(1e3*x) for x in p)))
+        return " | ".join(parts)
+
+
+class CallTimer(object):
+    '''
+    count, total and max time of wrapped calls, keyed by function name
+    '''
+
+    def __init__(self):
+        self.stats = OrderedDict() # name -> [count, total s, max s]
+
+    def wrap(self, func):
+        name = getattr(func, '__name__', repr(func))
+        def timed(*args):
+            t0 = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.record(name, time.perf_counter() - t0)
+        return timed
+
+    def record(self, name, dt):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += dt
+        if dt > stats[2]:
+            stats[2] = dt
+
+    def reset(self):
+        self.stats.clear()
+
+    def table(self):
+        '''(names, (n, 3) array of count, total s, max s)'''
+        names = list(self.stats.keys())
+        return names, np.array([self.stats[name] for name in names], dtype=float).reshape(-1, 3)
@@ -0,0 +1,151 @@
+'''
+Velocity / acceleration (and optionally jerk) limited point-to-point
+trajectories for multi-axis piezo moves.
+
+All axes follow one normalized profile s(t) going from 0 to 1, scaled by each
+axis' displacement, so the move is a straight line in position space and every
+axis finishes at the same time. The profile is a trapezoid in velocity, and
+with a jerk limit it is smoothed by a moving average of width a/j, which turns
+the acceleration steps into ramps (S-curve). Positions are evaluated in
+closed form for the whole time grid in one pass.
+'''
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+
+class Trajectory(object):
+    '''
+    t: (n,) time of each point relative to the start of the move (s)
+    positions: (n, n_axes) commanded position at each point
+    dt: time between points (s)
+    '''
+
+    def __init__(self, t, positions, dt, duration):
+        self.t = t
+        self.positions = positions
+        self.dt = dt
+        self.duration = duration
+
+    def __len__(self):
+        return len(self.t)
+
+
+def _broadcast(x, n):
+    return np.broadcast_to(np.asarray(x, dtype=float), (n,))
+
+
+def profile_limits(distance, max_speed, max_accel, max_jerk=None):
+    '''
+    Limits of the normalized profile s(t) such that every axis, moving
+    |distance[i]|, stays within its own limits.
+
+    returns (speed, accel, jerk) for s, jerk is None without a jerk limit
+    '''
+    d = np.abs(np.asarray(distance, dtype=float))
+    n = len(d)
+    moving = d > 0
+    d = d[moving]
+    vs = np.min(_broadcast(max_speed, n)[moving]/d)
+    as_ = np.min(_broadcast(max_accel, n)[moving]/d)
+    js = None
+    if max_jerk is not None:
+        js = np.min(_broadcast(max_jerk, n)[moving]/d)
+    return vs, as_, js
+
+
+def _trapezoid_timing(vs, as_):
+    t_acc = vs/as_
+    if vs*t_acc >= 1.0:
+        # never reaches full speed: triangular profile
+        t_acc = np.sqrt(1.0/as_)
+        return t_acc, as_*t_acc, 2*t_acc
+    return t_acc, vs, 1.0/vs + t_acc
+
+
+def _trapezoid_s(t, t_acc, vpk, T, as_):
+    t = np.clip(t, 0, T)
+    return np.where(t < t_acc, 0.5*as_*t**2,
+                    np.where(t <= T - t_acc, 0.5*as_*t_acc**2 + vpk*(t - t_acc),
+                             1.0 - 0.5*as_*(T - t)**2))
+
+
+def _trapezoid_s_integral(t, t_acc, vpk, T, as_):
+    '''integral of s from 0 to t, s=0 before the move and s=1 after it'''
+    tc = np.clip(t, 0, T)
+    r = T - tc
+    P = np.where(tc < t_acc, as_*tc**3/6,
+                 np.where(tc <= T - t_acc,
+                          as_*t_acc**3/6 + 0.5*as_*t_acc**2*(tc - t_acc) + 0.5*vpk*(tc - t_acc)**2,
+                          0.5*T - (r - as_*r**3/6)))
+    return P + np.maximum(t - T, 0)
+
+
+def normalized_profile(t, vs, as_, js=None):
+    '''
+    s(t) at times t for a profile with speed, accel (and jerk) limits
+    vs, as_, js. returns (s, duration)
+    '''
+    t_acc, vpk, T = _trapezoid_timing(vs, as_)
+    if js is None:
+        return _trapezoid_s(t, t_acc, vpk, T, as_), T
+    tj = as_/js
+    P1 = _trapezoid_s_integral(t, t_acc, vpk, T, as_)
+    P0 = _trapezoid_s_integral(t - tj, t_acc, vpk, T, as_)
+    return (P1 - P0)/tj, T + tj
+
+
+def profile_duration(vs, as_, js=None):
+    T = _trapezoid_timing(vs, as_)[2]
+    if js is not None:
+        T += as_/js
+    return T
+
+
+def choose_dt(duration, peak_speed, max_step, min_dt, max_dt, max_points=None):
+    '''
+    Step period: small enough that no step exceeds max_step (microns) at
+    peak speed, within [min_dt, max_dt], and long enough to stay under
+    max_points for the whole move.
+    '''
+    if peak_speed > 0:
+        dt = max_step/peak_speed
+    else:
+        dt = max_dt
+    dt = min(max(dt, min_dt), max_dt)
+    if max_points is not None:
+        dt = max(dt, duration/max_points)
+    return dt
+
+
+def plan_move(start, end, max_speed, max_accel, max_jerk=None, dt=None,
+              max_step=0.1, min_dt=0.001, max_dt=0.050, max_points=None):
+    '''
+    Plan a straight line move from start to end (arrays, one entry per axis)
+
+    max_speed, max_accel, max_jerk: per axis limits (scalar or array),
+        microns/s, microns/s^2, microns/s^3. max_jerk=None for a trapezoidal
+        velocity profile.
+    dt: fixed time between points, otherwise chosen with choose_dt from
+        max_step, min_dt, max_dt and max_points
+
+    The returned points start one dt after the move starts and the last point
+    is exactly `end`.
+    '''
+    start = np.atleast_1d(np.asarray(start, dtype=float))
+    end = np.atleast_1d(np.asarray(end, dtype=float))
+    delta = end - start
+    if not np.any(delta):
+        return Trajectory(np.zeros(1), end[None, :].copy(), dt or min_dt, 0.0)
+
+    vs, as_, js = profile_limits(delta, max_speed, max_accel, max_jerk)
+    duration = profile_duration(vs, as_, js)
+    if dt is None:
+        peak = min(vs, np.sqrt(as_))*np.max(np.abs(delta))
+        dt = choose_dt(duration, peak, max_step, min_dt, max_dt, max_points)
+
+    n = max(1, int(np.ceil(duration/dt)))
+    t = dt*np.arange(1, n+1)
+    s, _ = normalized_profile(t, vs, as_, js)
+    s[-1] = 1.0
+    positions = start[None, :] + s[:, None]*delta[None, :]
+    return Trajectory(t, positions, dt, duration)
@@ -0,0 +1,172 @@
+'''
+Sample to stage coordinate transform.
+
+StageTransform maps sample coordinates (x, y, z in um) to the positions of
+the controller channels in one affine step:
+
+    stage = sample @ matrix.T + offset
+
+The matrix folds together the sample rotation and skew and the
+xyz_axis_map permutation (a channel per controller axis, in controller axis
+order), so whole scan grids are converted and bounds checked with a single
+array operation and a pixel move is an indexed write of a precomputed row.
+'''
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+
+def sample_matrix(rotation=0.0, skew=0.0):
+    '''
+    (3, 3) linear part in sample axes: skew shears x along y (deg),
+    rotation turns the xy plane about z (deg, counterclockwise)
+    '''
+    r, s = np.deg2rad(rotation), np.deg2rad(skew)
+    R = np.array([[np.cos(r), -np.sin(r), 0], [np.sin(r), np.cos(r), 0], [0, 0, 1]])
+    S = np.array([[1, np.tan(s), 0], [0, 1, 0], [0, 0, 1]])
+    return R.dot(S)
+
+
+class StageTransform(object):
+
+    def __init__(self, channels, axis_channel, limits, rotation=0.0, skew=0.0, offset=(0, 0, 0)):
+        '''
+        channels: list of (drive, axis id), one per stage channel, grouped by drive
+        axis_channel: dict 'X'/'Y'/'Z' -> channel index the sample axis drives
+        limits: (n_channels,) upper position limit of each channel (um)
+        offset: stage position (um) of the sample origin, per sample axis
+        '''
+        self.channels = list(channels)
+        self.axis_channel = dict(axis_channel)
+        self.limits = np.asarray(limits, dtype=float)
+        n = len(self.channels)
+        A = sample_matrix(rotation, skew)
+        self.matrix = np.zeros((n, 3))
+        self.offset = np.zeros(n)
+        for a, name in enumerate('XYZ'):
+            c = self.axis_channel.get(name)
+            if c is not None:
+                self.matrix[c] = A[a]
+                self.offset[c] = offset[a]
+        self.inverse = np.linalg.pinv(self.matrix)
+        self.groups = self.groups_for(np.ones(n, dtype=bool))
+
+    def groups_for(self, mask):
+        '''
+        [(drive, channel indices, axis ids)] for the channels in mask,
+        precompute once for writes that only touch some channels
+        '''
+        groups = []
+        for c in np.flatnonzero(mask):
+            drive, axis = self.channels[c]
+            if not groups or groups[-1][0] is not drive:
+                groups.append((drive, [], []))
+            groups[-1][1].append(c)
+            groups[-1][2].append(axis)
+        return [(drive, np.array(idx), tuple(axes)) for drive, idx, axes in groups]
+
+    @property
+    def axis_aligned(self):
+        '''True if each sample axis drives a single channel'''
+        nz = self.matrix != 0
+        return bool(np.all(nz.sum(axis=0) <= 1) and np.all(nz.sum(axis=1) <= 1))
+
+    def to_stage(self, sample):
+        '''(..., 3) sample positions -> (..., n_channels) stage positions'''
+        return np.asarray(sample, dtype=float).dot(self.matrix.T) + self.offset
+
+    def to_sample(self, stage):
+        '''(..., n_channels) stage positions -> (..., 3) sample positions'''
+        return (np.asarray(stage, dtype=float) - self.offset).dot(self.inverse.T)
+
+    def direction(self, axis):
+        '''(n_channels,) stage change per um along sample axis 'X', 'Y' or 'Z' '''
+        return self.matrix[:, 'XYZ'.index(axis)].copy()
+
+    def affected(self, axes):
+        '''channel mask of the channels that move with any of the sample axes'''
+        cols = ['XYZ'.index(a) for a in axes]
+        return np.any(self.matrix[:, cols] != 0, axis=1)
+
+    def axis_map(self, axis):
+        '''
+        (channel, scale, offset) of a sample axis that drives a single
+        channel: stage = scale*sample + offset
+        '''
+        col = self.matrix[:, 'XYZ'.index(axis)]
+        nz = np.flatnonzero(col)
+        if len(nz) != 1 or np.count_nonzero(self.matrix[nz[0]]) != 1:
+            raise ValueError("sample axis {} is not aligned with a stage axis".format(axis))
+        c = nz[0]
+        return c, col[c], self.offset[c]
+
+    def validate(self, stage, mask=None):
+        '''
+        raise ValueError unless all (..., n_channels) positions are in
+        range, only the channels in mask if given
+        '''
+        stage = np.asarray(stage, dtype=float)
+        bad = ~np.isfinite(stage) | (stage < 0) | (stage > self.limits)
+        if mask is not None:
+            bad &= mask
+        if np.any(bad):
+            idx = np.argwhere(bad)[0]
+            c = idx[-1]
+            raise ValueError("{} stage positions out of range, first at {}: channel {} (axis {}) = {} "
+                             "not in 0..{} um".format(int(bad.sum()), tuple(int(k) for k in idx[:-1]), int(c),
+                                                      self.channels[c][1], stage[tuple(idx)],
+                                                      self.limits[c]))
+
+    def targets(self, stage, groups=None):
+        '''
+        [(drive, axis ids, positions, raw)] per controller of groups for
+        validated (N, n_channels) stage positions: positions (N, n_axes)
+        and raw, the commands after the drive's linearization, corrected
+        for all N rows in one call (see MCLNanoDrive.linearize). Row i is
+        written with write_targets.
+        '''
+        if groups is None:
+            groups = self.groups
+        targets = []
+        for drive, idx, axes in groups:
+            pos = np.ascontiguousarray(np.asarray(stage, dtype=float)[:, idx])
+            raw = drive.linearize(dict(zip(axes, pos.T)))
+            raw = np.column_stack([raw[axis] for axis in axes])
+            targets.append((drive, axes, pos, raw))
+        return targets
+
+    def write_targets(self, targets, i):
+        '''
+        write row i of targets (see targets), no per-call conversion or
+        correction, and settle. Controllers are written in parallel.
+        '''
+        if len(targets) == 1:
+            drive, axes, pos, raw = targets[0]
+            drive.write_axes(axes, pos[i], raw[i])
+            return
+        futures = []
+        for drive, axes, pos, raw in targets:
+            futures += drive.write_axes_async(axes, pos[i], raw[i])
+        for future in futures:
+            future.result()
+        for drive, axes, pos, raw in targets:
+            drive.settle()
+
+    def write(self, stage, groups=None):
+        '''
+        write validated stage positions (n_channels,), all channels or those
+        of groups (see groups_for), and settle. Controllers are written in
+        parallel.
+        '''
+        if groups is None:
+            groups = self.groups
+        if len(groups) == 1:
+            drive, idx, axes = groups[0]
+            drive.write_axes(axes, stage[idx])
+            return
+        futures = []
+        for drive, idx, axes in groups:
+            futures += drive.write_axes_async(axes, stage[idx])
+        for future in futures:
+            future.result()
+        for drive, idx, axes in groups:
+            drive.settle()
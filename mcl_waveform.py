@@ -0,0 +1,94 @@
+'''
+Helpers to build Nano-Drive waveforms from scan coordinate arrays.
+
+Limits are taken from the MadLib 1.8 manual (Waveform Acquisition section).
+'''
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+
+# max number of points in a single waveform, keyed by DAC resolution (bits)
+WAVEFORM_MAX_POINTS = {16: 10000, 20: 6666}
+
+# allowed time between waveform points (ms) for MCL_(Setup_)LoadWaveFormN
+LOAD_WAVEFORM_MIN_PERIOD_MS = {16: 1/30., 20: 1/6.}
+LOAD_WAVEFORM_MAX_PERIOD_MS = 5.0
+
+# multi-axis (Wfma) waveforms, 16 bit systems take a period in ms
+WFMA_MIN_PERIOD_MS = 1/10.
+WFMA_MAX_PERIOD_MS = 5.0
+
+# 20 bit systems take an index into a table of periods instead of a time
+PERIOD_INDEX_20BIT = {3: 0.267, 4: 0.5, 5: 1.0, 6: 2.0, 7: 10.0, 8: 17.0, 9: 20.0}
+WFMA_PERIOD_INDICES_20BIT = (3, 4, 5, 6)
+
+
+def waveform_timing(pixel_time, min_period_ms, max_period_ms=LOAD_WAVEFORM_MAX_PERIOD_MS):
+    '''
+    Split a pixel dwell time (seconds) into waveform points.
+
+    returns (period_ms, oversample) where each pixel is held for
+    `oversample` consecutive points spaced by `period_ms`
+    '''
+    pixel_ms = pixel_time*1e3
+    oversample = max(1, int(np.ceil(pixel_ms/max_period_ms)))
+    period_ms = pixel_ms/oversample
+    if period_ms < min_period_ms:
+        raise ValueError("pixel_time {:g} s is shorter than the minimum waveform period {:g} ms".format(
+                         pixel_time, min_period_ms))
+    return period_ms, oversample
+
+
+def waveform_timing_indexed(pixel_time, indices=WFMA_PERIOD_INDICES_20BIT):
+    '''
+    Like waveform_timing, for 20 bit controllers where the period must be one
+    of the entries of PERIOD_INDEX_20BIT.
+
+    returns (period_index, period_ms, oversample), choosing the table entry
+    that best reproduces pixel_time
+    '''
+    pixel_ms = pixel_time*1e3
+    best = None
+    for index in indices:
+        period_ms = PERIOD_INDEX_20BIT[index]
+        oversample = max(1, int(round(pixel_ms/period_ms)))
+        err = abs(oversample*period_ms - pixel_ms)
+        if best is None or err < best[0]:
+            best = (err, index, period_ms, oversample)
+    return best[1:]
+
+
+def period_index_20bit(period_ms, indices=None):
+    '''
+    nearest PERIOD_INDEX_20BIT entry for a period in ms
+    '''
+    if indices is None:
+        indices = sorted(PERIOD_INDEX_20BIT)
+    return min(indices, key=lambda i: abs(PERIOD_INDEX_20BIT[i] - period_ms))
+
+
+def line_waveform(positions, oversample=1, out=None):
+    '''
+    Hold each position for `oversample` waveform points.
+    '''
+    positions = np.asarray(positions, dtype=np.float64)
+    if out is None:
+        out = np.empty(len(positions)*oversample, dtype=np.float64)
+    out.reshape(len(positions), oversample)[:, :] = positions[:, None]
+    return out
+
+
+def check_waveform_limits(waveform, low, high):
+    waveform = np.asarray(waveform)
+    if waveform.size and (waveform.min() < low or waveform.max() > high):
+        raise ValueError("waveform out of range [{:g}, {:g}]: [{:g}, {:g}]".format(
+                         low, high, waveform.min(), waveform.max()))
+
+
+def pixel_mean(samples, oversample):
+    '''
+    Average groups of `oversample` waveform samples back down to one value per pixel
+    '''
+    samples = np.asarray(samples)
+    n = samples.shape[-1]//oversample
+    return samples[..., :n*oversample].reshape(samples.shape[:-1] + (n, oversample)).mean(axis=-1)
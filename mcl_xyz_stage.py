@@ -5,12 +5,23 @@ Created on Jul 27, 2014
 '''
 from __future__ import absolute_import, print_function, division
 from ScopeFoundry import HardwareComponent
+from .mcl_linearize import LinearizationMap, calibrate_sensor_sweep
+from .mcl_transform import StageTransform
+from .mcl_device_cache import DeviceInfoCache
+from .mcl_server import MCLStageServer, DEFAULT_ADDRESS
 try:
-    from .mcl_nanodrive import MCLNanoDrive
+    from .mcl_nanodrive import MCLNanoDrive, PRIORITY_POLL, PROFILE_ISS
+    from .mcl_device_pool import MCLDevicePool
+    from .mcl_recorder import MCLPositionRecorder, H5PositionSink
+    from .mcl_client import MCLStageClient
+    from .mcl_async import AsyncStage
 except Exception as err:
     print("Cannot load required modules for MclXYZStage:", err)
 from qtpy import QtCore
+from collections import OrderedDict
+import threading
 import time
+import numpy as np
 
 
 class MclXYZStageHW(HardwareComponent):
@@ -53,11 +64,45 @@ class MclXYZStageHW(HardwareComponent):
         self.h_axis = self.add_logged_quantity("h_axis", initial="X", **lq_params)
         self.v_axis = self.add_logged_quantity("v_axis", initial="Y", **lq_params)
         
+        # serial number of the controller driving each axis, 0 for the
+        # first one found. Axes on different controllers are moved in parallel.
+        lq_params = dict(dtype=int, initial=0, vmin=0, vmax=32767)
+        self.x_serial = self.add_logged_quantity('x_serial', **lq_params)
+        self.y_serial = self.add_logged_quantity('y_serial', **lq_params)
+        self.z_serial = self.add_logged_quantity('z_serial', **lq_params)
+        
         self.MCL_AXIS_ID = dict(X = 2, Y = 1, Z = 3)
         self.xyz_axis_map = self.add_logged_quantity('xyz_axis_map', dtype=str, initial='213')
         self.xyz_axis_map.updated_value.connect(self.on_update_xyz_axis_map)
         
         
+        # 'sim' runs against the in-process simulator (mcl_sim.SimMadlib)
+        self.backend = self.add_logged_quantity('backend', dtype=str, initial='madlib',
+                                                choices=('madlib', 'sim'))
+        self.sim_kwargs = dict()
+        # empty: MCL_MADLIB_PATH or the default install location
+        self.madlib_path = self.add_logged_quantity('madlib_path', dtype=str, initial='')
+        # fast reconnect: keep the device handles on disconnect, and take product
+        # info / calibration from the on-disk cache (checked in the background)
+        self.keep_handle = self.add_logged_quantity('keep_handle', dtype=bool, initial=True)
+        self.device_cache = self.add_logged_quantity('device_cache', dtype=bool, initial=True)
+        self.connect_time = self.add_logged_quantity('connect_time', dtype=float, ro=True, initial=0,
+                                                     unit='ms', spinbox_decimals=1, si=False)
+        self._sim_backend = None
+        self._sim_cache = None
+        # USB drops: how long recover_connection keeps retrying, and how often it had to
+        self.reconnect_timeout = self.add_logged_quantity('reconnect_timeout', dtype=float, initial=60.0,
+                                                          unit='s', vmin=0, si=False)
+        self.reconnect_count = self.add_logged_quantity('reconnect_count', dtype=int, ro=True, initial=0)
+        # sharing the stage with other processes (mcl_server): 'client' uses the
+        # server at server_address, 'host' connects directly and serves there
+        self.server_mode = self.add_logged_quantity('server_mode', dtype=str, initial='direct',
+                                                    choices=('direct', 'client', 'host'))
+        self.server_address = self.add_logged_quantity('server_address', dtype=str,
+                                                       initial=DEFAULT_ADDRESS)
+        self.stage_server = None
+        self._async_stage = None
+
         self.move_speed = self.add_logged_quantity(name='move_speed',
                                                              initial = 100.0,
                                                              unit = "um/s",
@@ -66,13 +111,127 @@ class MclXYZStageHW(HardwareComponent):
                                                              si = False,
                                                              dtype=float)        
         
+        self.move_accel = self.add_logged_quantity(name='move_accel',
+                                                   initial = 1000.0,
+                                                   unit = "um/s^2",
+                                                   vmin = 1e-2,
+                                                   vmax = 1e6,
+                                                   si = False,
+                                                   dtype=float)
+        # 'waveform' uploads slow moves to the controller in one go when possible
+        self.slow_move_mode = self.add_logged_quantity('slow_move_mode', dtype=str, initial='stream',
+                                                       choices=('stream', 'waveform'))
+        
+        # position cache, see MCLNanoDrive.get_pos_ax / set_pos_ax
+        self.read_max_age = self.add_logged_quantity('read_max_age', dtype=float, initial=0.0,
+                                                     unit='s', vmin=0, spinbox_decimals=4, si=False)
+        self.skip_redundant_writes = self.add_logged_quantity('skip_redundant_writes', dtype=bool,
+                                                              initial=True)
+        
+        # waiting for the stage to arrive after fast moves, see MCLNanoDrive.settle
+        self.settle_mode = self.add_logged_quantity('settle_mode', dtype=str, initial='off',
+                                                    choices=('off', 'poll', 'model'))
+        self.settle_tolerance = self.add_logged_quantity('settle_tolerance', dtype=float, initial=0.02,
+                                                         unit='um', vmin=0, spinbox_decimals=4, si=False)
+        self.settle_timeout = self.add_logged_quantity('settle_timeout', dtype=float, initial=0.1,
+                                                       unit='s', vmin=0, spinbox_decimals=4, si=False)
+        lq_params = dict(dtype=float, ro=True, initial=0, unit='ms', spinbox_decimals=3, si=False)
+        self.settle_time_last = self.add_logged_quantity('settle_time_last', **lq_params)
+        self.settle_time_mean = self.add_logged_quantity('settle_time_mean', **lq_params)
+        self.settle_count = self.add_logged_quantity('settle_count', dtype=int, ro=True, initial=0)
+        self.settle_timeouts = self.add_logged_quantity('settle_timeouts', dtype=int, ro=True, initial=0)
+        
+        # Image Scan Sync TTL clocks (controller of the X axis): event each
+        # clock is bound to, the defaults are the controller's reset state
+        events = ('none', 'X', 'Y', 'Z', 'aux', 'waveform_read', 'waveform_write')
+        self.iss_pixel_bind = self.add_logged_quantity('iss_pixel_bind', dtype=str,
+                                                       initial='waveform_read', choices=events)
+        self.iss_line_bind = self.add_logged_quantity('iss_line_bind', dtype=str,
+                                                      initial='waveform_write', choices=events)
+        self.iss_frame_bind = self.add_logged_quantity('iss_frame_bind', dtype=str,
+                                                       initial='none', choices=events)
+        self.iss_aux_bind = self.add_logged_quantity('iss_aux_bind', dtype=str,
+                                                     initial='none', choices=events)
+        self.iss_polarity = self.add_logged_quantity('iss_polarity', dtype=str, initial='rising',
+                                                     choices=('rising', 'falling'))
+        for lq in [self.iss_pixel_bind, self.iss_line_bind, self.iss_frame_bind,
+                   self.iss_aux_bind, self.iss_polarity]:
+            lq.add_listener(self.apply_iss_bindings)
+        
+        # continuous position recording, see mcl_recorder. Other measurements
+        # can use self.recorder.ring / add_listener while it runs
+        self.recorder = None
+        self.recorder_active = self.add_logged_quantity('recorder_active', dtype=bool, initial=False)
+        self.recorder_axes = self.add_logged_quantity('recorder_axes', dtype=str, initial='XY')
+        self.recorder_mode = self.add_logged_quantity('recorder_mode', dtype=str, initial='read',
+                                                      choices=('read', 'wfma'))
+        self.recorder_period = self.add_logged_quantity('recorder_period', dtype=float, initial=1.0,
+                                                        unit='ms', vmin=0.034, vmax=5.0,
+                                                        spinbox_decimals=3, si=False)
+        self.recorder_block = self.add_logged_quantity('recorder_block', dtype=int, initial=200,
+                                                       vmin=1, vmax=10000)
+        self.recorder_ring_seconds = self.add_logged_quantity('recorder_ring_seconds', dtype=float,
+                                                              initial=60.0, unit='s', vmin=0.1)
+        # empty: ring buffer only. *.h5 appends all samples to that file,
+        # anything else backs the ring buffer with a memory mapped file
+        self.recorder_file = self.add_logged_quantity('recorder_file', dtype=str, initial='')
+        self.recorder_active.add_listener(self.on_recorder_active)
+        
+        # position polling in threaded_update: poll_fast while moving and for
+        # about poll_decay after the last activity, then backing off to poll_idle
+        lq_params = dict(dtype=float, unit='s', vmin=0.001, spinbox_decimals=3, si=False)
+        self.poll_fast = self.add_logged_quantity('poll_fast', initial=0.02, **lq_params)
+        self.poll_idle = self.add_logged_quantity('poll_idle', initial=1.0, **lq_params)
+        self.poll_decay = self.add_logged_quantity('poll_decay', initial=2.0, **lq_params)
+        self.poll_during_scan = self.add_logged_quantity('poll_during_scan', dtype=str,
+                                                         initial='pause',
+                                                         choices=('pause', 'throttle'))
+        # position logged quantities are only updated by more than this
+        self.poll_deadband = self.add_logged_quantity('poll_deadband', dtype=float, initial=0.002,
+                                                      unit='um', vmin=0, spinbox_decimals=4, si=False)
+        # sample coordinates used by move_pos_* and the scans: stage =
+        # rotation/skew of the sample xy + offset, see mcl_transform.
+        # x/y/z_target and _position are stage (piezo) coordinates
+        self.transform = None
+        self._device_info_changes = []
+        lq_params = dict(dtype=float, initial=0.0, unit='deg', spinbox_decimals=4, si=False)
+        self.sample_rotation = self.add_logged_quantity('sample_rotation', **lq_params)
+        self.sample_skew = self.add_logged_quantity('sample_skew', vmin=-45, vmax=45, **lq_params)
+        lq_params = dict(dtype=float, initial=0.0, unit='um', spinbox_decimals=3, si=False)
+        self.sample_x_offset = self.add_logged_quantity('sample_x_offset', **lq_params)
+        self.sample_y_offset = self.add_logged_quantity('sample_y_offset', **lq_params)
+        self.sample_z_offset = self.add_logged_quantity('sample_z_offset', **lq_params)
+        for lq in [self.sample_rotation, self.sample_skew, self.sample_x_offset,
+                   self.sample_y_offset, self.sample_z_offset]:
+            lq.add_listener(self.update_transform)
+        
+        # piezo linearization tables, one mcl_linearization_<serial>.npz per
+        # controller in linearization_dir, see mcl_linearize
+        self.linearization = self.add_logged_quantity('linearization', dtype=bool, initial=False)
+        self.linearization_dir = self.add_logged_quantity('linearization_dir', dtype=str, initial='')
+        self.linearization_status = self.add_logged_quantity('linearization_status', dtype=str,
+                                                             initial='', ro=True)
+        self.linearization.add_listener(self.apply_linearization)
+        self.linearization_dir.add_listener(self.apply_linearization)
+        
+        # measurement currently driving the stage, set by the scans
+        self.scan_owner = None
+        self._last_activity = time.monotonic()
+        self._poll_wake = threading.Event()
+        
         # connect logged quantities together
+        self.x_target.add_listener(self.mark_activity)
+        self.y_target.add_listener(self.mark_activity)
+        self.z_target.add_listener(self.mark_activity)
         self.x_target.add_listener(self.read_pos)
         self.y_target.add_listener(self.read_pos)
         self.z_target.add_listener(self.read_pos)
         
         # Actions
         self.add_operation('GOTO_Center_XY', self.go_to_center_xy)
+        self.add_operation('Stop_Motion', self.stop_motion)
+        self.add_operation('Reset_Settle_Model', self.reset_settle_model)
+        self.add_operation('Calibrate_Linearization', self.calibrate_linearization)
         
     def on_update_xyz_axis_map(self):
         print("on_update_xyz_axis_map")
@@ -80,92 +239,260 @@ class MclXYZStageHW(HardwareComponent):
         self.MCL_AXIS_ID['X'] = int(map_str[0])
         self.MCL_AXIS_ID['Y'] = int(map_str[1])
         self.MCL_AXIS_ID['Z'] = int(map_str[2])
+        self.update_transform()
+    
+    def update_transform(self):
+        '''rebuild self.transform from the axis map and sample_* settings'''
+        if not getattr(self, 'drives', None):
+            return
+        assigned = dict(((self.axis_drive[ax], self.MCL_AXIS_ID[ax]), ax) for ax in 'XYZ'
+                        if self.MCL_AXIS_ID[ax] <= self.axis_drive[ax].num_axes)
+        channels = []
+        axis_channel = dict()
+        for drive in self.drives:
+            for axis in range(1, drive.num_axes + 1):
+                if (drive, axis) in assigned:
+                    axis_channel[assigned[(drive, axis)]] = len(channels)
+                    channels.append((drive, axis))
+        self.transform = StageTransform(
+            channels, axis_channel, [drive.cal[axis] for drive, axis in channels],
+            rotation=self.sample_rotation.val, skew=self.sample_skew.val,
+            offset=(self.sample_x_offset.val, self.sample_y_offset.val, self.sample_z_offset.val))
+    
+    def update_target_limits(self):
+        '''target ranges from the *_max calibration'''
+        self.settings.x_target.change_min_max(0.1, self.x_max.value-0.1)
+        self.settings.y_target.change_min_max(0.1, self.y_max.value-0.1)
+        if self.has_z:
+            self.settings.z_target.change_min_max(0.1, self.z_max.value-0.1)
+    
+    def check_device_info(self):
+        '''
+        re-read the *_max limits and rebuild the transform if the background
+        revalidation of cached device info (MCLNanoDrive.revalidate_device_info)
+        found it stale
+        '''
+        changes = [getattr(drive, 'device_info_changes', 0) for drive in self.drives]
+        if changes == self._device_info_changes:
+            return
+        self._device_info_changes = changes
+        self.x_max.read_from_hardware()
+        self.y_max.read_from_hardware()
+        if self.has_z:
+            self.z_max.read_from_hardware()
+        self.update_target_limits()
+        self.update_transform()
+    
+    def commanded_stage_pos(self):
+        '''(n_channels,) last commanded stage positions, no USB traffic'''
+        return np.array([drive.get_commanded_pos_ax(axis) for drive, axis in self.transform.channels])
+    
+    def sample_position(self):
+        '''(3,) commanded position in sample coordinates'''
+        return self.transform.to_sample(self.commanded_stage_pos())
+    
+    def stage_targets(self, x=None, y=None, z=None):
+        '''
+        validated stage positions for a sample position (None: keep that
+        sample coordinate), and the mask of channels that need writing
+        '''
+        given = [ax for ax, pos in zip('XYZ', (x, y, z)) if pos is not None]
+        xyz = self.sample_position() if len(given) < 3 else np.zeros(3)
+        for a, pos in enumerate((x, y, z)):
+            if pos is not None:
+                xyz[a] = pos
+        stage = self.transform.to_stage(xyz)
+        mask = self.transform.affected(given)
+        self.transform.validate(stage, mask)
+        return stage, mask
+    
+    def group_by_drive(self, x=None, y=None, z=None):
+        '''controller -> stage positions of its axes 1..3 (None: not moved)'''
+        stage, mask = self.stage_targets(x, y, z)
+        groups = OrderedDict()
+        for drive, idx, axes in self.transform.groups_for(mask):
+            pos = groups.setdefault(drive, [None, None, None])
+            for c, axis in zip(idx, axes):
+                pos[axis-1] = stage[c]
+        return groups
+    
+    def write_stage_pos(self, stage, groups=None):
+        '''
+        fast move to precomputed, validated stage positions (a row of
+        transform.to_stage), see StageTransform.write
+        '''
+        self._last_activity = time.monotonic()
+        self.transform.write(stage, groups)
+    
+    def write_targets(self, targets, i):
+        '''
+        fast move to row i of targets precomputed for a whole scan grid
+        (transform.targets), see StageTransform.write_targets
+        '''
+        self._last_activity = time.monotonic()
+        self.transform.write_targets(targets, i)
+
+    def mark_activity(self):
+        '''restart fast position polling'''
+        self._last_activity = time.monotonic()
+        if self.scan_owner is None:
+            self._poll_wake.set()
     
     def move_pos_slow(self, x=None,y=None,z=None):
         # move slowly to new position
-        new_pos = [None, None,None]
-        new_pos[self.MCL_AXIS_ID['X']-1] = x
-        new_pos[self.MCL_AXIS_ID['Y']-1] = y
-        new_pos[self.MCL_AXIS_ID['Z']-1] = z
-        if self.nanodrive.num_axes < 3:
-            new_pos[2] = None
-        self.nanodrive.set_pos_slow(*new_pos)
-
-        if x is not None: 
-            self.settings.x_target.update_value(x, update_hardware=False)
-        if y is not None:
-            self.settings.y_target.update_value(y, update_hardware=False)
-        if z is not None:
-            self.settings.z_target.update_value(z, update_hardware=False)
+        self.mark_activity()
+        groups = self.group_by_drive(x, y, z)
+        if self.slow_move_mode.val == 'waveform':
+            calls = [(drive.set_pos_waveform, new_pos) for drive, new_pos in groups.items()]
+            if len(calls) > 1:
+                self.pool.run_parallel(calls)
+            else:
+                for func, args in calls:
+                    func(*args)
+        else:
+            # start all moves, then wait: controllers move concurrently
+            moves = [drive.move_slow(*new_pos) for drive, new_pos in groups.items()]
+            for move in moves:
+                move.wait()
+
+        for ax in 'XYZ':
+            drive, axis_id = self.axis_drive[ax], self.MCL_AXIS_ID[ax]
+            if drive in groups and groups[drive][axis_id-1] is not None:
+                self.settings[ax.lower() + '_target'].update_value(groups[drive][axis_id-1],
+                                                                    update_hardware=False)
 
         self.read_pos()
         
     def move_pos_fast(self,  x=None,y=None,z=None):
-        new_pos = [None, None,None]
-        new_pos[self.MCL_AXIS_ID['X']-1] = x
-        new_pos[self.MCL_AXIS_ID['Y']-1] = y
-        new_pos[self.MCL_AXIS_ID['Z']-1] = z
-        if self.nanodrive.num_axes < 3:
-            new_pos[2] = None
-        self.nanodrive.set_pos(*new_pos)
+        '''
+        single write to a sample position, converted and range checked on
+        each call: for interactive moves, scans write targets precomputed
+        for the whole grid (write_targets)
+        '''
+        self._last_activity = time.monotonic()
+        stage, mask = self.stage_targets(x, y, z)
+        self.transform.write(stage, self.transform.groups_for(mask))
         
-
     
     def read_pos(self):
         if self.settings['debug_mode']: self.log.debug("read_pos")
         if self.settings['connected']:
             self.x_position.read_from_hardware()
             self.y_position.read_from_hardware()
-            if self.nanodrive.num_axes > 2:
+            if self.has_z:
                 self.z_position.read_from_hardware()
         
     def connect(self):
         if self.debug_mode.val: print("connecting to mcl_xyz_stage")
         
+        t0 = time.monotonic()
+        backend = None
+        info_cache = None
+        if self.backend.val == 'sim':
+            from .mcl_sim import SimMadlib
+            # kept across connects like the DLL, the cache stays in memory
+            # so simulated serial numbers never mix with real ones
+            if self._sim_backend is None:
+                self._sim_backend = SimMadlib(**self.sim_kwargs)
+                self._sim_cache = DeviceInfoCache(path=None)
+            backend = self._sim_backend
+            if self.device_cache.val:
+                info_cache = self._sim_cache
+        elif self.device_cache.val:
+            info_cache = DeviceInfoCache()
+
         # Open connection to hardware
-        self.nanodrive = MCLNanoDrive(debug=self.debug_mode.val)
+        serials = [self.x_serial.val, self.y_serial.val, self.z_serial.val]
+        if self.server_mode.val == 'client':
+            # the server process owns the controller, axis serials are its business
+            self.pool = None
+            self.nanodrive = MCLStageClient(self.server_address.val)
+            self.axis_drive = dict(X=self.nanodrive, Y=self.nanodrive, Z=self.nanodrive)
+        elif any(serials):
+            self.pool = MCLDevicePool(backend=backend, madlib_path=self.madlib_path.val or None,
+                                      debug=self.debug_mode.val, info_cache=info_cache)
+            self.axis_drive = dict((ax, self.pool.open(serial or None))
+                                   for ax, serial in zip('XYZ', serials))
+            self.nanodrive = self.axis_drive['X']
+        else:
+            self.pool = None
+            self.nanodrive = MCLNanoDrive(debug=self.debug_mode.val, backend=backend,
+                                          madlib_path=self.madlib_path.val or None,
+                                          info_cache=info_cache, reuse_handle=self.keep_handle.val)
+            self.axis_drive = dict(X=self.nanodrive, Y=self.nanodrive, Z=self.nanodrive)
+        self.drives = list(OrderedDict((d, None) for d in self.axis_drive.values()))
+        self.has_z = self.MCL_AXIS_ID['Z'] <= self.axis_drive['Z'].num_axes
+        if self.server_mode.val == 'host':
+            self.stage_server = MCLStageServer(self.nanodrive, self.server_address.val)
+            self.stage_server.start_thread()
         
         # connect logged quantities
+        # target changes start a slow move in the background and return
+        # immediately, a newer target supersedes a move in progress
         self.x_target.hardware_set_func  = \
-            lambda x: self.nanodrive.set_pos_ax_slow(x, self.MCL_AXIS_ID["X"])
+            lambda x: self.axis_drive["X"].move_slow_ax(x, self.MCL_AXIS_ID["X"])
         self.y_target.hardware_set_func  = \
-            lambda y: self.nanodrive.set_pos_ax_slow(y, self.MCL_AXIS_ID["Y"])
-        if self.nanodrive.num_axes > 2:
+            lambda y: self.axis_drive["Y"].move_slow_ax(y, self.MCL_AXIS_ID["Y"])
+        if self.has_z:
             self.z_target.change_readonly(False)
             self.z_target.hardware_set_func  = \
-                lambda z: self.nanodrive.set_pos_ax_slow(z, self.MCL_AXIS_ID["Z"])
+                lambda z: self.axis_drive["Z"].move_slow_ax(z, self.MCL_AXIS_ID["Z"])
         else:
             self.z_target.change_readonly(True)
 
         self.x_position.hardware_read_func = \
-            lambda: self.nanodrive.get_pos_ax(int(self.MCL_AXIS_ID["X"]))
+            lambda: self.axis_drive["X"].get_pos_ax(int(self.MCL_AXIS_ID["X"]))
         self.y_position.hardware_read_func = \
-            lambda: self.nanodrive.get_pos_ax(int(self.MCL_AXIS_ID["Y"]))
-        if self.nanodrive.num_axes > 2:
+            lambda: self.axis_drive["Y"].get_pos_ax(int(self.MCL_AXIS_ID["Y"]))
+        if self.has_z:
             self.z_position.hardware_read_func = \
-                lambda: self.nanodrive.get_pos_ax(self.MCL_AXIS_ID["Z"])
+                lambda: self.axis_drive["Z"].get_pos_ax(self.MCL_AXIS_ID["Z"])
             
             
-        self.x_max.hardware_read_func = lambda: self.nanodrive.cal[self.MCL_AXIS_ID["X"]]
-        self.y_max.hardware_read_func = lambda: self.nanodrive.cal[self.MCL_AXIS_ID["Y"]]
-        if self.nanodrive.num_axes > 2:
-            self.z_max.hardware_read_func = lambda: self.nanodrive.cal[self.MCL_AXIS_ID["Z"]]
+        self.x_max.hardware_read_func = lambda: self.axis_drive["X"].cal[self.MCL_AXIS_ID["X"]]
+        self.y_max.hardware_read_func = lambda: self.axis_drive["Y"].cal[self.MCL_AXIS_ID["Y"]]
+        if self.has_z:
+            self.z_max.hardware_read_func = lambda: self.axis_drive["Z"].cal[self.MCL_AXIS_ID["Z"]]
         
         self.move_speed.hardware_read_func = self.nanodrive.get_max_speed
-        self.move_speed.hardware_set_func =  self.nanodrive.set_max_speed
+        self.move_speed.hardware_set_func = \
+            lambda v: [drive.set_max_speed(v) for drive in self.drives]
         self.move_speed.write_to_hardware()
+        self.move_accel.hardware_read_func = self.nanodrive.get_max_accel
+        self.move_accel.hardware_set_func = \
+            lambda a: [drive.set_max_accel(a) for drive in self.drives]
+        self.move_accel.write_to_hardware()
         
-        self.read_from_hardware()
+        self.read_max_age.hardware_set_func = \
+            lambda t: [setattr(drive, 'read_max_age', t) for drive in self.drives]
+        self.skip_redundant_writes.hardware_set_func = \
+            lambda skip: [setattr(drive, 'skip_redundant_writes', skip) for drive in self.drives]
+        self.read_max_age.write_to_hardware()
+        self.skip_redundant_writes.write_to_hardware()
         
-        self.settings.x_target.change_min_max(0.1, self.x_max.value-0.1)
-        self.settings.y_target.change_min_max(0.1, self.y_max.value-0.1)
-        if self.nanodrive.num_axes > 2:
-            self.settings.z_target.change_min_max(0.1, self.z_max.value-0.1)
+        for lq_name in ['settle_mode', 'settle_tolerance', 'settle_timeout']:
+            lq = getattr(self, lq_name)
+            lq.hardware_set_func = \
+                lambda val, name=lq_name: [setattr(drive, name, val) for drive in self.drives]
+            lq.write_to_hardware()
+        
+        self.has_iss = self.nanodrive.has_profile(PROFILE_ISS)
+        self.apply_iss_bindings()
+        self.update_transform()
+        self.apply_linearization()
+        
+        if self.recorder_active.val:
+            self.start_recorder()
+        
+        self._device_info_changes = [getattr(drive, 'device_info_changes', 0) for drive in self.drives]
+        self.read_from_hardware()
+        self.update_target_limits()
         
         self.settings.x_target.update_value(self.settings['x_position'], update_hardware=False)
         self.settings.y_target.update_value(self.settings['y_position'], update_hardware=False)
-        if self.nanodrive.num_axes > 2:
+        if self.has_z:
             self.settings.z_target.update_value(self.settings['z_position'], update_hardware=False)
+        self.connect_time.update_value(1e3*(time.monotonic() - t0))
 
         
 
@@ -173,11 +500,27 @@ class MclXYZStageHW(HardwareComponent):
         #disconnect logged quantities from hardware
         self.settings.disconnect_all_from_hardware()
 
+        self.stop_recorder()
+        self._poll_wake.set()
+
         #disconnect hardware
+        if self._async_stage is not None:
+            self._async_stage.close()
+            self._async_stage = None
+        if self.stage_server is not None:
+            self.stage_server.stop()
+            self.stage_server = None
+        if getattr(self, 'pool', None) is not None:
+            self.pool.close(release=not self.keep_handle.val)
+            self.pool = None
+        elif hasattr(self, 'nanodrive'):
+            self.nanodrive.close(release=not self.keep_handle.val)
         if hasattr(self, 'nanodrive'):
-            self.nanodrive.close()
             # clean up hardware object
             del self.nanodrive
+            self.axis_drive = dict()
+            self.drives = []
+            self.transform = None
         
     @property
     def v_axis_id(self):
@@ -200,14 +543,194 @@ class MclXYZStageHW(HardwareComponent):
         return self.MCL_AXIS_ID["Z"]
     
     
+    def async_stage(self):
+        '''mcl_async.AsyncStage of this component, valid until disconnect'''
+        if self._async_stage is None:
+            self._async_stage = AsyncStage(self)
+        return self._async_stage
+
+    def stop_motion(self):
+        if self.settings['connected']:
+            for drive in self.drives:
+                drive.stop_motion()
+            self.read_pos()
+
+    def apply_iss_bindings(self):
+        '''
+        configure the ISS clocks from the iss_* settings, starting from
+        the controller defaults
+        '''
+        if not hasattr(self, 'nanodrive') or not getattr(self, 'has_iss', False):
+            return
+        nd = self.nanodrive
+        nd.iss_reset()
+        defaults = dict(pixel='waveform_read', line='waveform_write', frame='none', aux='none')
+        binds = dict((clock, self.settings['iss_%s_bind' % clock]) for clock in defaults)
+        for clock, event in defaults.items():
+            if event != 'none' and binds[clock] != event:
+                nd.iss_unbind(clock, event)
+        polarity = self.iss_polarity.val
+        for clock, event in binds.items():
+            nd.iss_set_polarity(clock, polarity)
+            if event != 'none' and (event != defaults[clock] or polarity != 'rising'):
+                nd.iss_bind(clock, event, polarity)
+
+    def recover_connection(self):
+        '''
+        after a MCLDeviceError with device_lost: reconnect the controllers
+        that dropped off the bus, each goes back to its last commanded
+        position (see MCLNanoDrive.reconnect), and restore the ISS bindings
+        '''
+        for drive in self.drives:
+            if not drive.is_attached():
+                drive.reconnect(timeout=self.reconnect_timeout.val)
+                self.reconnect_count.update_value(self.reconnect_count.val + 1)
+        self.apply_iss_bindings()
+        self.read_pos()
+
+    def apply_linearization(self):
+        '''load the tables of each connected controller, or remove them'''
+        if not getattr(self, 'drives', None):
+            return
+        status = []
+        for drive in self.drives:
+            lmap = None
+            if self.linearization.val and self.linearization_dir.val:
+                lmap = LinearizationMap.load(self.linearization_dir.val, drive.device_serial_number)
+            if self.linearization.val:
+                status.append("{}:{}".format(drive.device_serial_number,
+                                             'on' if lmap is not None else 'missing'))
+            drive.set_linearization(lmap)
+        self.linearization_status.update_value(" ".join(status) or 'off')
+
+    def calibrate_linearization(self):
+        '''sensor sweep of every controller, saved to linearization_dir'''
+        if not self.settings['connected']:
+            return
+        for drive in self.drives:
+            lmap = calibrate_sensor_sweep(drive)
+            if self.linearization_dir.val:
+                fname = lmap.save(self.linearization_dir.val)
+                print("MclXYZStageHW linearization saved", fname, lmap.residual())
+        self.apply_linearization()
+        self.read_pos()
+
+    def on_recorder_active(self):
+        if self.recorder_active.val:
+            if hasattr(self, 'nanodrive') and self.recorder is None:
+                self.start_recorder()
+        else:
+            self.stop_recorder()
+    
+    def start_recorder(self):
+        '''
+        record the recorder_axes that are on self.nanodrive, axes of other
+        controllers in the pool are left out
+        '''
+        if self.recorder_mode.val == 'wfma' and self.scan_owner is not None:
+            print("MclXYZStageHW: 'wfma' recording would overwrite the waveforms of",
+                  self.scan_owner.name, "- use recorder_mode 'read'")
+            self.recorder_active.update_value(False)
+            return
+        names = [ax for ax in self.recorder_axes.val.upper() if ax in self.MCL_AXIS_ID
+                 and self.axis_drive[ax] is self.nanodrive
+                 and self.MCL_AXIS_ID[ax] <= self.nanodrive.num_axes]
+        skipped = [ax for ax in self.recorder_axes.val.upper() if ax in self.MCL_AXIS_ID
+                   and self.axis_drive[ax] is not self.nanodrive]
+        if skipped:
+            print("MclXYZStageHW: not recording", "".join(skipped), "(on another controller)")
+        path = self.recorder_file.val
+        self.recorder = MCLPositionRecorder(
+            self.nanodrive, axes=[self.MCL_AXIS_ID[ax] for ax in names],
+            period_ms=self.recorder_period.val, block=self.recorder_block.val,
+            ring_seconds=self.recorder_ring_seconds.val,
+            ring_file=path if path and not path.endswith('.h5') else None,
+            mode=self.recorder_mode.val)
+        self.recorder_names = names
+        self.recorder_h5 = None
+        if path.endswith('.h5'):
+            import h5py
+            self.recorder_h5 = h5py.File(path, 'a')
+            group = self.recorder_h5.create_group(time.strftime('%Y%m%d_%H%M%S_positions'))
+            self.recorder.add_sink(H5PositionSink(group, len(names), self.recorder.block,
+                                                  self.recorder_period.val*1e-3, names))
+        self.recorder.start()
+    
+    def stop_recorder(self):
+        if self.recorder is None:
+            return
+        self.recorder.stop()
+        self.recorder = None
+        if self.recorder_h5 is not None:
+            self.recorder_h5.close()
+            self.recorder_h5 = None
+    
+    def reset_settle_model(self):
+        if self.settings['connected']:
+            for drive in self.drives:
+                drive.reset_settle_model()
+            self.update_settle_stats()
+    
+    def update_settle_stats(self):
+        stats = [drive.settle_stats for drive in self.drives]
+        count = sum(st.count for st in stats)
+        self.settle_count.update_value(count)
+        self.settle_timeouts.update_value(sum(st.timeouts for st in stats))
+        self.settle_time_last.update_value(1e3*max(st.last for st in stats))
+        if count:
+            self.settle_time_mean.update_value(1e3*sum(st.total for st in stats)/count)
+
     def go_to_center_xy(self):
         self.settings['x_target'] = self.settings['x_max']*0.5
         self.settings['y_target'] = self.settings['y_max']*0.5
         
         
+    def poll_interval(self):
+        '''seconds until the next position poll, None while paused'''
+        if self.scan_owner is not None:
+            if self.poll_during_scan.val == 'pause':
+                return None
+            return self.poll_idle.val
+        now = time.monotonic()
+        if any(drive.motion_active() for drive in self.drives):
+            self._last_activity = now
+        idle = now - self._last_activity
+        return min(self.poll_idle.val, self.poll_fast.val*2.0**(idle/self.poll_decay.val))
+    
+    def poll_positions(self):
+        '''
+        read all axes (one batched driver call per controller) and update
+        the position logged quantities that moved by more than poll_deadband
+        '''
+        if self.recorder is not None and self.recorder.running \
+                and self.recorder.ring.blocks_written:
+            # positions from the recording instead of extra single reads
+            positions = dict(zip(self.recorder_names, self.recorder.ring.last_sample()))
+        else:
+            positions = dict()
+        axes = [ax for ax in 'XYZ' if ax not in positions and (ax != 'Z' or self.has_z)]
+        groups = OrderedDict()
+        for ax in axes:
+            groups.setdefault(self.axis_drive[ax], []).append(ax)
+        for drive, names in groups.items():
+            values = drive.read_axes([self.MCL_AXIS_ID[ax] for ax in names])
+            positions.update(zip(names, values))
+        deadband = self.poll_deadband.val
+        for ax, pos in positions.items():
+            lq = getattr(self, ax.lower() + '_position')
+            if abs(pos - lq.val) > deadband:
+                lq.update_value(pos)
+    
     def threaded_update(self):
-        self.x_position.read_from_hardware()
-        self.y_position.read_from_hardware()
-        if self.nanodrive.num_axes > 2:
-            self.z_position.read_from_hardware()
-        time.sleep(0.1)    
\ No newline at end of file
+        self._poll_wake.clear()
+        interval = self.poll_interval()
+        if interval is None:
+            # a scan owns the stage and reads positions itself
+            self._poll_wake.wait(self.poll_idle.val)
+            return
+        for drive in self.drives:
+            drive.set_io_priority(PRIORITY_POLL)
+        self.check_device_info()
+        self.poll_positions()
+        self.update_settle_stats()
+        self._poll_wake.wait(interval)
@@ -0,0 +1,32 @@
+'''
+The package's __init__ imports the ScopeFoundry hardware component, the
+tests import the driver modules directly: register the package directory
+as the namespace package mcl_stage so relative imports work without it.
+'''
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import types
+import pytest
+
+PKG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'mcl_stage' not in sys.modules:
+    pkg = types.ModuleType('mcl_stage')
+    pkg.__path__ = [PKG_DIR]
+    sys.modules['mcl_stage'] = pkg
+
+
+@pytest.fixture
+def sim():
+    '''simulated MadLib without call latencies'''
+    from mcl_stage.mcl_sim import SimMadlib
+    return SimMadlib(write_latency=0, read_latency=0, call_latency=0, noise=0)
+
+
+@pytest.fixture
+def nd(sim):
+    from mcl_stage.mcl_nanodrive import MCLNanoDrive
+    drive = MCLNanoDrive(backend=sim)
+    yield drive
+    drive.close()
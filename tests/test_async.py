@@ -0,0 +1,84 @@
+from __future__ import division, print_function, absolute_import
+import asyncio
+import pytest
+from mcl_stage.mcl_async import AsyncNanoDrive, await_move
+
+
+def test_move_to(nd):
+    nd.set_max_speed(500)
+    async def main():
+        stage = AsyncNanoDrive(nd)
+        try:
+            ticks = 0
+            move = asyncio.ensure_future(stage.move_to(10.0, 15.0))
+            while not move.done():
+                ticks += 1
+                await asyncio.sleep(0.001)
+            return await move, ticks
+        finally:
+            stage.close()
+    reached, ticks = asyncio.run(main())
+    assert reached
+    assert ticks > 1 # the loop kept running during the move
+    assert nd.get_commanded_pos_ax(1) == 10.0
+
+
+def test_cancel_stops_move(nd):
+    nd.set_max_speed(20)
+    async def main():
+        stage = AsyncNanoDrive(nd)
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(stage.move_to(60.0), 0.05)
+        finally:
+            stage.close()
+    asyncio.run(main())
+    assert nd.wait_motion_idle(5) is not False
+    assert nd.get_commanded_pos_ax(1) < 60.0
+
+
+def test_stream_positions(nd):
+    async def main():
+        stage = AsyncNanoDrive(nd)
+        try:
+            samples = []
+            async for t, pos in stage.stream_positions(0.005, axes=[1, 2]):
+                samples.append((t, pos))
+                if len(samples) == 5:
+                    break
+            return samples
+        finally:
+            stage.close()
+    samples = asyncio.run(main())
+    assert len(samples) == 5
+    assert all(len(pos) == 2 for t, pos in samples)
+    assert all(t1 > t0 for (t0, _), (t1, _) in zip(samples, samples[1:]))
+
+
+class CallbackMove(object):
+    '''a move that ends when the test calls finish()'''
+
+    def __init__(self):
+        self.callbacks = []
+        self.cancelled = False
+
+    def add_done_callback(self, func):
+        self.callbacks.append(func)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def finish(self):
+        for func in self.callbacks:
+            func(self)
+
+
+def test_move_ending_after_the_loop_closed():
+    move = CallbackMove()
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(await_move(move), 0.01)
+    asyncio.run(main())
+    assert move.cancelled
+    # the motion thread finishes the cancelled move later
+    move.finish()
@@ -0,0 +1,73 @@
+'''
+Auto hysteresis correction on a simulated stage with backlash, on a
+stand-in that borrows the scan methods (needs ScopeFoundry to import them).
+'''
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+
+pytest.importorskip("ScopeFoundry")
+from mcl_stage.mcl_stage_slowscan import MCLStageScanMixin
+
+
+class BacklashStage(object):
+    '''readback lags the command by `backlash` in the direction of motion'''
+
+    def __init__(self, backlash):
+        self.backlash = backlash
+        self.settings = dict(x_position=0.0)
+
+    def write(self, h_cmd, reverse):
+        self.settings['x_position'] = h_cmd + (self.backlash if reverse else -self.backlash)
+
+
+class HysteresisStandIn(object):
+    reverse_offset = MCLStageScanMixin.reverse_offset
+    h_offset = MCLStageScanMixin.h_offset
+    find_reverse_lines = MCLStageScanMixin.find_reverse_lines
+    _update_hysteresis = MCLStageScanMixin._update_hysteresis
+    _calibrate_hysteresis = MCLStageScanMixin._calibrate_hysteresis
+    move_position_fast = MCLStageScanMixin.move_position_fast
+
+    def __init__(self, stage, n_lines=4, n_pixels=8):
+        self.settings = dict(h_axis='X', hysteresis_correction='auto', reverse_offset=0.0)
+        self.stage = stage
+        h = np.linspace(10.0, 20.0, n_pixels)
+        self.scan_h_positions = np.concatenate([h if j % 2 == 0 else h[::-1] for j in range(n_lines)])
+        self.scan_v_positions = np.repeat(np.arange(n_lines, dtype=float), n_pixels)
+        self.find_reverse_lines()
+        self.hyst_err_sum = np.zeros(2)
+        self.hyst_err_n = np.zeros(2, dtype=int)
+        self.n_pixels = n_pixels
+
+    def timing_stamp(self, k):
+        pass
+
+    def iss_pulse(self, clock):
+        pass
+
+    def with_recovery(self, move, *args):
+        return move(*args)
+
+    def move_pixel(self, pixel_i):
+        h = self.scan_h_positions[pixel_i] + self.h_offset(pixel_i)
+        self.stage.write(h, self.scan_reverse[pixel_i])
+
+    def scan_frame(self):
+        # move_position_slow calibrates at line starts
+        for self.pixel_i, h in enumerate(self.scan_h_positions):
+            if self.pixel_i % self.n_pixels == 0:
+                self._calibrate_hysteresis()
+            self.move_position_fast(h, self.scan_v_positions[self.pixel_i], 0, 0)
+
+
+def test_reverse_offset_converges():
+    stage = BacklashStage(0.05)
+    scan = HysteresisStandIn(stage)
+    offsets = []
+    for frame in range(12):
+        scan.scan_frame()
+        offsets.append(scan.settings['reverse_offset'])
+    # reverse readback matches forward readback: offset = -2*backlash
+    assert offsets[-1] == pytest.approx(-0.1, abs=1e-4)
+    assert abs(offsets[-1] - offsets[-2]) < 1e-4
@@ -0,0 +1,65 @@
+from __future__ import division, print_function, absolute_import
+import threading
+import pytest
+from mcl_stage.mcl_io_worker import MCLIOWorker, PRIORITY_SCAN, PRIORITY_POLL
+
+
+@pytest.fixture
+def worker():
+    w = MCLIOWorker(name='mcl_io_test')
+    yield w
+    w.close()
+
+
+def _blocked(worker):
+    '''occupy the worker until the returned event is set'''
+    release = threading.Event()
+    started = threading.Event()
+    def block():
+        started.set()
+        release.wait(5)
+    worker.submit(block)
+    started.wait(5)
+    return release
+
+
+def test_call_result_and_error(worker):
+    assert worker.call(lambda a, b: a + b, (1, 2)) == 3
+    def fail():
+        raise ValueError("bad")
+    with pytest.raises(ValueError):
+        worker.call(fail)
+
+
+def test_priority_order(worker):
+    release = _blocked(worker)
+    order = []
+    futures = [worker.submit(order.append, ('poll',), PRIORITY_POLL),
+               worker.submit(order.append, ('scan',), PRIORITY_SCAN)]
+    release.set()
+    for f in futures:
+        f.result(5)
+    assert order == ['scan', 'poll']
+
+
+def test_coalesce(worker):
+    release = _blocked(worker)
+    writes = []
+    f1 = worker.submit(writes.append, (1,), PRIORITY_POLL, coalesce_key=('write', 1))
+    f2 = worker.submit(writes.append, (2,), PRIORITY_SCAN, coalesce_key=('write', 1))
+    release.set()
+    f1.result(5)
+    f2.result(5)
+    assert f1 is f2
+    assert writes == [2]
+
+
+def test_nested_call_runs_inline(worker):
+    assert worker.call(lambda: worker.call(lambda: 'inner')) == 'inner'
+
+
+def test_closed(worker):
+    worker.close()
+    assert worker.closed
+    with pytest.raises(IOError):
+        worker.submit(lambda: None)
@@ -0,0 +1,86 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+from mcl_stage.mcl_linearize import LinearizationMap, calibrate_sensor_sweep
+
+
+def _bowed_map():
+    c = np.linspace(0, 75, 31)
+    m = c + 0.5*np.sin(np.pi*c/75)
+    m[10] = m[9] - 0.01 # noise dip
+    lmap = LinearizationMap(1600)
+    lmap.set_axis(1, c, m)
+    return lmap
+
+
+def test_set_axis_monotonic():
+    c, m = _bowed_map().axes[1]
+    assert np.all(np.diff(c) > 0)
+    assert np.all(np.diff(m) >= 0)
+
+
+def test_correct_forward_round_trip():
+    lmap = _bowed_map()
+    lmap.set_coupling(2, 1, [0.0, 75.0], [0.0, 0.3])
+    wanted = {1: np.linspace(5, 70, 14), 2: np.full(14, 30.0)}
+    commanded = lmap.correct(wanted)
+    assert np.all(np.diff(commanded[1]) > 0)
+    reached = lmap.forward(commanded)
+    np.testing.assert_allclose(reached[1], wanted[1], atol=1e-2)
+    np.testing.assert_allclose(reached[2], wanted[2], atol=1e-2)
+
+
+def test_axes_without_tables_pass_through():
+    out = _bowed_map().correct({3: 12.5})
+    assert out[3] == 12.5
+
+
+def test_save_load(tmp_path):
+    lmap = _bowed_map()
+    lmap.set_coupling(2, 1, [0.0, 75.0], [0.0, 0.3])
+    lmap.save(str(tmp_path))
+    loaded = LinearizationMap.load(str(tmp_path), 1600)
+    assert loaded.serial == 1600 and loaded.reference == 'sensor'
+    for a, b in zip(loaded.axes[1], lmap.axes[1]):
+        np.testing.assert_array_equal(a, b)
+    for a, b in zip(loaded.coupling[(2, 1)], lmap.coupling[(2, 1)]):
+        np.testing.assert_array_equal(a, b)
+    assert LinearizationMap.load(str(tmp_path), 1601) is None
+
+
+def test_calibrate_sensor_sweep():
+    from mcl_stage.mcl_sim import SimMadlib
+    from mcl_stage.mcl_nanodrive import MCLNanoDrive
+    sim = SimMadlib(write_latency=0, read_latency=0, call_latency=0, noise=0,
+                    settle_tau=1e-4, nonlinearity=0.01)
+    nd = MCLNanoDrive(backend=sim)
+    nd.set_max_speed(2000)
+    try:
+        lmap = calibrate_sensor_sweep(nd, axes=[1], n_points=21, n_avg=2, settle_time=0.001)
+        assert lmap.residual()[1] > 0.1
+        nd.set_linearization(lmap)
+        nd.set_pos_ax(40.0, 1)
+        nd.settle('poll')
+        assert abs(nd.get_pos_ax(1, 0) - 40.0) < 0.05
+    finally:
+        nd.close()
+
+
+def test_grid_targets_match_per_call_correction(nd):
+    from mcl_stage.mcl_transform import StageTransform
+    lmap = _bowed_map()
+    lmap.serial = nd.device_serial_number
+    lmap.set_coupling(2, 1, [0.0, 75.0], [0.0, 0.3])
+    nd.set_linearization(lmap)
+    T = StageTransform([(nd, 1), (nd, 2)], dict(X=0, Y=1), [nd.cal[1], nd.cal[2]])
+    grid = T.to_stage(np.column_stack([np.linspace(5, 70, 8), np.full(8, 30.0), np.zeros(8)]))
+    targets = T.targets(grid)
+    for i in (0, 5):
+        T.write_targets(targets, i)
+        raw = dict(nd._raw_pos)
+        assert raw[1] != grid[i, 0]
+        nd.skip_redundant_writes = False
+        nd.write_axes([1, 2], grid[i]) # corrected per call
+        assert nd._raw_pos[1] == pytest.approx(raw[1])
+        assert nd._raw_pos[2] == pytest.approx(raw[2])
+        assert nd.get_commanded_pos_ax(1) == grid[i, 0]
@@ -0,0 +1,80 @@
+from __future__ import division, print_function, absolute_import
+import threading
+import numpy as np
+from mcl_stage.mcl_nanodrive import MCLNanoDrive
+from mcl_stage.mcl_device_cache import DeviceInfoCache
+
+
+def test_write_and_settle(nd):
+    nd.settle_mode = 'poll'
+    nd.write_axes([1, 2], [10.0, 20.0])
+    assert abs(nd.get_pos_ax(1, 0) - 10.0) <= nd.settle_tolerance
+    assert nd.settle_stats.count == 1
+    # nothing written since: returns right away without a settle record
+    assert nd.settle('poll')
+    assert nd.settle_stats.count == 1
+
+
+def test_skip_redundant_writes(nd):
+    nd.skip_redundant_writes = True
+    nd.set_pos_ax(5.0, 1)
+    n = nd.write_count
+    nd.set_pos_ax(5.0, 1)
+    assert nd.write_count == n
+    assert nd.skipped_write_count == 1
+
+
+def test_concurrent_writes_and_settles(nd):
+    # writes from another thread while settling must neither be lost nor raise
+    errors = []
+    def writer():
+        try:
+            for k in range(200):
+                nd.set_pos_ax(10.0 + (k % 5), 2)
+        except Exception as err:
+            errors.append(err)
+    t = threading.Thread(target=writer)
+    t.start()
+    while t.is_alive():
+        nd.settle('off')
+    t.join()
+    assert not errors
+    nd.settle('off')
+    assert not nd._settle_pending
+
+
+def test_stale_cached_info_is_revalidated(sim):
+    cache = DeviceInfoCache(path=None)
+    nd = MCLNanoDrive(backend=sim, info_cache=cache)
+    try:
+        prodinfo, cal = nd.prodinfo, dict(nd.cal)
+        assert nd.revalidate_device_info()
+        assert nd.device_info_changes == 0
+        # as if the cache had the calibration of another stage
+        stale = dict(cal)
+        stale[1] = 100.0
+        nd._apply_device_info(prodinfo, stale)
+        nd.settle_models[1].add(1.0, 0.01)
+        assert not nd.revalidate_device_info()
+        assert nd.cal == cal
+        assert nd.device_info_changes == 1
+        assert sorted(nd.settle_models) == sorted(cal)
+        assert all(len(m.samples) == 0 for m in nd.settle_models.values())
+        assert cache.get(nd.device_serial_number)[1] == cal
+    finally:
+        nd.close()
+
+
+def test_waveform_setups_replace_each_other(nd):
+    wf = np.linspace(10.0, 20.0, 50)
+    nd.setup_load_waveform_ax(wf, 1, 2.0)
+    nd.setup_load_waveform_ax(wf, 1, 2.0)
+    assert (nd.upload_count, nd.skipped_upload_count) == (1, 1)
+    # the multi-axis setup replaces the load setup and the other way around
+    nd.wfma_setup({1: wf, 2: wf}, 2.0)
+    nd.setup_load_waveform_ax(wf, 1, 2.0)
+    nd.wfma_setup({1: wf, 2: wf}, 2.0)
+    assert (nd.upload_count, nd.skipped_upload_count) == (4, 1)
+    nd.revalidate_device_info()
+    nd.wfma_setup({1: wf, 2: wf}, 2.0)
+    assert nd.upload_count == 5
@@ -0,0 +1,45 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from mcl_stage.mcl_path import (path_length, nearest_neighbor_order, two_opt, plan_visit_order,
+                                mask_to_points)
+
+
+def _points(n=60):
+    return np.random.RandomState(1).uniform(0, 50, size=(n, 2))
+
+
+def test_orders_are_permutations():
+    points = _points()
+    for order in (nearest_neighbor_order(points), plan_visit_order(points, start=[0.0, 0.0])):
+        assert sorted(order) == list(range(len(points)))
+
+
+def test_two_opt_does_not_lengthen():
+    points = _points()
+    start = np.array([25.0, 25.0])
+    order = nearest_neighbor_order(points, start)
+    improved = two_opt(points, order, start)
+    assert path_length(points, improved, start) <= path_length(points, order, start) + 1e-9
+
+
+def test_two_opt_keeps_first_point_without_start():
+    points = _points()
+    order = np.random.RandomState(2).permutation(len(points))
+    assert two_opt(points, order)[0] == order[0]
+
+
+def test_line_is_visited_in_order():
+    points = np.column_stack([np.arange(10.0)[::-1], np.zeros(10)])
+    order = plan_visit_order(points, start=[0.0, 0.0])
+    assert list(order) == list(range(10))[::-1]
+
+
+def test_empty():
+    assert len(nearest_neighbor_order(np.zeros((0, 2)))) == 0
+
+
+def test_mask_to_points():
+    mask = np.zeros((3, 4), dtype=bool)
+    mask[1, 2] = mask[2, 0] = True
+    points = mask_to_points(mask, [0.0, 1.0, 2.0, 3.0], [10.0, 20.0, 30.0])
+    np.testing.assert_array_equal(points, [[2.0, 20.0], [0.0, 30.0]])
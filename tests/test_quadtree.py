@@ -0,0 +1,42 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from mcl_stage.mcl_quadtree import QuadTreeImage
+
+
+def _sample(qt, nodes, image):
+    qt.add_samples(nodes, image[nodes[:, 0], nodes[:, 1]])
+
+
+def test_flat_image_is_not_refined():
+    qt = QuadTreeImage(4, 3, 2)
+    _sample(qt, qt.initial_samples(), np.ones(qt.shape))
+    assert qt.n_samples == 5*4
+    assert len(qt.refine(0.1)) == 0
+    np.testing.assert_allclose(qt.resample(), 1.0)
+
+
+def test_edge_is_refined_to_full_resolution():
+    qt = QuadTreeImage(4, 4, 2)
+    image = np.zeros(qt.shape)
+    image[:, 7:] = 1.0
+    _sample(qt, qt.initial_samples(), image)
+    while True:
+        nodes = qt.refine(0.5)
+        if not len(nodes):
+            break
+        assert not qt.sampled[nodes[:, 0], nodes[:, 1]].any()
+        _sample(qt, nodes, image)
+    assert qt.n_samples < image.size
+    assert qt.leaves[:, 2].min() == 1
+    # sampled nodes hold the image, the flat areas are filled exactly
+    resampled = qt.resample()
+    np.testing.assert_array_equal(resampled[qt.sampled], image[qt.sampled])
+    np.testing.assert_allclose(resampled[:, :4], 0.0)
+    np.testing.assert_allclose(resampled[:, 12:], 1.0)
+
+
+def test_node_coords():
+    qt = QuadTreeImage(2, 1, 1)
+    h = np.linspace(0, 4, qt.shape[1])
+    v = np.linspace(0, 2, qt.shape[0])
+    np.testing.assert_allclose(qt.node_coords(np.array([[0, 0], [2, 4]]), h, v), [[0, 0], [4, 2]])
@@ -0,0 +1,34 @@
+from __future__ import division, print_function, absolute_import
+import time
+import numpy as np
+from mcl_stage.mcl_recorder import MCLPositionRecorder, PositionRingBuffer, READ_MAX_HOLD_MS
+
+
+def test_ring_buffer_latest():
+    ring = PositionRingBuffer(2, 4, 3, 0.001)
+    for k in range(4):
+        j, view = ring.next_block()
+        view[:] = k
+        ring.commit_block(j, [float(k), float(k)])
+    t, data = ring.latest()
+    # the slot after the newest block is not returned
+    np.testing.assert_array_equal(data[0], [2]*4 + [3]*4)
+    np.testing.assert_allclose(t[0, :2], [2.0, 2.001])
+    np.testing.assert_array_equal(ring.last_sample(), [3.0, 3.0])
+
+
+def test_read_blocks_do_not_hold_the_io_worker(nd):
+    rec = MCLPositionRecorder(nd, axes=(1, 2), period_ms=1.0, block=500, ring_seconds=1.0)
+    assert rec.block == int(READ_MAX_HOLD_MS)
+    rec.start()
+    try:
+        while not rec.ring.blocks_written:
+            time.sleep(0.005)
+        # a move waits at most for the block being read
+        t0 = time.monotonic()
+        nd.set_pos_ax(12.0, 1)
+        assert time.monotonic() - t0 < 3*READ_MAX_HOLD_MS*1e-3
+    finally:
+        rec.stop()
+    assert rec.error is None
+    assert np.all(np.isfinite(rec.ring.last_sample()))
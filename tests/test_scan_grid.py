@@ -0,0 +1,122 @@
+'''
+Scan grids and their precomputed pixel writes, on stand-ins that borrow the
+scan and stage component methods over a simulated drive: no app, Qt or h5
+file needed, only ScopeFoundry to import them.
+'''
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+
+pytest.importorskip("ScopeFoundry")
+pytest.importorskip("qtpy")
+from mcl_stage.mcl_stage_slowscan import MCLStageScanMixin, MCLStage3DStackSlowScan
+from mcl_stage.mcl_xyz_stage import MclXYZStageHW
+from mcl_stage.mcl_transform import StageTransform
+
+
+class StageStandIn(object):
+    commanded_stage_pos = MclXYZStageHW.commanded_stage_pos
+    sample_position = MclXYZStageHW.sample_position
+    stage_targets = MclXYZStageHW.stage_targets
+    write_targets = MclXYZStageHW.write_targets
+    move_pos_fast = MclXYZStageHW.move_pos_fast
+
+    def __init__(self, nd, rotation=0.0):
+        self.nanodrive = nd
+        self.transform = StageTransform([(nd, 1), (nd, 2), (nd, 3)], dict(X=0, Y=1, Z=2),
+                                        [nd.cal[1], nd.cal[2], nd.cal[3]],
+                                        rotation=rotation, offset=(30.0, 30.0, 10.0))
+
+    def commanded(self):
+        return np.array([self.nanodrive.get_commanded_pos_ax(axis) for axis in (1, 2, 3)])
+
+
+class GridStandIn(MCLStageScanMixin):
+    '''3 serpentine lines of 4 pixels, the middle one reverse'''
+    name = 'grid_stand_in'
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.settings = dict(h_axis='X', v_axis='Y', hysteresis_correction='fixed',
+                             reverse_offset=0.5)
+        self.ax_map = dict(X=0, Y=1, Z=2)
+        h = np.linspace(1.0, 10.0, 4)
+        self.scan_h_positions = np.concatenate([h, h[::-1], h])
+        self.scan_v_positions = np.repeat([2.0, 4.0, 6.0], 4)
+        self.scan_slow_move = np.tile([True, False, False, False], 3)
+        self.Npixels = 12
+        self.find_reverse_lines()
+
+
+class StackStandIn(GridStandIn):
+    scan_axes = MCLStage3DStackSlowScan.scan_axes
+    setup_stage_grid = MCLStage3DStackSlowScan.setup_stage_grid
+    scan_grid = MCLStage3DStackSlowScan.scan_grid
+    stack_z = MCLStage3DStackSlowScan.stack_z
+
+    def __init__(self, stage, z):
+        GridStandIn.__init__(self, stage)
+        self.settings['stack_mode'] = 'continuous'
+        self.stack_positions = np.asarray(z, dtype=float)
+        self.stack_end_positions = self.stack_positions + 2.0
+        self.stack_ax = 'Z'
+        self.stack_dir = stage.transform.direction('Z')
+        self.stack_frame_i = 0
+
+
+@pytest.mark.parametrize('rotation', [0.0, 10.0])
+def test_scan_targets_match_interactive_moves(nd, rotation):
+    stage = StageStandIn(nd, rotation)
+    stage.move_pos_fast(5.0, 5.0, 5.0)
+    scan = GridStandIn(stage)
+    scan.setup_stage_grid()
+    # the z channel does not move with the pixels
+    assert [axes for drive, axes, pos, raw in scan.scan_targets] == [(1, 2)]
+    for i in range(scan.Npixels):
+        stage.write_targets(scan.scan_targets, i)
+        written = stage.commanded()
+        h = scan.scan_h_positions[i] + scan.h_offset(i)
+        stage.move_pos_fast(h, scan.scan_v_positions[i])
+        np.testing.assert_allclose(written, stage.commanded(), atol=1e-12)
+        assert written[2] == pytest.approx(5.0 + 10.0)
+
+
+def test_offset_change_rebuilds_line_targets(nd):
+    stage = StageStandIn(nd)
+    stage.move_pos_fast(5.0, 5.0, 5.0)
+    scan = GridStandIn(stage)
+    scan.setup_stage_grid()
+    pos = scan.scan_targets[0][2].copy()
+    scan.settings['reverse_offset'] = 1.0
+    i0 = 5
+    scan.update_scan_targets(i0, scan.line_end(i0))
+    np.testing.assert_array_equal(scan.scan_targets_offset, [0.5]*5 + [1.0]*3 + [0.5]*4)
+    new = scan.scan_targets[0][2]
+    np.testing.assert_array_equal(new[:5], pos[:5])
+    np.testing.assert_array_equal(new[8:], pos[8:])
+    np.testing.assert_allclose(new[5:8, 0] - pos[5:8, 0], 0.5)
+
+
+def test_stack_grid_follows_the_planes(nd):
+    stage = StageStandIn(nd)
+    stage.move_pos_fast(5.0, 5.0, 5.0)
+    scan = StackStandIn(stage, [4.0, 8.0])
+    scan.setup_stage_grid()
+    assert [axes for drive, axes, pos, raw in scan.scan_targets] == [(1, 2, 3)]
+    for frame_i in (0, 1):
+        scan.stack_frame_i = frame_i
+        scan.update_scan_targets()
+        # continuous mode: z sweeps the plane during the frame
+        z = scan.stack_z(np.arange(scan.Npixels))
+        assert z[0] == scan.stack_positions[frame_i]
+        assert z[-1] < scan.stack_end_positions[frame_i]
+        np.testing.assert_allclose(scan.scan_targets[0][2][:, 2], z + 10.0)
+
+
+def test_stack_planes_out_of_range(nd):
+    stage = StageStandIn(nd)
+    stage.move_pos_fast(5.0, 5.0, 5.0)
+    # the end of the last continuous plane is past the z range
+    scan = StackStandIn(stage, [4.0, nd.cal[3] - 10.0 - 1.0])
+    with pytest.raises(ValueError):
+        scan.setup_stage_grid()
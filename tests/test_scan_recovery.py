@@ -0,0 +1,151 @@
+'''
+Recovery of the stage scans from a USB drop, on a stand-in that borrows the
+scan methods: no app, Qt or h5 file needed, only ScopeFoundry to import them.
+'''
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+
+pytest.importorskip("ScopeFoundry")
+from mcl_stage.mcl_stage_slowscan import (MCLStageScanMixin, MCLStage2DSlowScan,
+                                          MCLStage2DFrameSlowScan)
+from mcl_stage.mcl_nanodrive import MCLDeviceError
+from mcl_stage.mcl_checkpoint import ScanCheckpoint
+
+
+class FakeStage(object):
+
+    def __init__(self):
+        self.recoveries = 0
+
+    def recover_connection(self):
+        self.recoveries += 1
+
+
+class ScanStandIn(object):
+    '''2 lines of 4 pixels, collect_pixel records its arguments'''
+    name = 'scan_stand_in'
+    with_recovery = MCLStageScanMixin.with_recovery
+    replay_line = MCLStageScanMixin.replay_line
+    line_start = MCLStageScanMixin.line_start
+    checkpoint_line = MCLStageScanMixin.checkpoint_line
+    find_reverse_lines = MCLStageScanMixin.find_reverse_lines
+
+    def __init__(self):
+        self.settings = dict(auto_recover=True, max_recoveries=2, recoveries=0)
+        self.stage = FakeStage()
+        self.scan_checkpoint = None
+        self.scan_h_positions = np.tile(np.arange(4.0), 2)
+        self.scan_v_positions = np.repeat([0.0, 1.0], 4)
+        self.scan_slow_move = np.tile([True, False, False, False], 2)
+        self.scan_index_array = np.array([(0, j, i) for j in range(2) for i in range(4)])
+        self.moves = []
+        self.collected = []
+
+    def move_position_start(self, h, v):
+        self.moves.append(('start', self.pixel_i))
+
+    def move_pixel(self, pixel_i):
+        self.moves.append(('pixel', pixel_i))
+
+
+class FrameScanStandIn(ScanStandIn):
+    _collect = MCLStage2DFrameSlowScan._collect
+
+    def collect_pixel(self, pixel_num, frame_i, k, j, i):
+        self.collected.append((pixel_num, frame_i, k, j, i))
+
+
+class SingleScanStandIn(ScanStandIn):
+    _collect = MCLStage2DSlowScan._collect
+
+    def collect_pixel(self, pixel_num, k, j, i):
+        self.collected.append((pixel_num, k, j, i))
+
+
+def _drop_once():
+    calls = []
+    def move():
+        calls.append(1)
+        if len(calls) == 1:
+            raise MCLDeviceError("device lost", -3)
+        return 'moved'
+    return move, calls
+
+
+def test_frame_scan_replays_line_with_frame_index():
+    scan = FrameScanStandIn()
+    scan.scan_frame_i = 3
+    scan.pixel_i = 6
+    move, calls = _drop_once()
+    assert scan.with_recovery(move) == 'moved'
+    assert len(calls) == 2
+    assert scan.stage.recoveries == 1
+    assert scan.settings['recoveries'] == 1
+    # line 1 starts at pixel 4: pixels 4 and 5 are taken again
+    assert scan.moves == [('start', 4), ('pixel', 5)]
+    assert scan.collected == [(4, 3, 0, 1, 0), (5, 3, 0, 1, 1)]
+    assert scan.pixel_i == 6
+
+
+def test_single_scan_replay():
+    scan = SingleScanStandIn()
+    scan.pixel_i = 2
+    move, calls = _drop_once()
+    scan.with_recovery(move)
+    assert scan.collected == [(0, 0, 0, 0), (1, 0, 0, 1)]
+
+
+def test_recovery_limit():
+    scan = FrameScanStandIn()
+    scan.scan_frame_i = 0
+    scan.pixel_i = 1
+    def move():
+        raise MCLDeviceError("device lost", -3)
+    with pytest.raises(MCLDeviceError):
+        scan.with_recovery(move)
+    assert scan.settings['recoveries'] == 2
+
+
+def test_other_errors_are_not_recovered():
+    scan = FrameScanStandIn()
+    scan.pixel_i = 1
+    def move():
+        raise MCLDeviceError("argument out of range", -6)
+    with pytest.raises(MCLDeviceError):
+        scan.with_recovery(move)
+    assert scan.stage.recoveries == 0
+
+
+def test_reverse_lines():
+    scan = ScanStandIn()
+    scan.scan_h_positions = np.concatenate([np.arange(4.0), np.arange(4.0)[::-1]])
+    scan.find_reverse_lines()
+    np.testing.assert_array_equal(scan.scan_reverse, [False]*4 + [True]*4)
+
+
+class ResumeStandIn(object):
+    name = 'resume_stand_in'
+    resume_state = MCLStageScanMixin.resume_state
+    resume_from_checkpoint = MCLStage2DFrameSlowScan.resume_from_checkpoint
+
+    def __init__(self, path):
+        self.path = path
+        self.settings = dict(n_frames=5)
+
+    def checkpoint_path(self):
+        return self.path
+
+
+def test_frame_scan_resume(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    scan = ResumeStandIn(path)
+    scan.resume_from_checkpoint() # no checkpoint yet
+    assert scan.settings['n_frames'] == 5
+    cp = ScanCheckpoint(path, n_frames=5, Npixels=16)
+    cp.update(True, frame_i=2, pixel_i=4)
+    scan.resume_from_checkpoint()
+    assert scan.settings['n_frames'] == 3
+    cp.update(True, status='finished', frame_i=5, pixel_i=0)
+    scan.resume_from_checkpoint()
+    assert scan.settings['n_frames'] == 3
@@ -0,0 +1,43 @@
+'''
+Scan setup on stand-ins that borrow the scan methods: no app, Qt or h5
+file needed, only ScopeFoundry to import them.
+'''
+from __future__ import division, print_function, absolute_import
+import pytest
+
+pytest.importorskip("ScopeFoundry")
+from mcl_stage.mcl_stage_slowscan import MCLStageScanMixin
+
+
+class FakeRecorder(object):
+    running = True
+
+    def __init__(self, mode):
+        self.mode = mode
+
+
+class FakeHW(object):
+
+    def __init__(self, recorder=None):
+        self.recorder = recorder
+        self.scan_owner = None
+
+
+class _Base(object):
+
+    def pre_scan_setup(self):
+        pass
+
+
+class SetupStandIn(MCLStageScanMixin, _Base):
+    name = 'setup_stand_in'
+
+    def __init__(self, stage):
+        self.stage = stage
+
+
+def test_scan_refused_while_wfma_recorder_runs():
+    scan = SetupStandIn(FakeHW(FakeRecorder('wfma')))
+    with pytest.raises(IOError):
+        scan.pre_scan_setup()
+    assert scan.stage.scan_owner is None
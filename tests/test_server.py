@@ -0,0 +1,122 @@
+from __future__ import division, print_function, absolute_import
+import threading
+import numpy as np
+import pytest
+from mcl_stage.mcl_server import (MCLStageServer, encode_array, decode_array, parse_address,
+                                  axis_mask, mask_axes)
+from mcl_stage.mcl_client import MCLStageClient
+from mcl_stage.mcl_nanodrive import MCLDeviceError
+
+
+@pytest.fixture
+def client(nd, tmp_path):
+    address = 'unix:' + str(tmp_path / 'mcl.sock')
+    server = MCLStageServer(nd, address)
+    server.start_thread()
+    c = MCLStageClient(address)
+    yield c
+    c.close()
+    server.stop()
+
+
+def test_encoding():
+    a = np.arange(6.0).reshape(2, 3)
+    np.testing.assert_array_equal(decode_array(encode_array(a)), a)
+    assert parse_address('127.0.0.1:47555') == ('tcp', ('127.0.0.1', 47555))
+    assert parse_address('unix:/tmp/s') == ('unix', '/tmp/s')
+    assert mask_axes(axis_mask([1, 3])) == [1, 3]
+
+
+def test_device_info(client, nd):
+    assert client.device_serial_number == nd.device_serial_number
+    assert client.num_axes == nd.num_axes
+    assert client.cal == nd.cal
+
+
+def test_positions(client, nd):
+    client.set_pos_ax(12.5, 1)
+    assert client.get_commanded_pos_ax(1) == 12.5
+    assert nd.get_commanded_pos_ax(1) == 12.5
+    nd.settle('poll')
+    assert abs(client.get_pos_ax(1, 0) - 12.5) < 0.05
+
+
+def test_batch(client, nd):
+    b = client.batch()
+    for x in (10.0, 11.0, 12.0):
+        b.set_pos_ax(x, 1).get_commanded_pos_ax(1)
+    results = b.read_axes([1, 2]).send()
+    assert len(results) == 7
+    assert [float(r[0]) for r in results[1:6:2]] == [10.0, 11.0, 12.0]
+    assert results[6].shape == (2,)
+
+
+def test_errors(client):
+    with pytest.raises(AssertionError):
+        client.set_pos_ax(1000.0, 1)
+    with pytest.raises(ValueError):
+        client.call('close')
+    # commands after a failed one are skipped, the connection stays usable
+    with pytest.raises(AssertionError):
+        client.batch().set_pos_ax(1000.0, 1).set_pos_ax(5.0, 1).send()
+    assert client.get_commanded_pos_ax(1) != 5.0
+    client.set_pos_ax(5.0, 1)
+    assert client.get_commanded_pos_ax(1) == 5.0
+
+
+def test_remote_moves(client, nd):
+    nd.set_max_speed(50)
+    first = client.move_slow(30.0)
+    second = client.move_slow(y=30.0)
+    assert first.move_id != second.move_id
+    # each handle waits for its own move
+    assert not first.wait(5)
+    assert second.wait(5)
+    assert first.done() and second.done()
+    third = client.move_slow(0.0)
+    third.cancel()
+    assert not third.wait(5)
+    with pytest.raises(ValueError):
+        client.batch().wait_motion(None, 999).send()
+
+
+def test_set_pos_slow(client, nd):
+    nd.set_max_speed(500)
+    client.set_pos_slow(20.0, 25.0)
+    assert nd.get_commanded_pos_ax(1) == 20.0
+    assert nd.get_commanded_pos_ax(2) == 25.0
+    assert not client.motion_active()
+
+
+def test_remote_attributes(client, nd):
+    client.settle_mode = 'poll'
+    assert nd.settle_mode == 'poll'
+    assert client.settle_mode == 'poll'
+    client.max_jerk = 1e6
+    assert nd.max_jerk == 1e6
+
+
+def test_connection_refused(tmp_path):
+    with pytest.raises((MCLDeviceError, OSError)):
+        MCLStageClient('unix:' + str(tmp_path / 'nobody.sock'))
+
+
+def test_busy_io_worker_does_not_block_other_clients(client, nd):
+    # a long driver call holds the I/O worker, the event loop keeps serving
+    release = threading.Event()
+    blocked = nd._io.submit(release.wait, (5,))
+    queued = []
+    t = threading.Thread(target=lambda: queued.append(client.get_pos_ax(1, 0)))
+    t.start()
+    try:
+        other = MCLStageClient(client.address)
+        try:
+            assert other.num_axes == nd.num_axes # served on the thread pool
+        finally:
+            other.close()
+        assert not queued # still waiting for the worker
+    finally:
+        release.set()
+    t.join(5)
+    assert queued
+    assert blocked.result(1)
@@ -0,0 +1,79 @@
+from __future__ import division, print_function, absolute_import
+import threading
+import time
+from mcl_stage.mcl_nanodrive import MCLNanoDrive
+
+
+def test_move_reaches_target(nd):
+    nd.set_max_speed(500)
+    move = nd.move_slow(10.0, 20.0)
+    assert move.wait(5)
+    assert move.done()
+    assert nd.get_commanded_pos_ax(1) == 10.0
+    assert nd.get_commanded_pos_ax(2) == 20.0
+    assert not nd.motion_active()
+
+
+def test_superseded_moves_finish(nd):
+    nd.set_max_speed(50)
+    first = nd.move_slow(30.0)
+    second = nd.move_slow(y=30.0) # superseded while first runs or is pending
+    third = nd.move_slow(y=5.0)
+    assert not first.wait(5)
+    assert not second.wait(5)
+    assert third.wait(5)
+    assert first.superseded and second.superseded
+    # targets of superseded moves are kept for the axes not given later
+    assert nd.get_commanded_pos_ax(1) == 30.0
+    assert nd.get_commanded_pos_ax(2) == 5.0
+
+
+def test_cancel_stops_the_move(nd):
+    nd.set_max_speed(20)
+    move = nd.move_slow(60.0)
+    time.sleep(0.05)
+    move.cancel()
+    assert not move.wait(5)
+    assert move.cancelled
+    assert 0 < nd.get_commanded_pos_ax(1) < 60.0
+
+
+def test_stop_motion(nd):
+    nd.set_max_speed(20)
+    move = nd.move_slow(60.0)
+    nd.stop_motion()
+    assert not move.wait(5)
+    assert nd.wait_motion_idle(5) is not False
+
+
+def test_done_callback(nd):
+    nd.set_max_speed(500)
+    called = threading.Event()
+    ended = []
+    move = nd.move_slow(5.0)
+    move.add_done_callback(lambda m: (ended.append(m), called.set()))
+    assert called.wait(5)
+    assert ended == [move]
+    # added after the end: called right away
+    late = []
+    move.add_done_callback(late.append)
+    assert late == [move]
+
+
+def test_close_finishes_pending_move(sim):
+    nd = MCLNanoDrive(backend=sim)
+    nd.set_max_speed(10)
+    running = nd.move_slow(60.0)
+    pending = nd.move_slow(y=60.0)
+    nd.close()
+    assert running.done() and pending.done()
+    assert not pending.wait(0)
+
+
+def test_timeout(nd):
+    nd.set_max_speed(10)
+    move = nd.move_slow(60.0)
+    assert not move.wait(0.01)
+    assert not move.done()
+    move.cancel()
+    assert not move.wait(5)
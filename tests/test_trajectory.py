@@ -0,0 +1,55 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+from mcl_stage.mcl_trajectory import plan_move, profile_limits, choose_dt
+
+
+def _derivatives(traj, start):
+    p = np.vstack([start[None, :], traj.positions])
+    v = np.diff(p, axis=0)/traj.dt
+    a = np.diff(v, axis=0)/traj.dt
+    return v, a
+
+
+@pytest.mark.parametrize('max_jerk', [None, 2e5])
+def test_plan_move_limits(max_jerk):
+    start = np.array([10.0, 20.0, 5.0])
+    end = np.array([60.0, 10.0, 5.0])
+    max_speed = np.array([100.0, 50.0, 100.0])
+    max_accel = np.array([2000.0, 1000.0, 2000.0])
+    traj = plan_move(start, end, max_speed, max_accel, max_jerk, dt=1e-4)
+    np.testing.assert_array_equal(traj.positions[-1], end)
+    v, a = _derivatives(traj, start)
+    # discretization adds at most one step of slack
+    assert np.all(np.abs(v).max(axis=0) <= max_speed*1.01)
+    assert np.all(np.abs(a[:-1]).max(axis=0) <= max_accel*1.05)
+    # straight line: every point on the segment from start to end
+    s = (traj.positions - start)/(end - start + (end == start))
+    np.testing.assert_allclose(s[:, 0], s[:, 1], atol=1e-12)
+    assert np.all(np.diff(s[:, 0]) >= -1e-12)
+
+
+def test_plan_move_jerk_takes_longer():
+    trapezoid = plan_move([0.0], [50.0], 100.0, 2000.0, dt=1e-3)
+    s_curve = plan_move([0.0], [50.0], 100.0, 2000.0, 2e5, dt=1e-3)
+    assert s_curve.duration > trapezoid.duration
+
+
+def test_plan_move_no_motion():
+    traj = plan_move([1.0, 2.0], [1.0, 2.0], 100.0, 1000.0)
+    assert len(traj) == 1
+    assert traj.duration == 0.0
+    np.testing.assert_array_equal(traj.positions[0], [1.0, 2.0])
+
+
+def test_profile_limits_slowest_axis():
+    vs, as_, js = profile_limits([10.0, -40.0, 0.0], [100.0, 100.0, 1.0], 1000.0)
+    assert vs == pytest.approx(100.0/40.0)
+    assert as_ == pytest.approx(1000.0/40.0)
+    assert js is None
+
+
+def test_choose_dt_bounds():
+    assert choose_dt(1.0, 100.0, 0.1, 0.001, 0.05) == pytest.approx(0.001)
+    assert choose_dt(1.0, 0.5, 0.1, 0.001, 0.05) == pytest.approx(0.05)
+    assert choose_dt(10.0, 100.0, 0.1, 0.001, 0.05, max_points=100) == pytest.approx(0.1)
@@ -0,0 +1,64 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pytest
+from mcl_stage.mcl_transform import StageTransform, sample_matrix
+
+
+def _transform(**kwargs):
+    channels = [('drive', 1), ('drive', 2), ('drive', 3)]
+    return StageTransform(channels, dict(X=0, Y=1, Z=2), [75.0, 75.0, 50.0], **kwargs)
+
+
+def test_round_trip():
+    T = _transform(rotation=12.0, skew=1.5, offset=(30.0, 35.0, 10.0))
+    sample = np.random.RandomState(0).uniform(-5, 5, size=(20, 3))
+    np.testing.assert_allclose(T.to_sample(T.to_stage(sample)), sample, atol=1e-12)
+    assert not T.axis_aligned
+
+
+def test_identity_is_axis_aligned():
+    T = _transform(offset=(1.0, 2.0, 3.0))
+    assert T.axis_aligned
+    np.testing.assert_allclose(T.to_stage([1.0, 1.0, 1.0]), [2.0, 3.0, 4.0])
+    assert T.axis_map('Y') == (1, 1.0, 2.0)
+
+
+def test_rotation_direction():
+    T = _transform(rotation=90.0)
+    np.testing.assert_allclose(T.direction('X'), [0.0, 1.0, 0.0], atol=1e-12)
+    np.testing.assert_array_equal(T.affected(['X']), [True, True, False])
+    with pytest.raises(ValueError):
+        T.axis_map('X')
+
+
+def test_swapped_axis_map():
+    channels = [('drive', 1), ('drive', 2)]
+    T = StageTransform(channels, dict(X=1, Y=0), [75.0, 75.0])
+    np.testing.assert_allclose(T.to_stage([10.0, 20.0, 0.0]), [20.0, 10.0])
+
+
+def test_validate():
+    T = _transform()
+    T.validate(np.array([[0.0, 75.0, 50.0], [10.0, 10.0, 10.0]]))
+    with pytest.raises(ValueError, match="channel 2"):
+        T.validate(np.array([[0.0, 75.0, 50.1]]))
+    with pytest.raises(ValueError):
+        T.validate(np.array([-0.1, 1.0, 1.0]))
+    with pytest.raises(ValueError):
+        T.validate(np.array([np.nan, 1.0, 1.0]))
+    # channels outside the mask are not checked
+    T.validate(np.array([70.0, 75.0, 60.0]), [True, True, False])
+    with pytest.raises(ValueError, match="channel 1"):
+        T.validate(np.array([70.0, 80.0, 60.0]), [True, True, False])
+
+
+def test_sample_matrix_skew():
+    A = sample_matrix(skew=45.0)
+    np.testing.assert_allclose(A.dot([0.0, 1.0, 0.0]), [1.0, 1.0, 0.0])
+
+
+def test_groups_for():
+    channels = [('a', 1), ('a', 2), ('b', 1)]
+    T = StageTransform(channels, dict(X=0, Y=1, Z=2), [75.0, 75.0, 75.0])
+    groups = T.groups_for(T.affected(['X', 'Z']))
+    assert [(drive, list(idx), axes) for drive, idx, axes in groups] == [('a', [0], (1,)), ('b', [2], (1,))]